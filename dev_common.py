@@ -104,7 +104,7 @@ def add_show_messages_button(parent_container, current_messages_count, command):
 
 
 class StrCol(tk.StringVar):
-    """A tk.StringVar that takes a flask-sqlalchemy Model and a bool column name and sets it with the str"""
+    """A tk.StringVar that takes a defect (ex: a DefectDraft) and a bool column name and sets it with the str"""
 
     def __init__(self, defect, column):
         super().__init__()
@@ -116,9 +116,7 @@ class StrCol(tk.StringVar):
             new_bool = True
         else:
             new_bool = False
-        with self.defect_interface.session() as session:
-            setattr(self.defect_interface, self.column, new_bool)
-            self.defect_interface.session.remove()
+        setattr(self.defect_interface, self.column, new_bool)
         super().set(value)
 
 
@@ -0,0 +1,74 @@
+"""Conditional GET (ETag / If-None-Match) for endpoints that are polled.
+
+An endpoint works out a cheap validator for what it would return, the count and latest entry_modified_ts of the rows
+matching the request (the database stamps that in commit order, see helpers.modified_time_ddl), and asks a
+ConditionalResponses for the response. A client that already has that version gets a 304 without any rows being
+loaded. A repeat poll from a different client gets the body from the cache.
+"""
+import collections
+import hashlib
+import threading
+
+import flask
+
+
+class ConditionalResponses:
+    """Serves a polled endpoint's responses by ETag, with a small cache of the recent bodies."""
+
+    max_entries = 16  # bodies kept, the least recently used are dropped first
+    max_body_bytes = 4 * 1024 * 1024  # larger bodies are streamed but not kept
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bodies = collections.OrderedDict()
+
+    def etag(self, *validator):
+        """Get the ETag for a version of a response.
+
+        :param validator: anything with a stable repr, that changes when the response would, ex: the request's
+        parameters with the count and max(modified time) of the rows.
+        :return: str, the ETag (without the quotes).
+        """
+        return hashlib.blake2b(repr(validator).encode(), digest_size=16).hexdigest()
+
+    def respond(self, etag, generate_body, last_modified=None, mimetype='application/json'):
+        """Get the response for a conditional GET.
+
+        :param etag: str, from etag() for this request.
+        :param generate_body: function, called without parameters if the body is needed. Returns an iterable of str
+        chunks, the response is streamed as they are produced.
+        :param last_modified: datetime.datetime, optional, for the Last-Modified header.
+        :param mimetype: str, the response mimetype.
+        :return: flask.Response, 304 if the request's If-None-Match has the etag.
+        """
+        if flask.request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+        else:
+            with self._lock:
+                body = self._bodies.get(etag)
+                if body is not None:
+                    self._bodies.move_to_end(etag)
+            if body is None:
+                body = flask.stream_with_context(self._generate_and_keep(etag, generate_body()))
+            response = flask.Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        return response
+
+    def _generate_and_keep(self, etag, chunks):
+        """Pass the chunks along and keep the body once it is complete, if it isn't too big."""
+        kept = []
+        kept_size = 0
+        for chunk in chunks:
+            if kept is not None:
+                kept.append(chunk)
+                kept_size += len(chunk)
+                if kept_size > self.max_body_bytes:
+                    kept = None
+            yield chunk
+        if kept is not None:
+            with self._lock:
+                self._bodies[etag] = ''.join(kept)
+                while len(self._bodies) > self.max_entries:
+                    self._bodies.popitem(last=False)
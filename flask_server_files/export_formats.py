@@ -0,0 +1,127 @@
+"""Writers that turn chunks of table rows into the bytes of an export file, a chunk at a time.
+
+Each writer takes a RowSerializer for the table and an iterable of lists of rows, and yields the file's bytes as it
+goes, so an export never holds more than a chunk of rows in memory. parquet and arrow need pyarrow, which is optional.
+"""
+import csv
+import datetime
+import io
+
+
+def csv_chunks(serializer, row_chunks):
+    """Yield a CSV file with a header row, a chunk of rows at a time.
+
+    :param serializer: RowSerializer, for the table of the rows.
+    :param row_chunks: iterable, of lists of rows in the order of serializer.select_columns.
+    :return: generator, of bytes.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(serializer.columns)
+    for rows in row_chunks:
+        writer.writerows(serializer.row_dict(row).values() for row in rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def arrow_schema(serializer):
+    """Get the pyarrow schema for a table's columns.
+
+    :param serializer: RowSerializer, for the table.
+    :return: pyarrow.Schema
+    """
+    import pyarrow as pa
+
+    arrow_types = {bool: pa.bool_(), int: pa.int64(), float: pa.float64(), str: pa.string(),
+                   datetime.datetime: pa.timestamp('us', tz='UTC'), datetime.date: pa.date32()}
+    fields = []
+    for name, column in zip(serializer.columns, serializer.select_columns):
+        try:
+            arrow_type = arrow_types.get(column.type.python_type, pa.string())
+        except NotImplementedError:
+            arrow_type = pa.string()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+def _record_batch(schema, rows):
+    """Transpose a chunk of rows into the columns of a pyarrow.RecordBatch."""
+    import pyarrow as pa
+
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    return pa.record_batch([pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                           schema=schema)
+
+
+class _DrainedSink:
+    """A write-only file for pyarrow writers, the bytes written so far are taken out with drain."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def arrow_chunks(serializer, row_chunks):
+    """Yield an Arrow IPC stream, a record batch per chunk of rows.
+
+    :param serializer: RowSerializer, for the table of the rows.
+    :param row_chunks: iterable, of lists of rows in the order of serializer.select_columns.
+    :return: generator, of bytes.
+    """
+    import pyarrow as pa
+
+    schema = arrow_schema(serializer)
+    sink = _DrainedSink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        yield sink.drain()
+        for rows in row_chunks:
+            writer.write_batch(_record_batch(schema, rows))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def parquet_chunks(serializer, row_chunks):
+    """Yield a Parquet file, a row group per chunk of rows.
+
+    :param serializer: RowSerializer, for the table of the rows.
+    :param row_chunks: iterable, of lists of rows in the order of serializer.select_columns.
+    :return: generator, of bytes.
+    """
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(serializer)
+    sink = _DrainedSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in row_chunks:
+            writer.write_batch(_record_batch(schema, rows))
+            yield sink.drain()
+    yield sink.drain()
+
+
+# format: (writer, mimetype, file extension, needs pyarrow)
+export_formats = {'csv': (csv_chunks, 'text/csv', 'csv', False),
+                  'parquet': (parquet_chunks, 'application/vnd.apache.parquet', 'parquet', True),
+                  'arrow': (arrow_chunks, 'application/vnd.apache.arrow.stream', 'arrows', True)}
@@ -8,14 +8,17 @@ import requests
 import waitress
 from flask_restful import Api
 
+from dev_common import exception_one_line
 from flask_server_files.queuesholder import queues
+from flask_server_files.request_metrics import RequestMetrics
 from flask_server_files.resources.btn_msg import ButtonMessage
-from flask_server_files.resources.database import Database
-from flask_server_files.resources.defect import Defect, DefectList
+from flask_server_files.resources.database import apply_migrations, Database
+from flask_server_files.resources.defect import (Defect, DefectBulk, DefectExport, DefectLengths, DefectList,
+                                                 DefectSummary)
 from flask_server_files.resources.lam_operator import Operator, Operators
 from flask_server_files.resources.signal_popup import Popup
 from flask_server_files.routing import routes_blueprint
-from flask_server_files.sqla_instance import fsa
+from flask_server_files.sqla_instance import fsa, pool_metrics
 from log_and_alert.log_setup import lg
 from untracked_config.configuration_data import DATABASE_URI, host, port, server_threads
 
@@ -27,11 +30,19 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.secret_key = 'this will be important when security is implemented'
 app.debug = True
 
+# per route request counts, errors and latencies, and the server threads in use, served at /metrics
+request_metrics = RequestMetrics(app, threads=server_threads)
+request_metrics.add_collector(pool_metrics)
+
 # add the restful endpoints
 api = Api(app)
 api.add_resource(Defect, '/defect')
 api.add_resource(Popup, '/popup')
 api.add_resource(DefectList, '/defects')
+api.add_resource(DefectLengths, '/defects/recompute_lengths')
+api.add_resource(DefectBulk, '/defects/bulk')
+api.add_resource(DefectExport, '/defects/export')
+api.add_resource(DefectSummary, '/defects/summary')
 api.add_resource(Database, '/database')
 api.add_resource(Operator, '/operator')
 api.add_resource(Operators, '/operators')
@@ -60,6 +71,10 @@ def start_flask_app(in_message_queue=None, out_message_queue=None):
         lg.warning('No inbound defect_instance queue!')
 
     fsa.init_app(app)
+    try:
+        apply_migrations()
+    except Exception as exc:
+        lg.error('Database migrations could not be applied: %s', exception_one_line(exc))
     # with app.app_context() as ac:
     #     from flask_server_files.resources.database import create_tables
     #     create_tables()
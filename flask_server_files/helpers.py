@@ -1,10 +1,15 @@
 import contextlib
 import datetime
+import decimal
 import errno
+import functools
+import json
 import os
 import time
 from typing import Any, Callable
 
+import sqlalchemy
+from sqlalchemy import event
 from sqlalchemy.types import TIMESTAMP, TypeDecorator
 
 
@@ -27,6 +32,144 @@ class Timestamp(TypeDecorator):
         return datetime.datetime.fromisoformat(value)
 
 
+def json_dumps_function(fast=True):
+    """Get a function that encodes a dict as a JSON str, orjson's when it is installed and fast is True.
+
+    :param fast: bool, use orjson if it is installed. Default=True
+    :return: function
+    """
+    if fast:
+        try:
+            import orjson
+
+            return lambda obj: orjson.dumps(obj).decode()
+        except ImportError:
+            pass
+    return json.dumps
+
+
+def _column_converter(column):
+    """Get the function that makes a column's values json serializable, or None if they already are."""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return None
+    if issubclass(python_type, (datetime.date, datetime.time)):  # datetime.datetime is a datetime.date
+        return python_type.isoformat
+    if issubclass(python_type, decimal.Decimal):
+        return float
+    return None
+
+
+class RowSerializer:
+    """Converts rows of a table to json serializable dicts, or JSON, with the work per column done once up front.
+
+    The column names and the converters for the columns that need one (the datetimes) are looked up when the serializer
+    is made, so each row is one pass over a tuple. Rows can be Core rows (select_columns, in order) or model instances.
+    Get one per model class with model_serializer.
+
+    ex:
+        > serializer = model_serializer(DefectModel)
+        > rows = DefectModel.session.execute(sqlalchemy.select(*serializer.select_columns)).all()
+        > serializer.to_json(rows[0])
+        '{"id": 1, "source_lot_number": "12345", ...}'
+    """
+
+    def __init__(self, table, fast_json=True):
+        """Initialize a new instance.
+
+        :param table: sqlalchemy.Table, the table of the rows.
+        :param fast_json: bool, encode JSON with orjson if it is installed. Default=True
+        """
+        self.select_columns = tuple(table.columns)
+        self.columns = tuple(str(key) for key in table.columns.keys())  # plain str, not quoted_name, for orjson
+        self._converters = tuple((index, converter) for index, converter in
+                                 enumerate(_column_converter(column) for column in self.select_columns)
+                                 if converter is not None)
+        self.dumps = json_dumps_function(fast_json)
+
+    def row_dict(self, row):
+        """Get a json serializable dict of a row.
+
+        :param row: tuple, of the values in the order of select_columns, ex: a sqlalchemy Row.
+        :return: dict
+        """
+        values = list(row)
+        for index, converter in self._converters:
+            value = values[index]
+            if value is not None:
+                values[index] = converter(value)
+        return dict(zip(self.columns, values))
+
+    def model_dict(self, model):
+        """Get a json serializable dict of a model instance.
+
+        :param model: a SQLAlchemy model instance of the table.
+        :return: dict
+        """
+        return self.row_dict([getattr(model, key) for key in self.columns])
+
+    def to_json(self, row):
+        """Get the JSON of a row.
+
+        :param row: tuple, of the values in the order of select_columns.
+        :return: str
+        """
+        return self.dumps(self.row_dict(row))
+
+
+@functools.lru_cache(maxsize=None)
+def model_serializer(model_class):
+    """Get the RowSerializer for a SQLAlchemy model class, it is made the first time it is asked for.
+
+    :param model_class: the model class, ex: DefectModel
+    :return: RowSerializer
+    """
+    return RowSerializer(model_class.__table__)
+
+
+# entry_modified_ts is stamped by the database with the time of each write (clock_timestamp), not the time its
+# transaction began (now()). Each write to the table first takes a lock held until the commit, so a transaction that
+# commits later can't stamp an earlier time than one already committed. That makes the latest stamp a version of the
+# table: a poll for the rows past the last stamp it saw doesn't miss a slow commit, and count() with
+# max(entry_modified_ts) is a validator that changes with any write.
+_stamp_modified_function = '''CREATE OR REPLACE FUNCTION stamp_entry_modified_ts() RETURNS trigger AS $$
+BEGIN
+    IF TG_LEVEL = 'STATEMENT' THEN
+        PERFORM pg_advisory_xact_lock(TG_RELID::bigint);
+        RETURN NULL;
+    END IF;
+    NEW.entry_modified_ts := clock_timestamp();
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql'''
+
+
+def modified_time_ddl(table):
+    """Get the DDL of the function and triggers that stamp a table's entry_modified_ts in commit order (see above), for
+    PostgreSQL.
+
+    :param table: sqlalchemy.Table, with an entry_modified_ts column.
+    :return: tuple, (sqlalchemy.DDL creating or replacing the function, dict of {trigger name: sqlalchemy.DDL})
+    """
+    triggers = {}
+    for name, level in (('lock', 'STATEMENT'), ('stamp', 'ROW')):
+        trigger = f'{table.name}_modified_{name}'
+        triggers[trigger] = sqlalchemy.DDL(f'CREATE TRIGGER {trigger} BEFORE INSERT OR UPDATE ON {table.name} '
+                                           f'FOR EACH {level} EXECUTE PROCEDURE stamp_entry_modified_ts()')
+    return sqlalchemy.DDL(_stamp_modified_function), triggers
+
+
+def stamp_modified_time(table):
+    """Add the triggers that stamp a table's entry_modified_ts when the table is created on PostgreSQL.
+
+    :param table: sqlalchemy.Table, with an entry_modified_ts column.
+    """
+    function, triggers = modified_time_ddl(table)
+    for ddl in (function, *triggers.values()):
+        event.listen(table, 'after_create', ddl.execute_if(dialect='postgresql'))
+
+
 def jsonize_sqla_model(model):
     """Get a json serializable representation of the SQLAlchemy Model instance.
 
@@ -35,17 +178,7 @@ def jsonize_sqla_model(model):
     :return: dict
     """
 
-    jdict = {}
-    for key in model.__table__.columns.keys():
-        this_val = getattr(model, key)
-        if isinstance(this_val, datetime.datetime):
-            try:
-                this_val = this_val.isoformat()
-            except AttributeError as er:
-                this_val = str(this_val)
-
-        jdict[key] = this_val
-    return jdict
+    return model_serializer(type(model)).model_dict(model)
 
 
 def remove_empty_parameters(data):
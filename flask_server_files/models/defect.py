@@ -4,7 +4,8 @@ import sqlalchemy
 from sqlalchemy import func
 
 from dev_common import exception_one_line
-from flask_server_files.helpers import jsonize_sqla_model
+from flask_server_files.helpers import jsonize_sqla_model, model_serializer, stamp_modified_time
+from flask_server_files.models.defect_rollup import DefectRollupModel, rollup_source_columns
 from flask_server_files.models.model_wrapper import ModelWrapper
 from flask_server_files.sqla_instance import Base
 from log_and_alert.log_setup import lg
@@ -53,6 +54,13 @@ class DefectModel(Base):
     operator_list_id = sqlalchemy.Column(sqlalchemy.Integer)
     shift_number = sqlalchemy.Column(sqlalchemy.Integer)
 
+    # the popup checks for new (unconfirmed) defects every few seconds, keep that from scanning the whole table
+    unconfirmed_index = sqlalchemy.Index('ix_defect_records_unconfirmed_lam_created', lam_num, entry_created_ts,
+                                         postgresql_where=operator_saved_time.is_(None))
+    # and the local mirror polls for the defects modified since its last sync, confirmed or not
+    modified_index = sqlalchemy.Index('ix_defect_records_lam_modified', lam_num, entry_modified_ts)
+    __table_args__ = (unconfirmed_index, modified_index)
+
     def __init__(self, **kwargs):
         # for the kwargs provided, assign them to the corresponding columns
         self_keys = DefectModel.__dict__.keys()
@@ -74,25 +82,76 @@ class DefectModel(Base):
         return id_df
 
     @classmethod
-    def find_new(cls, lam_number=None):
-        """Get a list of DefectModel objects that are new.
-        New here is defined as the creation and modification times are the same or have no operator_saved_time.
-        They will be ordered from oldest to newest.
+    def new_query(cls, lam_number=None, session=None):
+        """Get the query for the defects that are new, those that have not been confirmed (no operator_saved_time).
+        It is served by the unconfirmed_index partial index.
 
-        :return: list, [<DefectModel 1>, <DefectModel 2>]
+        :param lam_number: int, optional, if used only get defects from this laminator.
+        :param session: sqlalchemy.orm.Session, optional, ex: a snapshot_session. Default=None, cls.session.
+        :return: sqlalchemy.orm.Query
         """
 
         if lam_number is None:
-            return cls.query.filter(DefectModel.operator_saved_time is None or
-                                    DefectModel.entry_modified_ts == DefectModel.entry_created_ts).order_by(
-                DefectModel.entry_created_ts.desc()).all()
+            where = cls.operator_saved_time.is_(None)
         else:
+            where = sqlalchemy.and_(cls.operator_saved_time.is_(None), cls.lam_num == lam_number)
+        query = cls.query if session is None else session.query(cls)
+        return query.filter(where).order_by(cls.entry_created_ts.desc())
+
+    @classmethod
+    def find_new(cls, lam_number=None, session=None):
+        """Get a list of DefectModel objects that are new, those that have not been confirmed (no operator_saved_time).
+        They will be ordered from newest to oldest.
+
+        :param lam_number: int, optional, if used only get defects from this laminator.
+        :param session: sqlalchemy.orm.Session, optional, ex: a snapshot_session. Default=None, cls.session.
+        :return: list, [<DefectModel 2>, <DefectModel 1>]
+        """
+
+        return cls.new_query(lam_number, session).all()
+
+    @classmethod
+    def find_new_since(cls, lam_number=None, since_id=None, since_modified=None, session=None):
+        """Get the defects past a high-water mark, for polling for new defects without reloading them all each time.
+
+        Without a mark this gets every defect that has not been confirmed (no operator_saved_time). With a mark it gets
+        every defect with an id above since_id or modified after since_modified, confirmed or not, so the caller
+        can add the new ones and drop the ones that have since been confirmed elsewhere.
+        They will be ordered from newest to oldest.
+
+        :param lam_number: int, optional, if used only get defects from this laminator.
+        :param since_id: int, optional, the highest defect id seen so far.
+        :param since_modified: datetime.datetime, optional, the latest entry_modified_ts seen so far, the database stamps
+        those in commit order (see helpers.modified_time_ddl).
+        :param session: sqlalchemy.orm.Session, optional, ex: a snapshot_session. Default=None, cls.session.
+        :return: list, [<DefectModel 2>, <DefectModel 1>]
+        """
+
+        if since_id is None and since_modified is None:
+            return cls.find_new(lam_number, session)
+        return cls.since_query(lam_number, since_id, since_modified, session).all()
+
+    @classmethod
+    def since_query(cls, lam_number=None, since_id=None, since_modified=None, session=None):
+        """Get the query for the defects past a high-water mark, see find_new_since. Each side of the OR is an index
+        range, the primary key for the ids and modified_index for the modified times, so it reads only the changes.
+
+        :param lam_number: int, optional, if used only get defects from this laminator.
+        :param since_id: int, optional, the highest defect id seen so far.
+        :param since_modified: datetime.datetime, optional, the latest entry_modified_ts seen so far.
+        :param session: sqlalchemy.orm.Session, optional, ex: a snapshot_session. Default=None, cls.session.
+        :return: sqlalchemy.orm.Query
+        """
 
-            return cls.query.filter(DefectModel.operator_saved_time is None or
-                                    DefectModel.entry_modified_ts == DefectModel.entry_created_ts).filter(
-                DefectModel.lam_num == lam_number and (DefectModel.flagger_fire is not sqlalchemy.TIMESTAMP or
-                                                       DefectModel.record_creation_source == 'operator')).order_by(
-                DefectModel.entry_created_ts.desc()).all()
+        past_mark = []
+        if since_id is not None:
+            past_mark.append(cls.id > since_id)
+        if since_modified is not None:
+            past_mark.append(cls.entry_modified_ts > since_modified)
+        query = (cls.query if session is None else session.query(cls)).filter(sqlalchemy.or_(*past_mark))
+        if lam_number is not None:
+            query = query.filter(cls.lam_num == lam_number)
+        return query.order_by(cls.entry_created_ts.desc())
 
     @classmethod
     def find_all(cls):
@@ -103,15 +162,28 @@ class DefectModel(Base):
         return cls.query.all()
 
     @classmethod
-    def mark_all_confirmed(cls):
-        """Mark all a defect records that have not been confirmed as confirmed at this time.
+    def mark_all_confirmed(cls, lam_number=None):
+        """Mark all a defect records that have not been confirmed as confirmed at this time, with one UPDATE.
 
-        :return: list
+        :param lam_number: int, optional, if used only confirm the defects from this laminator.
+        :return: int, the number of defects confirmed.
         """
-        unconfirmed = cls.find_new()
-        for defect in unconfirmed:
-            defect.operator_saved_time = defect.db_current_ts
-            defect.save_to_database()
+        where = [cls.operator_saved_time.is_(None)]
+        if lam_number is not None:
+            where.append(cls.lam_num == lam_number)
+        query = sqlalchemy.update(cls.__table__).where(*where).values(operator_saved_time=cls.db_current_ts).returning(
+            *cls.rollup_columns())
+        try:
+            confirmed = cls.session.execute(query).all()
+            DefectRollupModel.apply_changes(cls.session, [({**row._mapping, 'operator_saved_time': None}, row._mapping)
+                                                          for row in confirmed])
+            cls.session.commit()
+        except Exception as exc:
+            lg.error(exception_one_line(exception_obj=exc))
+            cls.session.rollback()
+            raise
+        lg.info('Marked %s defects confirmed.', len(confirmed))
+        return len(confirmed)
 
     @classmethod
     def new_defect(cls, **kwargs):
@@ -143,6 +215,289 @@ class DefectModel(Base):
         lg.debug('Data collected: %s records', len(results))
         return results
 
+    @classmethod
+    def keyset_page_query(cls, columns, page_size, after_id=None, start_date=None, end_date=None, lam_num=None):
+        """Get the select for one page of defects, newest first, starting after the defect id after_id.
+
+        Paging on the id (keyset) instead of with an OFFSET keeps every page as fast as the first.
+
+        :param columns: iterable, of the columns to select, they must include id.
+        :param page_size: int, the maximum number of defects in the page.
+        :param after_id: int, optional, the last id of the previous page. Default=None, start from the newest.
+        :param start_date: str, optional, ISO formatted string, only defects with start dates after this.
+        :param end_date: str, optional, ISO formatted string, only defects with start dates before this.
+        :param lam_num: int, optional, if used limit the lam_num column results to those matching. Default=None, all.
+        :return: sqlalchemy.Select
+        """
+        query = sqlalchemy.select(*columns).where(*cls.defects_filter(start_date, end_date, lam_num))
+        if after_id is not None:
+            query = query.where(cls.id < after_id)
+        return query.order_by(cls.id.desc()).limit(page_size)
+
+    @classmethod
+    def defects_filter(cls, start_date=None, end_date=None, lam_num=None):
+        """Get the filter for the defects between the start dates, optionally for a single lam_num.
+
+        :param start_date: str, optional, ISO formatted string, only defects with start dates after this.
+        :param end_date: str, optional, ISO formatted string, only defects with start dates before this.
+        :param lam_num: int, optional, if used limit the lam_num column results to those matching. Default=None, all.
+        :return: list, of sqlalchemy expressions for filter/where.
+        """
+        where = []
+        if start_date and end_date:
+            where.append(cls.defect_start_ts > datetime.datetime.fromisoformat(start_date))
+            where.append(cls.defect_start_ts < datetime.datetime.fromisoformat(end_date))
+        if lam_num is not None:
+            where.append(cls.lam_num == lam_num)
+        return where
+
+    @classmethod
+    def iter_chunks(cls, columns=None, chunk_size=5000, **filters):
+        """Yield the defects in id order a chunk at a time, read from a server-side cursor.
+
+        :param columns: iterable, optional, of the columns to select. Default=None, all of them.
+        :param chunk_size: int, the number of rows fetched from the cursor at a time.
+        :param filters: start_date, end_date and lam_num, see defects_filter.
+        :return: generator, of lists of sqlalchemy Rows.
+        """
+        columns = cls.__table__.columns if columns is None else columns
+        query = sqlalchemy.select(*columns).where(*cls.defects_filter(**filters)).order_by(cls.id)
+        result = cls.session.execute(query, execution_options={'yield_per': chunk_size})
+        for rows in result.partitions():
+            yield rows
+
+    # the columns and time buckets defects can be summarized by
+    summary_group_columns = ('lam_num', 'shift_number', 'defect_type', 'source_lot_number', 'recipe')
+    summary_buckets = ('hour', 'day', 'week')
+
+    @classmethod
+    def summary_groups(cls, group_by=(), bucket=None):
+        """Get the expressions to group a summary by.
+
+        :param group_by: iterable, of column names from summary_group_columns.
+        :param bucket: str, optional, one of summary_buckets.
+        :return: list, of sqlalchemy expressions, the time bucket (labeled period) first.
+        :raises ValueError: for a column or bucket that can't be used.
+        """
+        groups = []
+        if bucket is not None:
+            if bucket not in cls.summary_buckets:
+                raise ValueError(f'Unknown time bucket {bucket}, use one of: {", ".join(cls.summary_buckets)}.')
+            # a literal, not a parameter, so the select and the GROUP BY are the same expression to postgres
+            groups.append(func.date_trunc(sqlalchemy.literal_column(f"'{bucket}'"), cls.defect_start_ts).label('period'))
+        for column_name in group_by:
+            if column_name not in cls.summary_group_columns:
+                raise ValueError(f'Cannot group by {column_name}, use any of: {", ".join(cls.summary_group_columns)}.')
+            groups.append(cls.__table__.c[column_name])
+        return groups
+
+    @classmethod
+    def summarize(cls, group_by=(), bucket=None, **filters):
+        """Get the count and meters of the defects grouped by columns and/or a time bucket, with one GROUP BY query.
+
+        ex:
+            > DefectModel.summarize(('lam_num', 'shift_number'), bucket='day',
+            >                       start_date='2023-09-01', end_date='2023-09-08')
+            [Row(period=datetime(2023, 9, 1, 0, 0), lam_num=1, shift_number=1, defect_count=4, total_meters=31.5,
+                 max_meters=12.0), ...]
+
+        :param group_by: iterable, of column names from summary_group_columns.
+        :param bucket: str, optional, one of summary_buckets, group by the start time truncated to this.
+        :param filters: start_date, end_date and lam_num, see defects_filter.
+        :return: list, of sqlalchemy Rows of (period if bucket, the group_by columns, defect_count, total_meters,
+        max_meters), in that order.
+        :raises ValueError: for a column or bucket that can't be used.
+        """
+        groups = cls.summary_groups(group_by, bucket)
+        query = sqlalchemy.select(*groups, func.count().label('defect_count'),
+                                  func.coalesce(func.sum(cls.length_of_defect_meters), 0).label('total_meters'),
+                                  func.max(cls.length_of_defect_meters).label('max_meters')).where(
+            *cls.defects_filter(**filters)).group_by(*groups).order_by(*groups)
+        return cls.session.execute(query).all()
+
+    @classmethod
+    def get_validator(cls, start_date=None, end_date=None, lam_num=None):
+        """Get a summary of the defects that changes when any of them are added, changed or removed, their count and
+        latest entry_modified_ts. The database stamps that in commit order, see helpers.modified_time_ddl.
+
+        :param start_date: str, optional, see defects_filter.
+        :param end_date: str, optional, see defects_filter.
+        :param lam_num: int, optional, see defects_filter.
+        :return: tuple, (int count, datetime.datetime latest entry_modified_ts or None)
+        """
+        query = sqlalchemy.select(func.count(), func.max(cls.entry_modified_ts)).where(
+            *cls.defects_filter(start_date, end_date, lam_num))
+        return tuple(cls.session.execute(query).one())
+
+    @classmethod
+    def iter_pages(cls, columns=None, page_size=1000, after_id=None, limit=None, **filters):
+        """Yield the defects a page at a time, newest first, so all of them never have to be held in memory.
+
+        The rows are Core rows (named tuples) rather than DefectModel instances, they are much cheaper to load.
+
+        :param columns: iterable, optional, of the columns to select, they must include id. Default=None, all of them.
+        :param page_size: int, the number of defects to query at a time.
+        :param after_id: int, optional, start after this defect id. Default=None, start from the newest.
+        :param limit: int, optional, stop after this many defects. Default=None, all of them.
+        :param filters: start_date, end_date and lam_num, see keyset_page_query.
+        :return: generator, of lists of sqlalchemy Rows.
+        """
+        columns = cls.__table__.columns if columns is None else columns
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            page = cls.session.execute(cls.keyset_page_query(columns, size, after_id, **filters)).all()
+            if not page:
+                return
+            yield page
+            if len(page) < size:
+                return
+            after_id = page[-1].id
+            if remaining is not None:
+                remaining -= len(page)
+
+    @classmethod
+    def patch(cls, id_, values):
+        """Update the columns of a defect with one UPDATE ... RETURNING statement, without loading it first.
+
+        If a mahlo length is set and length_of_defect_meters isn't, the length is worked out in the same statement from
+        the new and stored mahlo lengths.
+
+        :param id_: int, the defect id.
+        :param values: dict, of {column name: value}, the values already converted to the column types.
+        :return: sqlalchemy Row, of all the columns after the update, or None if there is no defect with the id.
+        """
+        table = cls.__table__
+        values = dict(values)
+        if ('length_of_defect_meters' not in values and
+                ('mahlo_start_length' in values or 'mahlo_end_length' in values)):
+            start, end = (sqlalchemy.literal(values[column], sqlalchemy.Float) if column in values else table.c[column]
+                          for column in ('mahlo_start_length', 'mahlo_end_length'))
+            values['length_of_defect_meters'] = func.round(sqlalchemy.cast(end - start, sqlalchemy.Numeric), 2)
+        query = sqlalchemy.update(table).where(table.c.id == id_).values(values).returning(*table.columns)
+        try:
+            before = cls.get_rollup_rows([id_], for_update=True) if set(values) & set(rollup_source_columns) else {}
+            row = cls.session.execute(query).one_or_none()
+            if id_ in before and row is not None:
+                DefectRollupModel.apply_changes(cls.session, [(before[id_], row._mapping)])
+            cls.session.commit()
+        except Exception as exc:
+            lg.error(exception_one_line(exception_obj=exc))
+            cls.session.rollback()
+            raise
+        return row
+
+    @classmethod
+    def bulk_insert(cls, records):
+        """Insert many defects in one transaction, with an executemany INSERT per set of columns.
+
+        On PostgreSQL the ids are taken from the id sequence in one query first, so the INSERTs don't need RETURNING
+        (an executemany RETURNING in parameter order needs SQLAlchemy 2.0.10). Other databases insert one at a time.
+        Records that set the same columns are inserted together, the columns a record leaves out get their defaults.
+
+        :param records: list, of dicts of {column name: value}, the values already converted to the column types.
+        :return: list, of the new ids in the order of the records.
+        """
+        if not records:
+            return []
+        table = cls.__table__
+        try:
+            if cls.session.get_bind().dialect.name == 'postgresql':
+                new_ids = cls._next_ids(len(records))
+                by_columns = {}
+                for record, new_id in zip(records, new_ids):
+                    by_columns.setdefault(tuple(sorted(record)), []).append({**record, 'id': new_id})
+                for rows in by_columns.values():
+                    cls.session.execute(sqlalchemy.insert(table), rows)
+            else:
+                new_ids = [cls.session.execute(sqlalchemy.insert(table).values(record)).inserted_primary_key[0]
+                           for record in records]
+            DefectRollupModel.apply_changes(cls.session, ((None, row) for row in cls.get_rollup_rows(new_ids).values()))
+            cls.session.commit()
+        except Exception as exc:
+            lg.error(exception_one_line(exception_obj=exc))
+            cls.session.rollback()
+            raise
+        return new_ids
+
+    @classmethod
+    def _next_ids(cls, count):
+        """Take ids for new defects from the PostgreSQL sequence of the id column.
+
+        :param count: int, the number of ids.
+        :return: list, of ints.
+        """
+        sequence = func.pg_get_serial_sequence(cls.__tablename__, 'id')
+        query = sqlalchemy.select(func.nextval(sequence)).select_from(func.generate_series(1, count))
+        return list(cls.session.execute(query).scalars())
+
+    @classmethod
+    def rollup_columns(cls):
+        """Get the id and the columns the defect rollup is made from.
+
+        :return: list, of sqlalchemy Columns.
+        """
+        return [cls.id] + [cls.__table__.c[column] for column in rollup_source_columns]
+
+    @classmethod
+    def get_rollup_rows(cls, ids, for_update=False, session=None):
+        """Get the columns the defect rollup is made from, for defects by id.
+
+        :param ids: list, of defect ids.
+        :param for_update: bool, lock the rows until the end of the transaction, for rows about to be changed.
+        :param session: sqlalchemy.orm.Session, optional, the session to query in. Default=None, cls.session.
+        :return: dict, of {id: mapping of {column name: value}}
+        """
+        if not ids:
+            return {}
+        session = cls.session if session is None else session
+        query = sqlalchemy.select(*cls.rollup_columns()).where(cls.id.in_(ids))
+        if for_update:
+            query = query.with_for_update()
+        return {row.id: row._mapping for row in session.execute(query)}
+
+    @classmethod
+    def get_defect_windows(cls, start_date, end_date, lam_num):
+        """Get the id, start and end timestamps, and length of the defects that started between the dates for a lam.
+
+        :param start_date: str, ISO formatted string of the beginning date-time of the range to search.
+        :param end_date: str, ISO formatted string of the ending date-time of the range to search.
+        :param lam_num: int, the laminator number.
+        :return: list, of Row(id, defect_start_ts, defect_end_ts, length_of_defect_meters) ordered by id.
+        """
+        start_date = datetime.datetime.fromisoformat(start_date)
+        end_date = datetime.datetime.fromisoformat(end_date)
+        query = sqlalchemy.select(cls.id, cls.defect_start_ts, cls.defect_end_ts, cls.length_of_defect_meters).where(
+            cls.defect_start_ts > start_date, cls.defect_start_ts < end_date, cls.lam_num == lam_num).order_by(cls.id)
+        return cls.session.execute(query).all()
+
+    @classmethod
+    def bulk_update_lengths(cls, lengths_by_id):
+        """Set the length_of_defect_meters of many defects with one executemany UPDATE in a single transaction.
+
+        The UPDATE matches each defect's id to a bound parameter, so it's keyed the same way on SQLAlchemy 1.4, where
+        an ORM bulk UPDATE by primary key doesn't exist.
+
+        :param lengths_by_id: dict, {defect id: length in meters}
+        :return: int, the number of defects updated.
+        """
+        if not lengths_by_id:
+            return 0
+        try:
+            before = cls.get_rollup_rows(list(lengths_by_id), for_update=True)
+            table = cls.__table__
+            query = sqlalchemy.update(table).where(table.c.id == sqlalchemy.bindparam('b_id')).values(
+                length_of_defect_meters=sqlalchemy.bindparam('b_length'))
+            cls.session.execute(query, [{'b_id': id_, 'b_length': length} for id_, length in lengths_by_id.items()])
+            DefectRollupModel.apply_changes(cls.session, (
+                (row, {**row, 'length_of_defect_meters': lengths_by_id[id_]}) for id_, row in before.items()))
+            cls.session.commit()
+        except Exception as exc:
+            lg.error(exception_one_line(exception_obj=exc))
+            cls.session.rollback()
+            raise
+        return len(lengths_by_id)
+
     def save_to_database(self):
         """Save the changed to defect to the database."""
 
@@ -158,14 +513,40 @@ class DefectModel(Base):
 
         :return: dict
         """
-        jdict = {}
-        for key in self.__table__.columns.keys():
-            jdict[key] = self.__dict__.get(key)
-        return jdict
+        return {key: self.__dict__.get(key) for key in model_serializer(DefectModel).columns}
 
     def jsonizable(self):
         return jsonize_sqla_model(self)
 
 
+def _rollup_modified(defect):
+    """Check if any of the columns the rollup is made from have been changed on a DefectModel."""
+    state = sqlalchemy.inspect(defect)
+    return any(state.attrs[column].history.has_changes() for column in rollup_source_columns)
+
+
+@sqlalchemy.event.listens_for(Base.session, 'before_flush')
+def _rollup_before_flush(session, flush_context, instances):
+    """Keep the rollup columns of the defects about to be changed or deleted, as they are in the database."""
+    ids = [defect.id for defect in session.dirty if isinstance(defect, DefectModel) and _rollup_modified(defect)]
+    ids += [defect.id for defect in session.deleted if isinstance(defect, DefectModel)]
+    with session.no_autoflush:
+        session.info['defect_rollup_before'] = DefectModel.get_rollup_rows(ids, for_update=True, session=session)
+
+
+@sqlalchemy.event.listens_for(Base.session, 'after_flush')
+def _rollup_after_flush(session, flush_context):
+    """Apply the defects added, changed or deleted by an ORM flush (ex: save_to_database) to the rollup, in the same
+    transaction."""
+    before = session.info.pop('defect_rollup_before', {})
+    ids = [defect.id for defect in session.new if isinstance(defect, DefectModel)] + [
+        id_ for id_ in before if id_ not in {defect.id for defect in session.deleted}]
+    after = DefectModel.get_rollup_rows(ids, session=session)
+    DefectRollupModel.apply_changes(session, ((before.get(id_), after.get(id_)) for id_ in set(before) | set(after)))
+
+
+stamp_modified_time(DefectModel.__table__)
+
+
 if __name__ == '__main':
     pass
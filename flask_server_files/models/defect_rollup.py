@@ -0,0 +1,187 @@
+"""A rollup of the defects by day, laminator, shift and defect type, kept up to date as the defects change.
+
+Dashboards read the counts and meters from here instead of aggregating laminator_foam_defect_removal_records. Every
+change to a defect is applied as a delta (its old contribution out, its new one in) by an upsert in the same
+transaction as the change, see DefectModel. rebuild regenerates the whole table from the defects.
+"""
+import datetime
+
+import sqlalchemy
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from dev_common import exception_one_line
+from flask_server_files.sqla_instance import Base
+from log_and_alert.log_setup import lg
+
+# the defect columns a rollup row is made from
+rollup_source_columns = ('defect_start_ts', 'lam_num', 'shift_number', 'defect_type', 'length_of_defect_meters',
+                         'operator_saved_time')
+
+
+class DefectRollupModel(Base):
+    """A SQLalchemy model for the defect rollup table. Null keys are stored as 0 or an empty string."""
+    __tablename__ = 'laminator_foam_defect_rollups'
+
+    day = sqlalchemy.Column(sqlalchemy.Date, primary_key=True)  # the date of defect_start_ts
+    lam_num = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    shift_number = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    defect_type = sqlalchemy.Column(sqlalchemy.VARCHAR(13), primary_key=True)
+
+    defect_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    total_meters = sqlalchemy.Column(sqlalchemy.Float, nullable=False, default=0.0)
+    confirmed_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+    key_columns = ('day', 'lam_num', 'shift_number', 'defect_type')
+    value_columns = ('defect_count', 'total_meters', 'confirmed_count')
+
+    @staticmethod
+    def contribution(defect):
+        """Get what a defect adds to the rollup.
+
+        :param defect: mapping, of the rollup_source_columns of a defect, ex: a sqlalchemy Row's _mapping.
+        :return: tuple, (key tuple, (count, meters, confirmed count)), or None for a defect without a start time.
+        """
+        if defect['defect_start_ts'] is None:
+            return None
+        key = (defect['defect_start_ts'].date(), defect['lam_num'] or 0, defect['shift_number'] or 0,
+               defect['defect_type'] or '')
+        return key, (1, defect['length_of_defect_meters'] or 0.0, int(defect['operator_saved_time'] is not None))
+
+    @classmethod
+    def apply_changes(cls, session, changes):
+        """Apply changed defects to the rollup, in the session's transaction.
+
+        :param session: sqlalchemy.orm.Session, the session the defects were changed in.
+        :param changes: iterable, of tuples of (old, new) defect mappings (see contribution), old is None for a new
+        defect and new is None for a removed one.
+        """
+        deltas = {}
+        for old, new in changes:
+            for defect, sign in ((old, -1), (new, 1)):
+                contribution = cls.contribution(defect) if defect is not None else None
+                if contribution is not None:
+                    key, values = contribution
+                    delta = deltas.setdefault(key, [0, 0.0, 0])
+                    for index, value in enumerate(values):
+                        delta[index] += sign * value
+        cls.upsert(session, {key: delta for key, delta in deltas.items() if any(delta)})
+
+    @classmethod
+    def upsert(cls, session, deltas):
+        """Add to the rollup rows, creating those that don't exist yet.
+
+        :param session: sqlalchemy.orm.Session
+        :param deltas: dict, of {key tuple: (count, meters, confirmed count) to add}
+        """
+        if not deltas:
+            return
+        dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}[session.get_bind().dialect.name]
+        insert = dialect_insert(cls.__table__)
+        query = insert.on_conflict_do_update(
+            index_elements=cls.key_columns,
+            set_={column: cls.__table__.c[column] + insert.excluded[column] for column in cls.value_columns})
+        session.execute(query, [dict(zip(cls.key_columns + cls.value_columns, key + tuple(delta)))
+                                for key, delta in deltas.items()])
+
+    @classmethod
+    def rebuild(cls, batch_size=10_000):
+        """Regenerate the rollup from the defects, aggregating batch_size defects (by id) at a time, in one transaction.
+
+        :param batch_size: int, the number of defects aggregated per query.
+        :return: int, the number of rollup rows.
+        """
+        from flask_server_files.models.defect import DefectModel
+
+        session = cls.session
+        defects = DefectModel.__table__.c
+        key_expressions = (func.date(defects.defect_start_ts, type_=sqlalchemy.Date), func.coalesce(defects.lam_num, 0),
+                           func.coalesce(defects.shift_number, 0), func.coalesce(defects.defect_type, ''))
+        try:
+            if session.get_bind().dialect.name == 'postgresql':
+                # changes to defects wait to apply their deltas until this is done, instead of being counted twice
+                session.execute(sqlalchemy.text(f'LOCK TABLE {cls.__tablename__} IN EXCLUSIVE MODE'))
+            session.execute(sqlalchemy.delete(cls.__table__))
+            last_id = 0
+            while True:
+                batch = sqlalchemy.select(defects.id).where(defects.id > last_id).order_by(defects.id).limit(
+                    batch_size).subquery()
+                batch_end = session.execute(sqlalchemy.select(func.max(batch.c.id))).scalar()
+                if batch_end is None:
+                    break
+                query = sqlalchemy.select(
+                    *key_expressions, func.count(),
+                    func.coalesce(func.sum(defects.length_of_defect_meters), 0.0),
+                    func.sum(sqlalchemy.case((defects.operator_saved_time.is_not(None), 1), else_=0))).where(
+                    defects.id > last_id, defects.id <= batch_end, defects.defect_start_ts.is_not(None)).group_by(
+                    *key_expressions)
+                cls.upsert(session, {tuple(row[:4]): tuple(row[4:]) for row in session.execute(query)})
+                last_id = batch_end
+            row_count = session.execute(sqlalchemy.select(func.count()).select_from(cls.__table__)).scalar()
+            session.commit()
+        except Exception as exc:
+            lg.error(exception_one_line(exception_obj=exc))
+            session.rollback()
+            raise
+        lg.info('Defect rollup rebuilt with %s rows.', row_count)
+        return row_count
+
+    # the columns and time buckets the rollup can be summarized by
+    summary_group_columns = ('lam_num', 'shift_number', 'defect_type')
+    summary_buckets = ('day', 'week')
+
+    @classmethod
+    def summary_groups(cls, group_by=(), bucket=None):
+        """Get the expressions to group a summary of the rollup by.
+
+        :param group_by: iterable, of column names from summary_group_columns.
+        :param bucket: str, optional, one of summary_buckets.
+        :return: list, of sqlalchemy expressions, the time bucket (labeled period) first.
+        :raises ValueError: for a column or bucket that can't be used.
+        """
+        table = cls.__table__
+        groups = []
+        if bucket == 'day':
+            groups.append(table.c.day.label('period'))
+        elif bucket == 'week':
+            groups.append(func.date_trunc(sqlalchemy.literal_column("'week'"), table.c.day).label('period'))
+        elif bucket is not None:
+            raise ValueError(f'Unknown time bucket {bucket} for the rollup, use one of: '
+                             f'{", ".join(cls.summary_buckets)}.')
+        for column_name in group_by:
+            if column_name not in cls.summary_group_columns:
+                raise ValueError(f'Cannot group the rollup by {column_name}, use any of: '
+                                 f'{", ".join(cls.summary_group_columns)}.')
+            groups.append(table.c[column_name])
+        return groups
+
+    @classmethod
+    def summarize(cls, group_by=(), bucket=None, start_date=None, end_date=None, lam_num=None):
+        """Get the count, meters and confirmed count of the defects from the rollup, grouped by its columns and/or a
+        time bucket. Dates are compared by day.
+
+        :param group_by: iterable, of column names from summary_group_columns.
+        :param bucket: str, optional, one of summary_buckets.
+        :param start_date: str, optional, ISO formatted string, only days on or after this date.
+        :param end_date: str, optional, ISO formatted string, only days on or before this date.
+        :param lam_num: int, optional, only this laminator.
+        :return: list, of sqlalchemy Rows of (period if bucket, the group_by columns, defect_count, total_meters,
+        confirmed_count), in that order.
+        :raises ValueError: for a column or bucket that can't be used.
+        """
+        table = cls.__table__
+        groups = cls.summary_groups(group_by, bucket)
+        where = []
+        if start_date:
+            where.append(table.c.day >= datetime.datetime.fromisoformat(start_date).date())
+        if end_date:
+            where.append(table.c.day <= datetime.datetime.fromisoformat(end_date).date())
+        if lam_num is not None:
+            where.append(table.c.lam_num == lam_num)
+        query = sqlalchemy.select(*groups, *(func.sum(table.c[column]).label(column) for column in cls.value_columns))
+        query = query.where(*where).group_by(*groups).order_by(*groups)
+        return cls.session.execute(query).all()
+
+
+if __name__ == '__main__':
+    DefectRollupModel.rebuild()
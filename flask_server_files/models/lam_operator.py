@@ -2,7 +2,7 @@ import sqlalchemy as fsa
 from sqlalchemy import func
 from typing_extensions import Self
 
-from flask_server_files.helpers import jsonize_sqla_model
+from flask_server_files.helpers import jsonize_sqla_model, stamp_modified_time
 from flask_server_files.models.model_wrapper import ModelWrapper
 from flask_server_files.sqla_instance import Base
 from log_and_alert.log_setup import lg
@@ -20,6 +20,7 @@ class OperatorModel(Base):
     lam_2_certified = fsa.Column(fsa.Boolean, server_default='''False''')
     date_added = fsa.Column(fsa.TIMESTAMP(timezone=True), server_default=fsa.func.now())
     date_removed = fsa.Column(fsa.TIMESTAMP(timezone=True))
+    entry_modified_ts = fsa.Column(fsa.TIMESTAMP(timezone=True), server_default=fsa.func.now(), onupdate=fsa.func.now())
 
     flask_sqlalchemy_instance = fsa
 
@@ -48,18 +49,59 @@ class OperatorModel(Base):
         return new_op
 
     @classmethod
-    def get_active_operators(cls, lam_number=None):
-        """Get a list of         """
+    def active_operators_filter(cls, lam_number=None):
+        """Get the filter for the active operators, optionally those certified for a laminator.
+
+        :param lam_number: int, optional, the laminator number.
+        :return: tuple, of sqlalchemy expressions for filter/where.
+        """
 
         if lam_number is None:
-            # return cls.query.filter(OperatorModel.date_removed == None).all()
-            return cls.query.all()
+            # return (OperatorModel.date_removed == None, )
+            return ()
         else:
             certified_lam_dict = {1: OperatorModel.lam_1_certified, 2: OperatorModel.lam_2_certified}
             certified_lam_dict[0] = certified_lam_dict[1]  # for development
             lam_column_dict = certified_lam_dict[lam_number]
-            # return cls.query.filter(OperatorModel.date_removed == None).filter(lam_column_dict).all()
-            return cls.query.filter(lam_column_dict).all()
+            # return OperatorModel.date_removed == None, lam_column_dict
+            return (lam_column_dict, )
+
+    @classmethod
+    def get_active_operators(cls, lam_number=None, session=None):
+        """Get a list of the active operators as OperatorModels, optionally those certified for a laminator.
+
+        :param lam_number: int, optional, the laminator number.
+        :param session: sqlalchemy.orm.Session, optional, ex: a snapshot_session. Default=None, cls.session.
+        :return: list
+        """
+
+        query = cls.query if session is None else session.query(cls)
+        return query.filter(*cls.active_operators_filter(lam_number)).all()
+
+    @classmethod
+    def get_active_operator_rows(cls, columns, lam_number=None):
+        """Get a list of the active operators as Core rows (named tuples) of the columns.
+
+        :param columns: iterable, of the columns to select.
+        :param lam_number: int, optional, the laminator number.
+        :return: list
+        """
+
+        query = fsa.select(*columns).where(*cls.active_operators_filter(lam_number))
+        return cls.session.execute(query).all()
+
+    @classmethod
+    def get_validator(cls, lam_number=None):
+        """Get a summary of the active operators that changes when they are added, removed or any column is edited,
+        through this server or not, their count and latest entry_modified_ts (see helpers.modified_time_ddl).
+
+        :param lam_number: int, optional, the laminator number.
+        :return: tuple, (int count, datetime.datetime latest entry_modified_ts or None)
+        """
+
+        query = fsa.select(func.count(), func.max(cls.entry_modified_ts)).where(
+            *cls.active_operators_filter(lam_number))
+        return tuple(cls.session.execute(query).one())
 
     @classmethod
     def find_by_id(cls, id_, get_sqalchemy=False, wrap_model=True) -> Self:
@@ -108,6 +150,8 @@ class OperatorModel(Base):
         return False
 
 
+stamp_modified_time(OperatorModel.__table__)
+
 
 if __name__ == '__main__':
     # OperatorModel.new_operator(first_name='John', last_name='Doe')
@@ -0,0 +1,76 @@
+"""Correlated request/response between the flask server and the popup.
+
+A flask request that needs an answer from the popup registers a request, sends its request_id along with the action,
+and blocks on the future with a timeout. The popup completes the request by its id, so several requests can be waiting
+at once without taking each other's replies.
+"""
+import itertools
+import threading
+from concurrent import futures
+
+
+class PopupRequests:
+    """Keeps track of the requests sent to the popup that are waiting on a response."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending = {}
+
+    def new_request(self):
+        """Register a new request.
+
+        :return: tuple, (int, concurrent.futures.Future), the request id to send with the action and the future that
+        will receive the popup's response.
+        """
+        future = futures.Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        return request_id, future
+
+    def complete(self, request_id, response):
+        """Complete the request with the response from the popup.
+
+        :param request_id: int, the id that was sent with the request.
+        :param response: any, the response to hand back to the waiting request.
+        :return: bool, False if the request is unknown or was already completed or abandoned.
+        """
+        with self._lock:
+            future = self._pending.pop(request_id, None)
+        if future is None or future.done():
+            return False
+        future.set_result(response)
+        return True
+
+    def abandon(self, request_id):
+        """Stop waiting on a request, a late response for it will be discarded.
+
+        :param request_id: int, the id that was sent with the request.
+        """
+        with self._lock:
+            future = self._pending.pop(request_id, None)
+        if future is not None:
+            future.cancel()
+
+    def wait_for(self, request_id, future, timeout):
+        """Block until the popup responds or the timeout passes, without using CPU while waiting.
+
+        :param request_id: int, the id that was sent with the request.
+        :param future: concurrent.futures.Future, from new_request.
+        :param timeout: float, seconds to wait.
+        :return: any, the response.
+        :raises TimeoutError: if the popup does not respond in time.
+        """
+        try:
+            return future.result(timeout=timeout)
+        except futures.TimeoutError:
+            self.abandon(request_id)
+            raise TimeoutError(f'No response to popup request {request_id} within {timeout} seconds.')
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+
+popup_requests = PopupRequests()
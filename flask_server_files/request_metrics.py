@@ -0,0 +1,170 @@
+"""Request counts, error counts and latency histograms per route, for /metrics (Prometheus text format) and /controls.
+
+RequestMetrics hooks into a flask app's requests. It also counts the requests in flight: waitress gives each request one
+of its server_threads until the response has been sent, so that is the number of threads in use, and a burst that
+saturates the pool shows as the peak reaching the thread count.
+"""
+import bisect
+import threading
+import time
+
+import flask
+
+
+def _label_value(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+class RequestMetrics:
+    """Collects the metrics of a flask app's requests, keyed by the route's rule (ex: /defect) and method."""
+
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds, bucket upper bounds
+    unmatched_route = '<unmatched>'  # for requests without a route (404s), instead of one label per path
+
+    def __init__(self, app=None, threads=None):
+        """
+        :param app: flask.Flask, optional, the app to collect the metrics of, or use init_app.
+        :param threads: int, optional, the number of server threads, for comparison with those in use.
+        """
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._routes = {}  # {(route, method): {'statuses': {code: count}, 'errors', 'buckets', 'seconds'}}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._collectors = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Start collecting the metrics of an app's requests.
+
+        :param app: flask.Flask
+        """
+        app.before_request(self._start)
+        app.after_request(self._keep_status)
+        app.teardown_request(self._finish)
+        app.extensions['request_metrics'] = self
+
+    def add_collector(self, collector):
+        """Add more metrics to render, ex: the database connection pool's.
+
+        :param collector: function, without parameters, returning a list of (name, type, help, value) tuples.
+        """
+        self._collectors.append(collector)
+
+    def _start(self):
+        flask.g.metrics_start = time.perf_counter()
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    @staticmethod
+    def _keep_status(response):
+        flask.g.metrics_status = response.status_code
+        return response
+
+    def _finish(self, exc):
+        """Record a request once its response is done, streamed responses included."""
+        start = flask.g.pop('metrics_start', None)
+        if start is None:
+            return
+        # GeneratorExit is a streamed response closed early (ex: the client went away), not a server error
+        status = 500 if exc is not None and not isinstance(exc, GeneratorExit) else flask.g.pop('metrics_status', 500)
+        url_rule = flask.request.url_rule
+        self.record(url_rule.rule if url_rule is not None else self.unmatched_route, flask.request.method, status,
+                    time.perf_counter() - start)
+        with self._lock:
+            self.in_flight -= 1
+
+    def record(self, route, method, status, seconds):
+        """Record a finished request.
+
+        :param route: str, the route's rule.
+        :param method: str, the request method.
+        :param status: int, the response status code, 500 for an unhandled exception.
+        :param seconds: float, the time taken.
+        """
+        with self._lock:
+            stats = self._routes.get((route, method))
+            if stats is None:
+                stats = self._routes[route, method] = {'statuses': {}, 'errors': 0, 'seconds': 0.0,
+                                                       'buckets': [0] * (len(self.latency_buckets) + 1)}
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            stats['errors'] += status >= 500
+            stats['seconds'] += seconds
+            stats['buckets'][bisect.bisect_left(self.latency_buckets, seconds)] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            routes = {key: {'statuses': dict(stats['statuses']), 'errors': stats['errors'],
+                            'seconds': stats['seconds'], 'buckets': list(stats['buckets'])}
+                      for key, stats in sorted(self._routes.items())}
+            return routes, self.in_flight, self.peak_in_flight
+
+    def render(self):
+        """Get the metrics in the Prometheus text exposition format.
+
+        :return: str
+        """
+        routes, in_flight, peak_in_flight = self._snapshot()
+        lines = ['# HELP http_requests_total Requests handled, by route, method and status code.',
+                 '# TYPE http_requests_total counter']
+        for (route, method), stats in routes.items():
+            for status, count in sorted(stats['statuses'].items()):
+                lines.append(f'http_requests_total{_labels(route=route, method=method, status=status)} {count}')
+
+        lines += ['# HELP http_request_errors_total Requests that failed with a 5xx status or an unhandled exception.',
+                  '# TYPE http_request_errors_total counter']
+        for (route, method), stats in routes.items():
+            lines.append(f'http_request_errors_total{_labels(route=route, method=method)} {stats["errors"]}')
+
+        lines += ['# HELP http_request_duration_seconds Time from the start of a request to the end of its response.',
+                  '# TYPE http_request_duration_seconds histogram']
+        for (route, method), stats in routes.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.latency_buckets + ('+Inf',), stats['buckets']):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket'
+                             f'{_labels(route=route, method=method, le=upper_bound)} {cumulative}')
+            lines.append(f'http_request_duration_seconds_sum{_labels(route=route, method=method)} {stats["seconds"]}')
+            lines.append(f'http_request_duration_seconds_count{_labels(route=route, method=method)} {cumulative}')
+
+        lines += ['# HELP server_threads_in_use Requests in flight, each holds a waitress thread.',
+                  '# TYPE server_threads_in_use gauge',
+                  f'server_threads_in_use {in_flight}',
+                  '# HELP server_threads_peak_in_use The most requests in flight at once since the server started.',
+                  '# TYPE server_threads_peak_in_use gauge',
+                  f'server_threads_peak_in_use {peak_in_flight}']
+        if self.threads is not None:
+            lines += ['# HELP server_threads The number of waitress threads.', '# TYPE server_threads gauge',
+                      f'server_threads {self.threads}']
+        for collector in self._collectors:
+            for name, metric_type, help_text, value in collector():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Get a summary of the metrics for people, ex: for the /controls page.
+
+        :return: dict, {'threads', 'in_flight', 'peak_in_flight', 'routes': list of dicts of route, method, count,
+        errors, mean_ms and p95_ms (the upper bound of the histogram bucket, None if over the largest)}
+        """
+        routes, in_flight, peak_in_flight = self._snapshot()
+        route_summaries = []
+        for (route, method), stats in routes.items():
+            count = sum(stats['buckets'])
+            cumulative = 0
+            for index, bucket_count in enumerate(stats['buckets']):
+                cumulative += bucket_count
+                if cumulative >= 0.95 * count:
+                    break
+            p95 = self.latency_buckets[index] * 1000 if index < len(self.latency_buckets) else None
+            route_summaries.append({'route': route, 'method': method, 'count': count, 'errors': stats['errors'],
+                                    'mean_ms': round(stats['seconds'] / count * 1000, 1), 'p95_ms': p95})
+        return {'threads': self.threads, 'in_flight': in_flight, 'peak_in_flight': peak_in_flight,
+                'routes': route_summaries}
@@ -1,9 +1,14 @@
 """The resource for working on the database table. FOR DEVELOPMENT."""
 import datetime
 
+import sqlalchemy
 from flask_restful import reqparse, Resource
 
-from flask_server_files.sqla_instance import fsa
+from flask_server_files.helpers import modified_time_ddl
+from flask_server_files.models.defect import DefectModel
+from flask_server_files.models.defect_rollup import DefectRollupModel
+from flask_server_files.models.lam_operator import OperatorModel
+from flask_server_files.sqla_instance import engine, fsa
 from log_and_alert.log_setup import lg
 
 
@@ -24,6 +29,59 @@ def create_tables():
     lg.debug('Database tables have been created.')
 
 
+def add_unconfirmed_defects_index(bind):
+    """Add the partial index that serves DefectModel.find_new to an existing defects table."""
+    DefectModel.unconfirmed_index.create(bind, checkfirst=True)
+
+
+def add_defect_modified_index(bind):
+    """Add the index that serves DefectModel.find_new_since to an existing defects table."""
+    DefectModel.modified_index.create(bind, checkfirst=True)
+
+
+def add_modified_time_triggers(bind):
+    """Stamp entry_modified_ts in commit order on PostgreSQL (see helpers.modified_time_ddl), adding the column to the
+    operators first."""
+    with bind.begin() as cnn:
+        operator_table = OperatorModel.__tablename__
+        operator_columns = {column['name'] for column in sqlalchemy.inspect(cnn).get_columns(operator_table)}
+        if 'entry_modified_ts' not in operator_columns:
+            cnn.execute(sqlalchemy.text(f'ALTER TABLE {operator_table} ADD COLUMN entry_modified_ts '
+                                        f'TIMESTAMP WITH TIME ZONE'))
+        if cnn.dialect.name != 'postgresql':
+            return
+        existing = set(cnn.execute(sqlalchemy.text('SELECT tgname FROM pg_trigger')).scalars())
+        for table in (DefectModel.__table__, OperatorModel.__table__):
+            function, triggers = modified_time_ddl(table)
+            cnn.execute(function)
+            for name, ddl in triggers.items():
+                if name not in existing:  # created once, instead of locking the table to replace it on every start
+                    cnn.execute(ddl)
+
+
+def add_defect_rollup_table(bind):
+    """Add the defect rollup table, filled from the existing defects."""
+    if not sqlalchemy.inspect(bind).has_table(DefectRollupModel.__tablename__):
+        DefectRollupModel.__table__.create(bind)
+        DefectRollupModel.rebuild()
+
+
+# create_all only creates missing tables, these bring existing tables up to the models. Each must be safe to rerun.
+migration_steps = (add_unconfirmed_defects_index, add_defect_rollup_table, add_defect_modified_index,
+                   add_modified_time_triggers)
+
+
+def apply_migrations(bind=engine):
+    """Apply each migration step to the database, in order.
+
+    :param bind: sqlalchemy.engine.Engine, the database to migrate.
+    """
+    for step in migration_steps:
+        lg.debug('Applying migration step: %s', step.__name__)
+        step(bind)
+    lg.debug('Database migrations have been applied.')
+
+
 class Database(Resource):
     defect_parser = reqparse.RequestParser()
     defect_parser.add_argument('action', type=str, required=True, help='This argument is not optional.')
@@ -36,6 +94,14 @@ class Database(Resource):
                 create_tables()
 
                 return {'database reset': f'successful at {datetime.datetime.now().isoformat()}'}, 200
+            elif action == 'migrate':
+                apply_migrations()
+
+                return {'database migrated': f'successful at {datetime.datetime.now().isoformat()}'}, 200
+            elif action == 'rebuild_rollup':
+                row_count = DefectRollupModel.rebuild()
+
+                return {'defect rollup rebuilt': f'{row_count} rows at {datetime.datetime.now().isoformat()}'}, 200
             # elif action == 'create_operators_table':
             #     OperatorModel.__table__.create(checkfirst=True)
             #     return {'operator table creation': f'successful at {datetime.datetime.now().isoformat()}'}, 200
@@ -1,9 +1,78 @@
+import datetime
+import json
+import math
+
+import flask
+import sqlalchemy
 from flask_restful import reqparse, Resource
 
+from flask_server_files.conditional_get import ConditionalResponses
 from flask_server_files.defect_args import all_args, arg_type_dict
-from flask_server_files.helpers import jsonize_sqla_model, remove_empty_parameters
+from flask_server_files.export_formats import export_formats
+from flask_server_files.helpers import model_serializer, remove_empty_parameters
 from flask_server_files.models.defect import DefectModel
+from flask_server_files.models.defect_rollup import DefectRollupModel
 from log_and_alert.log_setup import lg
+from scada_outbound_connections.meter_count_lengths import lengths_from_history
+from scada_outbound_connections.scada_tag_query import TagHistoryConnector, to_t_stamp
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    raise ValueError(f'{value!r} is not a bool')
+
+
+def _to_number(number_type):
+    def convert(value):
+        if isinstance(value, bool):  # bool is an int, but not a number here
+            raise ValueError(f'{value!r} is not a {number_type.__name__}')
+        return number_type(value)
+    return convert
+
+
+# how each column's value in a bulk record is checked and converted, following arg_type_dict
+timestamp_args = tuple(column.name for column in DefectModel.__table__.columns
+                       if isinstance(column.type, sqlalchemy.DateTime))
+bulk_converters = {arg: {bool: _to_bool, int: _to_number(int), float: _to_number(float)}.get(arg_type, arg_type)
+                   for arg, arg_type in arg_type_dict.items() if arg in DefectModel.__table__.columns and arg != 'id'}
+bulk_converters.update({arg: datetime.datetime.fromisoformat for arg in timestamp_args})
+
+
+def convert_defect_values(record):
+    """Check and convert the column values of a defect record, values that are None are left out.
+
+    :param record: dict, of {column name: value}, as sent to the server.
+    :return: tuple, (dict of the converted values, list of str errors)
+    """
+    values = {}
+    errors = []
+    for arg, value in record.items():
+        converter = bulk_converters.get(arg)
+        if converter is None:
+            errors.append(f'{arg} is not a column that can be set.')
+        elif value is not None:
+            try:
+                values[arg] = converter(value)
+            except (TypeError, ValueError) as err:
+                errors.append(f'{arg}: {err}')
+    return values, errors
+
+
+def validate_defect_record(record):
+    """Check and convert a defect record for a bulk insert.
+
+    :param record: dict, of {column name: value}, as sent to /defects/bulk.
+    :return: tuple, (dict of the converted values or None, list of str errors)
+    """
+    if not isinstance(record, dict):
+        return None, ['A record must be an object of column names and values.']
+    values, errors = convert_defect_values(record)
+    if not values.get('source_lot_number'):
+        errors.append('source_lot_number is required.')
+    return (None if errors else values), errors
 
 
 class Defect(Resource):
@@ -36,33 +105,47 @@ class Defect(Resource):
 
         return defect.jsonizable(), 201
 
-    # TODO: once there is an option to edit defects, this may need to be touched up
     def put(self):
-        data = self.defect_parser.parse_args()
-        # check if there is an id, if there is, try to get the defect record
-        id_ = data.get('id')
-        if id_:
-            defect = DefectModel
-            if defect:
-                lg.debug('defect exists, updating')
-                # don't pass the Model empty parameters
-                data = remove_empty_parameters(data)
-                lg.debug('put dict %s', data)
-                # update the existing
-                for key, arg in data.items():
-                    lg.debug('updating %s from %s to %s', key, getattr(defect, key), arg)
-                    setattr(defect, key, arg)
-                defect.save_to_database()
-                return_code = 200
-        else:
-            lg.debug('creating new defect')
-            # create a new record
-            defect = DefectModel(**data)
-            return_code = 201
+        data = remove_empty_parameters(self.defect_parser.parse_args())
+        # with an id, update that defect record
+        if data.get('id'):
+            return self.patch()
 
+        lg.debug('creating new defect')
+        # create a new record
+        defect = DefectModel(**data)
         defect.save_to_database()
 
-        return defect.jsonizable(), return_code
+        return defect.jsonizable(), 201
+
+    def patch(self):
+        """Update the columns sent for the defect with the id sent, with a single UPDATE statement.
+
+        The values can be sent as JSON or as parameters. If a mahlo length is sent without length_of_defect_meters, the
+        length is worked out from the mahlo lengths by the database.
+        """
+        data = flask.request.get_json(silent=True) or flask.request.values.to_dict()
+        try:
+            id_ = int(data.pop('id'))
+        except (KeyError, TypeError, ValueError):
+            return {'defect_instance': f'An id is required! (?id=###)'}, 400
+        values, errors = convert_defect_values(data)
+        if errors:
+            return {'errors': errors}, 400
+        if not values:
+            return {'defect_instance': 'No columns to update.'}, 400
+
+        lg.debug('patching defect %s with %s', id_, values)
+        with DefectModel.session() as session:
+            try:
+                row = DefectModel.patch(id_, values)
+            except Exception as exc:
+                return {'exception': str(exc)}, 500
+            finally:
+                DefectModel.session.remove()
+        if row is None:
+            return {'defect_instance': f'Defect not found with id: {id_}'}, 404
+        return model_serializer(DefectModel).row_dict(row), 200
 
 
 class DefectList(Resource):
@@ -71,30 +154,245 @@ class DefectList(Resource):
     parser.add_argument('start_date', type=str, required=False, help='Defects with start dates after this. (optional)')
     parser.add_argument('end_date', type=str, required=False, help='Defects with end dates before this. (optional)')
     parser.add_argument('lam_num', type=str, required=False, help='Defects from this laminator number only. (optional)')
+    parser.add_argument('limit', type=int, required=False, help='At most this many defects. (optional)')
+    parser.add_argument('after_id', type=int, required=False,
+                        help='Defects after this id, the next_after_id of the previous page. (optional)')
+    page_size = 1000  # defects queried and streamed at a time
+    responses = ConditionalResponses()
 
     def get(self):
+        """Get the defects, newest first, streamed as they are queried.
+
+        With a limit this is one page, use its next_after_id as the after_id for the next page. next_after_id is null
+        when there are no more pages. The response has an ETag, a request with it in If-None-Match gets a 304 if the
+        defects haven't changed.
+        """
         pargs = self.parser.parse_args()
         start_date = pargs.get('start_date')
         end_date = pargs.get('end_date')
         lam_num = pargs.get('lam_num')
         lam_num = int(lam_num) if lam_num is not None else None
-        lg.info('Request for defects data received. Start: %s End: %s', start_date, end_date)
+        limit = pargs.get('limit')
+        after_id = pargs.get('after_id')
+        lg.info('Request for defects data received. Start: %s End: %s Limit: %s After: %s',
+                start_date, end_date, limit, after_id)
+
         with DefectModel.session() as session:
-            if start_date and end_date:
-                results = DefectModel.get_defects_between_dates(start_date, end_date, lam_num)
-            else:
-                results = DefectModel.query.order_by(
-                    DefectModel.id.desc()).all()
-            result_dict = {}
-            for row in results:
-                result_dict[row.id] = jsonize_sqla_model(row)
+            validator = DefectModel.get_validator(start_date, end_date, lam_num)
             DefectModel.session.remove()
-        lg.debug('Returning %s defects data results response.', len(result_dict.keys()))
-        return {'results_dict': result_dict, 'default_column_order': DefectModel.__table__.columns.keys()}, 200
+        last_modified = validator[1]
+        etag = self.responses.etag(start_date, end_date, lam_num, limit, after_id, validator)
+        serializer = model_serializer(DefectModel)
+
+        def generate_json():
+            yield f'{{"default_column_order": {json.dumps(serializer.columns)}, "results_dict": {{'
+            count = 0
+            last_id = None
+            with DefectModel.session() as session:
+                for page in DefectModel.iter_pages(serializer.select_columns, page_size=self.page_size,
+                                                   after_id=after_id, limit=limit,
+                                                   start_date=start_date, end_date=end_date, lam_num=lam_num):
+                    chunk = ', '.join(f'"{row.id}": {serializer.to_json(row)}' for row in page)
+                    yield f', {chunk}' if count else chunk
+                    count += len(page)
+                    last_id = page[-1].id
+                DefectModel.session.remove()
+            next_after_id = last_id if limit and count == limit else None
+            lg.debug('Returned %s defects data results response.', count)
+            yield f'}}, "next_after_id": {json.dumps(next_after_id)}}}'
+
+        return self.responses.respond(etag, generate_json, last_modified=last_modified)
 
     def put(self):
         data = self.parser.parse_args()
+        confirmed_count = 0
         if data.get('confirm_all'):
-            DefectModel.mark_all_confirmed()
+            lam_num = data.get('lam_num')
+            with DefectModel.session() as session:
+                confirmed_count = DefectModel.mark_all_confirmed(int(lam_num) if lam_num is not None else None)
+                DefectModel.session.remove()
+
+        return {'completed': True, 'confirmed': confirmed_count}, 201
+
+
+class DefectLengths(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('start_date', type=str, required=True, help='Defects with start dates after this.')
+    parser.add_argument('end_date', type=str, required=True, help='Defects with start dates before this.')
+    parser.add_argument('lam_num', type=int, required=False,
+                        help='Defects from this laminator number only. (optional, default both)')
+
+    def post(self):
+        """Recompute the lengths of the defects between the dates from the Mahlo meter count history.
+
+        The lengths account for the meter counter resetting at roll change. Changed lengths are written back in bulk.
+        Defects without an end timestamp have no length yet and are skipped.
+        """
+        pargs = self.parser.parse_args()
+        lam_nums = (pargs['lam_num'],) if pargs['lam_num'] is not None else (1, 2)
+        response = {}
+        for lam_num in lam_nums:
+            with DefectModel.session() as session:
+                windows = DefectModel.get_defect_windows(pargs['start_date'], pargs['end_date'], lam_num)
+                DefectModel.session.remove()
+            skipped_count = sum(window.defect_end_ts is None for window in windows)
+            windows = [window for window in windows if window.defect_end_ts is not None]
+            starts = [to_t_stamp(window.defect_start_ts) for window in windows]
+            ends = [to_t_stamp(window.defect_end_ts) for window in windows]
+            lengths = lengths_from_history(TagHistoryConnector.shared(f'lam{lam_num}'), starts, ends)
+
+            changed = {window.id: float(length) for window, length in zip(windows, lengths)
+                       if not math.isnan(length) and length != window.length_of_defect_meters}
+            with DefectModel.session() as session:
+                updated_count = DefectModel.bulk_update_lengths(changed)
+                DefectModel.session.remove()
+            lg.info('Recomputed %s lam%s defect lengths, %s changed, %s without an end skipped.', len(windows), lam_num,
+                    updated_count, skipped_count)
+            response[lam_num] = {'checked': len(windows), 'skipped': skipped_count, 'updated': updated_count,
+                                 'updated_lengths': changed}
+        return response, 200
+
+
+class DefectBulk(Resource):
+    max_records = 10_000
+
+    def post(self):
+        """Insert many defects at once, sent as a JSON array of records or as NDJSON (one record per line).
+
+        Every record is validated, the valid ones are inserted in a single transaction. The response has a status for
+        each record, in order: created with its new id, or invalid with the errors.
+        """
+        records = []
+        statuses = []
+        for index, (record, parse_error) in enumerate(self.read_records()):
+            if index >= self.max_records:
+                return {'error': f'At most {self.max_records} records can be sent at once.'}, 413
+            values, errors = validate_defect_record(record) if parse_error is None else (None, [parse_error])
+            if errors:
+                statuses.append({'index': index, 'status': 'invalid', 'errors': errors})
+            else:
+                records.append(values)
+                statuses.append({'index': index, 'status': 'created'})
+        if not statuses:
+            return {'error': 'No records received.'}, 400
+
+        if records:
+            with DefectModel.session() as session:
+                try:
+                    new_ids = iter(DefectModel.bulk_insert(records))
+                except Exception as exc:
+                    return {'exception': str(exc)}, 500
+                finally:
+                    DefectModel.session.remove()
+            for status in statuses:
+                if status['status'] == 'created':
+                    status['id'] = next(new_ids)
+
+        lg.info('Bulk defects received: %s, created: %s.', len(statuses), len(records))
+        return {'created': len(records), 'invalid': len(statuses) - len(records), 'results': statuses}, \
+            (201 if records else 400)
+
+    @staticmethod
+    def read_records():
+        """Read the records from the request body, a JSON array or NDJSON.
+
+        :return: generator, of tuples of (record, None) or (None, str error) for a line that isn't JSON.
+        """
+        if flask.request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            for line_number, line in enumerate(flask.request.stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line), None
+                except ValueError as err:
+                    yield None, f'Line {line_number} is not JSON: {err}'
+        else:
+            body = flask.request.get_json(silent=True)
+            if not isinstance(body, list):
+                body = [] if body is None else [body]
+            for record in body:
+                yield record, None
+
+
+class DefectExport(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('format', type=str, default='csv', location='args',
+                        help=f'One of: {", ".join(export_formats)}. (optional, default csv)')
+    parser.add_argument('start_date', type=str, location='args', help='Defects with start dates after this. (optional)')
+    parser.add_argument('end_date', type=str, location='args', help='Defects with start dates before this. (optional)')
+    parser.add_argument('lam_num', type=int, location='args', help='Defects from this laminator number only. (optional)')
+    chunk_size = 5000  # defects read from the database and written at a time
+
+    def get(self):
+        """Get the defects as a csv, parquet or arrow (IPC stream) file, written as they are read from the database."""
+        pargs = self.parser.parse_args()
+        export_format = pargs['format'].lower()
+        if export_format not in export_formats:
+            return {'error': f'Unknown format {export_format}, use one of: {", ".join(export_formats)}.'}, 400
+        write_chunks, mimetype, extension, needs_pyarrow = export_formats[export_format]
+        if needs_pyarrow:
+            try:
+                import pyarrow
+            except ImportError:
+                return {'error': f'pyarrow is not installed on the server, {export_format} exports are unavailable.'}, 501
+        lg.info('Defects export requested: %s', pargs)
+        serializer = model_serializer(DefectModel)
+
+        def generate_file():
+            with DefectModel.session() as session:
+                row_chunks = DefectModel.iter_chunks(serializer.select_columns, chunk_size=self.chunk_size,
+                                                     start_date=pargs['start_date'], end_date=pargs['end_date'],
+                                                     lam_num=pargs['lam_num'])
+                yield from write_chunks(serializer, row_chunks)
+                DefectModel.session.remove()
+
+        return flask.Response(flask.stream_with_context(generate_file()), mimetype=mimetype,
+                              headers={'Content-Disposition': f'attachment; filename=defects.{extension}'})
+
+
+class DefectSummary(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('group_by', type=str, default='', location='args',
+                        help=f'Comma separated, any of: {", ".join(DefectModel.summary_group_columns)}. (optional)')
+    parser.add_argument('bucket', type=str, location='args',
+                        help=f'Group by start time, one of: {", ".join(DefectModel.summary_buckets)}. (optional)')
+    parser.add_argument('start_date', type=str, location='args', help='Defects with start dates after this. (optional)')
+    parser.add_argument('end_date', type=str, location='args', help='Defects with start dates before this. (optional)')
+    parser.add_argument('lam_num', type=int, location='args', help='Defects from this laminator number only. (optional)')
+    parser.add_argument('source', type=str, default='defects', choices=('defects', 'rollup'), location='args',
+                        help='defects (default) to aggregate the defects, rollup to read the pre-aggregated daily '
+                             'rollup, which compares dates by day and has confirmed_count instead of max_meters.')
+    responses = ConditionalResponses()
+
+    def get(self):
+        """Get the defect count and meters grouped by columns and/or a time bucket, aggregated by the database.
+
+        The response is {'columns': [column names], 'rows': [[values], ...]}, with an ETag like /defects.
+        """
+        pargs = self.parser.parse_args()
+        group_by = tuple(column for column in pargs['group_by'].replace(' ', '').split(',') if column)
+        if pargs['source'] == 'rollup':
+            summary_model, value_columns = DefectRollupModel, list(DefectRollupModel.value_columns)
+        else:
+            summary_model, value_columns = DefectModel, ['defect_count', 'total_meters', 'max_meters']
+        try:
+            groups = summary_model.summary_groups(group_by, pargs['bucket'])
+        except ValueError as err:
+            return {'error': str(err)}, 400
+        filters = {'start_date': pargs['start_date'], 'end_date': pargs['end_date'], 'lam_num': pargs['lam_num']}
+        with DefectModel.session() as session:
+            validator = DefectModel.get_validator(**filters)
+            DefectModel.session.remove()
+        # the rollup changes with the defects, so their validator covers it too
+        etag = self.responses.etag(group_by, pargs['bucket'], pargs['source'], filters, validator)
+
+        def generate_json():
+            with DefectModel.session() as session:
+                rows = summary_model.summarize(group_by, pargs['bucket'], **filters)
+                DefectModel.session.remove()
+            columns = [group.name for group in groups] + value_columns
+            yield json.dumps({'columns': columns,
+                              'rows': [[value.isoformat() if isinstance(value, datetime.date) else value
+                                        for value in row] for row in rows]})
 
-        return {'completed': True}, 201
+        return self.responses.respond(etag, generate_json, last_modified=validator[1])
@@ -1,7 +1,8 @@
 
 from flask_restful import reqparse, Resource
 
-from flask_server_files.helpers import remove_empty_parameters
+from flask_server_files.conditional_get import ConditionalResponses
+from flask_server_files.helpers import model_serializer, remove_empty_parameters
 from flask_server_files.models.lam_operator import OperatorModel
 from log_and_alert.log_setup import lg
 
@@ -16,6 +17,8 @@ class Operator(Resource):
     for arg in all_args:
         defect_parser.add_argument(arg, type=arg_type_dict[arg], required=False, help='This argument is optional.')
 
+    responses = ConditionalResponses()  # shared with Operators
+
     def get(self):
         """Get a response with the json representation of the operators."""
         try:
@@ -24,21 +27,30 @@ class Operator(Resource):
         except Exception:  # this is to handle 415: Unsupported Media Type
             lam_num = None  # though it should be unnecessary
 
+        return self.active_operators_response(lam_num)
+
+    def active_operators_response(self, lam_num=None):
+        """Get the response with the json of the active operators, 304 if the request already has this version.
+
+        :param lam_num: int, optional, only the operators certified for this laminator.
+        :return: flask.Response or tuple
+        """
+        lam_num = lam_num or None
         with OperatorModel.session() as session:
-            if lam_num:
-                ops = OperatorModel.get_active_operators(lam_num)
-            else:
-                ops = OperatorModel.get_active_operators()
-
-            if ops:
-                ops_list = []
-                for op in ops:
-                    ops_list.append(op.jsonizable())
-                response = ops_list, 200
-            else:
-                response = {'operator': 'No operators found'}, 404
+            validator = OperatorModel.get_validator(lam_num)
             OperatorModel.session.remove()
-        return response
+        if not validator[0]:
+            return {'operator': 'No operators found'}, 404
+
+        serializer = model_serializer(OperatorModel)
+
+        def generate_json():
+            with OperatorModel.session() as session:
+                ops = OperatorModel.get_active_operator_rows(serializer.select_columns, lam_num)
+                OperatorModel.session.remove()
+            yield serializer.dumps([serializer.row_dict(op) for op in ops])
+
+        return self.responses.respond(self.responses.etag(lam_num, validator), generate_json)
 
     def post(self):
         data = self.defect_parser.parse_args()
@@ -112,21 +124,7 @@ class Operators(Operator):
         except Exception:  # this is to handle 415: Unsupported Media Type
             lam_num = None  # though it should be unnecessary
 
-        with OperatorModel.session() as session:
-            if lam_num:
-                ops = OperatorModel.get_active_operators(lam_num)
-            else:
-                ops = OperatorModel.get_active_operators()
-
-            if ops:
-                ops_list = []
-                for op in ops:
-                    ops_list.append(op.jsonizable())
-                response = ops_list, 200
-            else:
-                response = {'operator': 'No operators found'}, 404
-            OperatorModel.session.remove()
-        return response
+        return self.active_operators_response(lam_num)
 
     def post(self):
         # todo: don't know why postman sending a list of ops as records is getting back the
@@ -1,17 +1,20 @@
 """Contains routing for (human) web interface.
 
 defects_table:  /defect_table renders a simple html view of the defects in the database.
+metrics:        /metrics serves the request metrics in the Prometheus text format.
 
 """
-import datetime
 import logging
 
 import flask
 import requests
 from flask import request
 
-from flask_server_files.resources.defect import DefectList
+from flask_server_files.helpers import model_serializer
+from flask_server_files.models.defect import DefectModel
+from flask_server_files.popup_requests import popup_requests
 from flask_server_files.resources.signal_popup import action_dict
+from flask_server_files.sqla_instance import pool_stats
 from log_and_alert.log_setup import lg
 from untracked_config.lam_num import LAM_NUM
 
@@ -25,7 +28,13 @@ def defects_table():
 	:return:
 	"""
     import pandas as pd
-    return pd.DataFrame.from_dict(DefectList().get()[0]).T.to_html()
+
+    serializer = model_serializer(DefectModel)
+    with DefectModel.session() as session:
+        rows = [row for page in DefectModel.iter_pages(serializer.select_columns) for row in page]
+        DefectModel.session.remove()
+    return pd.DataFrame([serializer.row_dict(row) for row in rows], index=[row.id for row in rows],
+                        columns=serializer.columns).to_html()
 
 
 @routes_blueprint.route('/popup_status')
@@ -33,26 +42,14 @@ def operational_check():
     """Ask the popup if it is operational."""
     from flask import current_app as app
 
-    # send a request for a popup status report
-    app.out_message_queue.append({'action': 'popup_status_check'})
-    start_time = datetime.datetime.now()
-    mn = 0
-    status_received = None
-
-    # wait 5 seconds, while checking for a status message
-    while (start_time - datetime.datetime.now()).total_seconds() < 5:
-        for mn, msg in enumerate(app.in_message_queue):
-            status_received = msg.get('popup_status')
-
-            # once a message has been received stop checking
-            if status_received:
-                break
-        if status_received:
-            break
-
-    # pop the message from the deque
-    p_status = app.in_message_queue[mn]
-    del app.in_message_queue[mn]
+    # send a request for a popup status report and wait up to 5 seconds for the reply
+    request_id, status_future = popup_requests.new_request()
+    app.out_message_queue.append({'action': 'popup_status_check', 'request_id': request_id})
+    try:
+        p_status = popup_requests.wait_for(request_id, status_future, timeout=5)
+    except TimeoutError:
+        lg.warning('No popup status response received for request %s.', request_id)
+        return {'popup_status': {'operational': False, 'error': 'No response from the popup.'}}, 504
     lg.debug(p_status)
 
     return p_status, 200
@@ -68,6 +65,14 @@ def server_operational_check():
     return server_status, 200
 
 
+@routes_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    """Serve the per route request counts, errors and latencies, and the server threads in use, for Prometheus."""
+    from flask import current_app as app
+
+    return flask.Response(app.extensions['request_metrics'].render(), mimetype='text/plain; version=0.0.4')
+
+
 act_keys = action_dict.keys()
 
 
@@ -98,5 +103,8 @@ def supervisory_controls_page():
         lg.debug('supervisory page loading.')
 
     current_level = logging.getLevelName(lg.getEffectiveLevel())
+    request_metrics = flask.current_app.extensions.get('request_metrics')
     return flask.render_template('pop_up_supervisory_controls.html', action_list=act_keys, action_dict=action_dict,
-                                 lam_num=LAM_NUM, form_response=form_response, current_level=current_level)
+                                 lam_num=LAM_NUM, form_response=form_response, current_level=current_level,
+                                 metrics=request_metrics.summary() if request_metrics is not None else None,
+                                 pool=pool_stats())
@@ -1,17 +1,153 @@
+import threading
+import time
+
 import flask_sqlalchemy
-from sqlalchemy import create_engine
+import sqlalchemy.exc
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.scoping import scoped_session
+from sqlalchemy.pool import NullPool, QueuePool
+
+from untracked_config.configuration_data import DATABASE_URI, server_threads
+
+
+class StatsQueuePool(QueuePool):
+    """A QueuePool that counts the checkouts that had to wait for a connection, how long they waited and how many
+    timed out, so a pool too small for the requests shows up in the metrics instead of as slow requests."""
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kwargs):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kwargs)
+        self.max_overflow = max_overflow
+        self._stats_lock = threading.Lock()
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def connect(self):
+        # a checkout only waits when no connection is idle and no more may be opened
+        if self.checkedin() or self.max_overflow < 0 or self.overflow() < self.max_overflow:
+            return super().connect()
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except sqlalchemy.exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self.waits += 1
+                self.wait_seconds += time.perf_counter() - start
+
 
-from untracked_config.configuration_data import DATABASE_URI
+# one pool for everything in this process (fsa below keeps no connections). Each waitress thread uses at most one
+# connection at a time (its scoped session), the popup's Tk thread and background jobs (migrations, rollup rebuilds)
+# need the rest.
+popup_connections = 2
+pool_options = {'poolclass': StatsQueuePool,
+                'pool_size': server_threads + popup_connections,
+                'max_overflow': max(server_threads // 2, 2),  # for bursts beyond that, closed again when returned
+                'pool_timeout': 10,  # seconds to wait for a connection before failing the request, instead of 30
+                'pool_recycle': 30 * 60,  # seconds, replace connections before the network drops them as idle
+                'pool_pre_ping': True}
+if make_url(DATABASE_URI).get_backend_name() == 'sqlite':
+    pool_options = {}  # sqlite uses its own single connection or file pools
 
 # engine = create_engine(DATABASE_URI, connect_args={'check_same_thread': False})
-engine = create_engine(DATABASE_URI, pool_pre_ping=True)
+engine = create_engine(DATABASE_URI, **pool_options)
 local_session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 Session = scoped_session(local_session)
 Base.session = Session
 Base.query = Session.query_property()
 
-fsa = flask_sqlalchemy.SQLAlchemy()
+# read-only snapshot sessions: what they load keeps its values after the session is closed (expire_on_commit is off),
+# so reading those objects later (ex: from the popup's widgets) never runs a refresh SELECT. The values are as loaded,
+# use session.refresh(obj) or query again for new ones.
+#   ex: with snapshot_session() as session:
+#           defects = DefectModel.find_new(lam_number=1, session=session)
+snapshot_session = sessionmaker(autoflush=False, bind=engine, expire_on_commit=False)
+
+
+@event.listens_for(snapshot_session, 'before_flush')
+def _refuse_snapshot_writes(session, flush_context, instances):
+    raise sqlalchemy.exc.InvalidRequestError('Snapshot sessions are read-only, save with Base.session.')
+
+
+class QueryCounter:
+    """Counts the SQL statements the current thread runs on an engine, ex: to check how many queries a Tk callback
+    makes.
+
+    ex:
+        > with QueryCounter() as counter:
+        >     popup_frame.check_for_new_defects()
+        > counter.count
+        1
+    """
+
+    def __init__(self, bind=engine):
+        """
+        :param bind: sqlalchemy.engine.Engine, the engine to count the statements of.
+        """
+        self.bind = bind
+        self.statements = []
+        self._thread_id = None
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self._thread_id:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        event.listen(self.bind, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(self.bind, 'before_cursor_execute', self._count)
+
+
+def pool_stats(bind=engine):
+    """Get the state of an engine's connection pool.
+
+    :param bind: sqlalchemy.engine.Engine
+    :return: dict, {'size', 'checked_out', 'checked_in', 'overflow', 'max_overflow', 'waits', 'wait_seconds',
+    'timeouts'}, only 'pool' (the pool's class name) for pools other than StatsQueuePool.
+    """
+    pool = bind.pool
+    if not isinstance(pool, StatsQueuePool):
+        return {'pool': type(pool).__name__}
+    with pool._stats_lock:
+        waits, wait_seconds, timeouts = pool.waits, pool.wait_seconds, pool.timeouts
+    return {'pool': type(pool).__name__, 'size': pool.size(), 'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(), 'overflow': max(pool.overflow(), 0), 'max_overflow': pool.max_overflow,
+            'waits': waits, 'wait_seconds': round(wait_seconds, 3), 'timeouts': timeouts}
+
+
+def pool_metrics(bind=engine):
+    """Get the connection pool's state as metrics, for RequestMetrics.add_collector.
+
+    :param bind: sqlalchemy.engine.Engine
+    :return: list, of (name, type, help, value) tuples.
+    """
+    stats = pool_stats(bind)
+    if 'size' not in stats:
+        return []
+    return [('db_pool_size', 'gauge', 'Connections kept open by the database pool.', stats['size']),
+            ('db_pool_max_overflow', 'gauge', 'Connections the pool may open beyond its size.', stats['max_overflow']),
+            ('db_pool_checked_out', 'gauge', 'Connections in use.', stats['checked_out']),
+            ('db_pool_overflow', 'gauge', 'Connections open beyond the pool size.', stats['overflow']),
+            ('db_pool_waits_total', 'counter', 'Checkouts that waited for a free connection.', stats['waits']),
+            ('db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a free connection.',
+             stats['wait_seconds']),
+            ('db_pool_timeouts_total', 'counter', 'Checkouts that gave up waiting.', stats['timeouts'])]
+
+
+# Flask-SQLAlchemy's engine only creates and drops tables, a NullPool keeps no connections open between those, so the
+# pool above is the only one holding connections.
+fsa = flask_sqlalchemy.SQLAlchemy(engine_options={'poolclass': NullPool})
@@ -72,23 +72,19 @@ else:
 			# of thing
 			# that somehow would anyway)
 			if def_id.val:
-				# get the values from the database
-				result = hc.get(defects_url, params={'id': def_id.val}).json
-				print('get current defect result {}'.format(result))
-
-				# we only need the updated values for put
-				current_data_dict = {'id': def_id.val, 'defect_end_ts': system.date.now()}
+				# we only need the updated values for patch
+				current_data_dict = {'id': def_id.val,
+									 'defect_end_ts': system.date.format(system.date.now(), "yyyy-MM-dd'T'HH:mm:ss.SSSXXX")}
 				# the database is on the same system as the gateway, so same time source
 
 				end_length = Ptag(tagpath_dict['mahlo_end_length'][lam_num]).val
 				current_data_dict['mahlo_end_length'] = end_length
-
-				current_data_dict['length_of_defect_meters'] = round(end_length - result['mahlo_start_length'], 2)
+				# length_of_defect_meters is worked out by the database from the start and end lengths
 
 				print('current_data_dict: {}'.format(current_data_dict))
 
 				# todo: check result code and add retries
-				result = hc.put(defects_url, params=current_data_dict).json
+				result = hc.patch(defects_url, data=current_data_dict).json
 				print('update result: {}'.format(result))
 
 				# reset this to no current defect
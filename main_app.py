@@ -11,6 +11,7 @@ from log_and_alert.email_alert import get_email_cfg_dict, set_up_alert
 from log_and_alert.log_setup import lg, program_unique_id
 from log_and_alert.program_restart_records import record_restart
 from main_window import MainWindow
+from publishing_vars import SubscribableDeque
 from restart_error import RestartError
 from untracked_config.configuration_data import ON_DEV_NODE, HOSTNAME
 from untracked_config.lam_num import LAM_NUM
@@ -26,7 +27,7 @@ try:
 
     with single_instance(lock_file_path):
         # allow communication between flask and the popup
-        f2p_queue = deque()
+        f2p_queue = SubscribableDeque()  # wakes the popup when flask sends a message
         p2f_queue = deque()
         termination_queue = deque()
 
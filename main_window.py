@@ -1,5 +1,6 @@
 """To add a popup window to the Mahlo HMI PC at the laminators. Designed to be called from the command line over ssl."""
 
+import collections
 import datetime
 import json
 import tkinter
@@ -9,11 +10,12 @@ from tkinter import ttk
 
 from dev_common import add_show_messages_button, blank_up, dt_to_shift, exception_one_line, recurse_hover, \
     recurse_tk_structure, style_component, window_topmost
-from flask_server_files.models.defect import DefectModel
-from flask_server_files.models.lam_operator import OperatorModel
+from flask_server_files.popup_requests import popup_requests
 from log_and_alert.log_setup import lg
 from lot_number_checks import LotChecker
+from msg_window.local_mirror import LocalMirror
 from msg_window.popup_frame import DefectMessageFrame
+from msg_window.save_queue import SaveQueue
 from restart_error import RestartError
 from scada_outbound_connections.scada_tag_query import TagHistoryConnector
 from untracked_config.lam_num import LAM_NUM
@@ -78,6 +80,19 @@ class MainWindow(tk.Tk):
         # list of components that need to 'hide' when the lam is running
         self.hideables = []
 
+        # the defects and operators are read from a local mirror of the database, kept in sync by a background thread
+        # which wakes the mainloop with an event when the mirror changed, started once the panels that show it exist
+        self.mirror = LocalMirror(self.lam_num, notify=self._signal_mirror_synced)
+        self.bind('<<MirrorSynced>>', self.check_for_mirror_changes)
+
+        # defects are saved by a background thread, which wakes the mainloop with an event when a save is done
+        self.done_saves = collections.deque()
+        self.operators = {}  # {'first last': (initials, operator id)}, the active operators, set by the controls panel
+        self.save_queue = SaveQueue(notify=self._signal_save_done, mirror=self.mirror)
+        self.bind('<<SaveDone>>', self.check_for_done_saves)
+        self.save_queue.start()
+        self.after(1000, self.check_for_done_saves)  # any saves replayed before the mainloop started
+
         # where the messages about defect appear with their toggles/save buttons
         self.popup_frame = DefectMessageFrame(self, lam_num=self.lam_num, **grid_style_params)
         self.popup_frame.grid(row=0, column=0, sticky='nesw')
@@ -130,6 +145,7 @@ class MainWindow(tk.Tk):
                                                        )
         self.controls_panel.grid(row=2, column=0, sticky='we')
         self.hideables.append(self.controls_panel)
+        self.mirror.start()
 
         # move the window to the front
         window_topmost(self)
@@ -165,10 +181,14 @@ class MainWindow(tk.Tk):
             self.after(1000, lambda: recursive_print(self))  # for debugging, prints out the tkinter structure
             recurse_hover(self.popup_frame)  # for debugging, shows widget info when mouse cursor moves over it
 
-        # check messages from flask
+        # check messages from flask; the inbox wakes the mainloop with an event when a message arrives
         self.new_messages = []
         self.flask_app = None
-        self.after(1000, self.check_for_inbound_messages)
+        self.bind('<<InboundMessage>>', self.check_for_inbound_messages)
+        self._poll_inbound = not hasattr(self.messages_from_flask, 'subscribe')
+        if not self._poll_inbound:
+            self.messages_from_flask.subscribe(self, self._signal_inbound_message)
+        self.after(1000, self.check_for_inbound_messages)  # anything that arrived before the mainloop started
 
         if self.lam_num:  # don't steal focus on development system
             self.after(5_000, self.ensure_on_top, True)
@@ -383,13 +403,66 @@ class MainWindow(tk.Tk):
             if self._ghost_hide.get():
                 self.attributes('-alpha', self._ghost_fade.get() / 100.0)
 
-    def check_for_inbound_messages(self):
-        """Check the inbound queue for new defect messages and if there are any, send them to the MessagePanel."""
+    def _signal_inbound_message(self):
+        """Wake the tkinter mainloop to handle a new inbound message. Called from the flask thread.
+
+        event_generate is marshalled to the tkinter thread by the threaded Tcl interpreter. Until the mainloop is
+        running this will fail, those messages are handled by the check scheduled during __init__.
+        """
+
+        try:
+            self.event_generate('<<InboundMessage>>', when='tail')
+        except (RuntimeError, tkinter.TclError) as err:
+            lg.debug('Could not signal the popup of an inbound message: %s', err)
+
+    def _signal_mirror_synced(self):
+        """Wake the tkinter mainloop to show the changes to the local mirror. Called from the mirror's sync thread."""
+
+        try:
+            self.event_generate('<<MirrorSynced>>', when='tail')
+        except (RuntimeError, tkinter.TclError) as err:
+            lg.debug('Could not signal the popup of a mirror sync: %s', err)
+
+    def check_for_mirror_changes(self, event=None):
+        """Show the defects and operators the local mirror has after a sync."""
+
+        self.controls_panel.refresh_operators()
+        self.popup_frame.check_for_new_defects()
 
-        # TODO: make a deque subclass that is subscribable -> generate tk events
+    def _signal_save_done(self, result):
+        """Keep the result of a defect save and wake the tkinter mainloop to handle it. Called from the save thread.
+
+        :param result: dict, see SaveQueue
+        """
+
+        self.done_saves.append(result)
+        try:
+            self.event_generate('<<SaveDone>>', when='tail')
+        except (RuntimeError, tkinter.TclError) as err:
+            lg.debug('Could not signal the popup of a done save: %s', err)
+
+    def check_for_done_saves(self, event=None):
+        """Sync the defects inserted by the save queue to the local mirror, and warn about the saves that failed."""
+
+        while self.done_saves:
+            result = self.done_saves.popleft()
+            if result['ok']:
+                if result['action'] == 'insert':
+                    self.mirror.request_sync()  # its panel is added when the mirror has it
+                continue
+            self.new_messages.append({'action': 'set_additional_msg', 'color_theme': 'warning',
+                                      'additional_message_text': f'Defect save failed: {result["error"]}',
+                                      'additional_message_short_text': 'Save failed.'})
+            # bring back the panel of a defect that wasn't saved
+            self.mirror.request_sync(full=result['action'] == 'patch')
+        if self.new_messages and not self._poll_inbound:  # when polling, the next poll shows them
+            self.event_generate('<<InboundMessage>>', when='tail')
+
+    def check_for_inbound_messages(self, event=None):
+        """Check the inbound queue for new defect messages and if there are any, send them to the MessagePanel."""
 
         while len(self.messages_from_flask):
-            self.new_messages.append(self.messages_from_flask.pop())
+            self.new_messages.append(self.messages_from_flask.popleft())
         if self.new_messages:
             lg.debug('new messages: %s', self.new_messages)
 
@@ -406,25 +479,27 @@ class MainWindow(tk.Tk):
                         self.show_hideables()
                     elif action_str == 'check_defect_updates':
                         lg.debug('check for updates to defects')
-                        self.popup_frame.check_for_new_defects()
+                        self.mirror.request_sync()  # the popup checks the mirror once it has synced
                     elif action_str == 'reset_position':
                         self.geometry('+0+0')
                     elif action_str == 'restart_popup':
                         merr = action_dict.get('error')
                         self.terminate_with_cause(merr)
                     elif action_str == 'shift_change':
+                        self._thist.invalidate('shift_number')  # the cached shift may be from before the change
                         self.current_shift = self._thist.get_current_shift_number()
                         self.event_generate('<<ShiftChange>>')
                     elif action_str == 'popup_status_check':
-                        self.messages_to_flask.append({'popup_status':
-                                                           {'operational': True,
-                                                            'geometry': self.geometry(),
-                                                            'lam_num': self.lam_num,
-                                                            'system_time': datetime.datetime.now().isoformat(),
-                                                            'shift': self.current_shift,
-                                                            'current_form': self.current_form,
-                                                            'operator': self.current_operator.get()
-                                                            }})
+                        popup_requests.complete(action_dict.get('request_id'),
+                                                {'popup_status':
+                                                     {'operational': True,
+                                                      'geometry': self.geometry(),
+                                                      'lam_num': self.lam_num,
+                                                      'system_time': datetime.datetime.now().isoformat(),
+                                                      'shift': self.current_shift,
+                                                      'current_form': self.current_form,
+                                                      'operator': self.current_operator.get()
+                                                      }})
                     elif action_str == 'set_additional_msg':
                         lg.debug('changing additional message: %s', action_dict)
                         themes = {'info': {'background': 'black', 'foreground': 'white'},
@@ -466,12 +541,15 @@ class MainWindow(tk.Tk):
                         # clear out any messages that cannot be used so that they don't accumulate
                         unused_message = action_dict
                         lg.warning('Unhandled message received in popup: %s', unused_message)
-        self.after(500, self.check_for_inbound_messages)
+        if self._poll_inbound:
+            self.after(500, self.check_for_inbound_messages)
 
     def terminate_with_cause(self, merr, *args, **kwargs):
         """Signal the post-tkinter program to restart after cleanup as well as ending tkinter."""
 
         merr.additional_information = {'operator': self.controls_panel.current_operator.get()}
+        self.save_queue.stop(timeout=5)  # let a save in progress finish, the queued saves stay in the journal
+        self.mirror.stop(timeout=5)
         self.quit()
         self.termd.append(merr)
 
@@ -502,21 +580,14 @@ class IndependentControlsPanel(tk.ttk.LabelFrame):
         def add_new_defect():
             """Add a new defect to the database & popup window."""
 
-            # create a new defect in the database, get the popup frame, tell it to update
-            thist = toplevel._thist
-            lot_num = thist.current_lot_number()
-            current_length = thist.current_mahlo_length()
-            tabcode = thist.get_current_tabcode()
-            recipe = thist.get_current_recipe()
-            file_name = thist.get_current_file_name()
-            new_defect = DefectModel.new_defect(source_lot_number=lot_num, record_creation_source='operator',
-                                                mahlo_end_length=current_length, mahlo_start_length=current_length,
-                                                lam_num=self.lam_num,
-                                                rolls_of_product_post_slit=toplevel.last_produced_rolls_count,
-                                                tabcode=tabcode, recipe=recipe, file_name=file_name
-                                                )
-            popup = self.parent.popup_frame  # TODO: replace this with a passed in method call
-            popup.check_for_new_defects()
+            # queue the new defect, its panel is added when the save queue signals it has been inserted
+            tags = toplevel._thist.snapshot(fields=('lot_number', 'length', 'tabcode', 'recipe', 'file_name'))
+            toplevel.save_queue.insert(dict(source_lot_number=tags.lot_number, record_creation_source='operator',
+                                            mahlo_end_length=tags.length, mahlo_start_length=tags.length,
+                                            lam_num=self.lam_num,
+                                            rolls_of_product_post_slit=toplevel.last_produced_rolls_count,
+                                            tabcode=tags.tabcode, recipe=tags.recipe, file_name=tags.file_name
+                                            ))
 
         # add a new defect button
         self.add_defect_button = tk.ttk.Button(self, text='New defect', command=add_new_defect)
@@ -553,16 +624,10 @@ class IndependentControlsPanel(tk.ttk.LabelFrame):
             self._ghost_fader.grid(row=3, column=self.next_column(), sticky='ns', padx=self.pad['x'],
                                    pady=self.pad['y'])
 
-        # drop down to select the current operator  todo: getting the list may be better located removed from the gui
-        with OperatorModel.session() as session:
-            active_operators_this_lam = OperatorModel.get_active_operators(self.lam_num)
-            operator_names = [(op.first_name, op.last_name) for op in active_operators_this_lam]
-            OperatorModel.session.remove()
-        operator_name_list = sorted([' '.join((fn, ln)) for (fn, ln) in operator_names])
+        # drop down to select the current operator, from the local mirror so the popup starts while offline
         self._default_operator = 'NO OPERATOR'
-        operator_name_list = [self._default_operator] + operator_name_list
-
-        self.operator_selector = ttk.OptionMenu(self, self.current_operator, *operator_name_list, direction='above')
+        self.operator_selector = ttk.OptionMenu(self, self.current_operator, self._default_operator, direction='above')
+        self.refresh_operators()
         self.operator_selector.grid(row=3, column=self.next_column(), sticky='ns', padx=self.pad['x'],
                                     pady=self.pad['y'])
 
@@ -602,6 +667,20 @@ class IndependentControlsPanel(tk.ttk.LabelFrame):
         self.restart_button.grid(row=3, column=1000, sticky='e', padx=self.pad['x'],  # put it all the way to the right
                                  pady=self.pad['y'])
 
+    def refresh_operators(self):
+        """Set the operator drop down's choices to the active operators in the local mirror, keeping the selection if
+        that operator is still active.
+        """
+
+        toplevel = self.winfo_toplevel()
+        # kept for saving defects, so a save doesn't have to look the operator up in the database
+        toplevel.operators = {' '.join((op.first_name, op.last_name)): (op.initials, op.id)
+                              for op in toplevel.mirror.active_operators()}
+        selected = self.current_operator.get()
+        if selected not in toplevel.operators:
+            selected = self._default_operator
+        self.operator_selector.set_menu(selected, self._default_operator, *sorted(toplevel.operators))
+
     def next_column(self):
         """Get an integer representing the next tk grid column to use."""
 
@@ -612,6 +691,8 @@ class IndependentControlsPanel(tk.ttk.LabelFrame):
 if __name__ == '__main__':
     from collections import deque
 
-    dq1 = deque()
+    from publishing_vars import SubscribableDeque
+
+    dq1 = SubscribableDeque()
     dq2 = deque()
     MainWindow(dq1, dq2)
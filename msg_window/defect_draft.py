@@ -0,0 +1,51 @@
+"""Contains the in-memory defect the popup's widgets edit, so editing never touches the database until it is saved."""
+
+from log_and_alert.log_setup import lg
+
+
+class DefectDraft:
+    """A plain copy of a defect's column values, its attributes are set by the MessagePanel widgets.
+
+    Nothing is read from or written to the database while editing, save queues the changed columns for one UPDATE.
+    """
+
+    def __init__(self, values):
+        """
+        :param values: dict, of {column name: value}, every column of the defect.
+        """
+        self.__dict__.update(values)
+        self._saved_values = dict(values)
+
+    @classmethod
+    def from_model(cls, defect):
+        """Make a draft from a loaded DefectModel, from the values it already holds (no refresh query).
+
+        :param defect: DefectModel
+        :return: DefectDraft
+        """
+        return cls(defect.get_model_dict())
+
+    def changes(self):
+        """Get the columns that have been changed since the draft was made or saved.
+
+        :return: dict, of {column name: new value}
+        """
+        return {column: getattr(self, column) for column, value in self._saved_values.items()
+                if getattr(self, column) != value}
+
+    def save(self, save_queue, **values):
+        """Queue the changed columns, and any values given, to be written with one UPDATE by the save queue.
+
+        :param save_queue: SaveQueue
+        :param values: column values to save along with the changes, ex: operator_initials='ABC'
+        :return: int, the save's sequence number.
+        """
+        values = {**self.changes(), **values}
+        lg.debug('Queueing the save of defect %s: %s', self.id, values)
+        seq = save_queue.patch(self.id, values)
+        self.__dict__.update(values)
+        self._saved_values.update(values)
+        return seq
+
+    def __repr__(self):
+        return f'<DefectDraft {self.id}>'
@@ -0,0 +1,229 @@
+"""Contains the local SQLite mirror of this laminator's open defects and certified operators, that the popup reads.
+
+A background thread keeps the mirror in sync with the central database, incrementally (only the defects past a
+high-water mark, and the ids of the mirrored defects to drop those deleted centrally), so the popup's reads never wait
+on the network and keep working from the last sync while the central database can't be reached. Saves go through the
+SaveQueue, which commits them once the connection is back and writes what it committed through to the mirror.
+"""
+import os
+import threading
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import sessionmaker
+
+from dev_common import exception_one_line
+from flask_server_files.models.defect import DefectModel
+from flask_server_files.models.lam_operator import OperatorModel
+from flask_server_files.sqla_instance import Base, snapshot_session
+from log_and_alert.log_setup import lg
+from msg_window.save_queue import program_dir, retry_errors
+
+
+def _column_values(model_instance):
+    """Get the {column name: value} of a loaded model instance."""
+    return {column.name: getattr(model_instance, column.name) for column in model_instance.__table__.columns}
+
+
+def _newer(modified, than):
+    """Get whether an entry_modified_ts is later than another, None being the earliest."""
+    return modified is not None and (than is None or modified > than)
+
+
+class LocalMirror:
+    """A local SQLite copy of the open (unconfirmed) defects and the certified operators of a laminator.
+
+    ex:
+        > mirror = LocalMirror(lam_num=1, notify=on_synced)
+        > mirror.start()  # keeps syncing in the background, the first sync right away
+        > with mirror.session() as session:
+        >     defects = DefectModel.find_new(lam_number=1, session=session)
+    """
+
+    sync_seconds = 5  # between syncs, request_sync starts one sooner
+
+    def __init__(self, lam_num, path=os.path.join(program_dir, 'mahlo_popup_mirror.sqlite'), notify=None):
+        """
+        :param lam_num: int, the laminator to mirror the defects and operators of.
+        :param path: str, the SQLite database file.
+        :param notify: function, optional, called without parameters from the sync thread when the mirror changed.
+        """
+        self.lam_num = lam_num
+        self.notify = notify
+        self.engine = sqlalchemy.create_engine(f'sqlite:///{path}')
+        event.listen(self.engine, 'connect', self._set_pragmas)
+        tables = [DefectModel.__table__, OperatorModel.__table__]
+        # the mirror is only a copy, replace the tables a mirror file has from older models
+        inspector = sqlalchemy.inspect(self.engine)
+        old_tables = [table for table in tables if inspector.has_table(table.name) and
+                      {column['name'] for column in inspector.get_columns(table.name)} != set(table.columns.keys())]
+        Base.metadata.drop_all(self.engine, tables=old_tables)
+        Base.metadata.create_all(self.engine, tables=tables)
+        # what the popup reads keeps its values after the session is closed, like from a snapshot_session
+        self.session = sessionmaker(autoflush=False, bind=self.engine, expire_on_commit=False)
+        self.connected = None  # whether the last sync reached the central database, None before the first
+
+        self._lock = threading.Lock()  # one write to the mirror at a time
+        self._sync_requested = threading.Event()
+        self._full_sync = True  # replace the mirrored defects instead of only getting those past the mark
+        self._last_seen_id = None
+        self._last_seen_modified = None
+        self._operators = None
+        self._written_through = None  # {defect id: entry_modified_ts}, of the saves written through during a sync
+        self._stopping = False
+        self._thread = None
+
+    @staticmethod
+    def _set_pragmas(dbapi_connection, connection_record):
+        # readers don't wait on the sync's writes, and commits don't wait on the disk (a lost sync is synced again)
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    def start(self):
+        """Start the sync thread, it syncs right away and notifies once the mirror is current."""
+        self._thread = threading.Thread(target=self._keep_syncing, name='local_mirror_sync', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the sync thread.
+
+        :param timeout: float, optional, the seconds to wait for the thread.
+        """
+        self._stopping = True
+        self._sync_requested.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def request_sync(self, full=False):
+        """Sync now instead of at the next interval.
+
+        :param full: bool, get every open defect again instead of those past the mark, ex: to bring back the panel of
+        a defect whose save failed.
+        """
+        if full:
+            self._full_sync = True
+        self._sync_requested.set()
+
+    def _keep_syncing(self):
+        while not self._stopping:
+            self._sync_and_notify()
+            self._sync_requested.wait(self.sync_seconds)
+            self._sync_requested.clear()
+
+    def _sync_and_notify(self):
+        try:
+            changed = self.sync()
+        except retry_errors as exc:  # the mirror keeps what it has until the next sync
+            if self.connected is not False:
+                lg.warning('The central database cannot be reached, the popup is using the local mirror: %s',
+                           exception_one_line(exc))
+            self.connected = False
+            return
+        except Exception as exc:
+            lg.error('Could not sync the local mirror: %s', exception_one_line(exc))
+            return
+        if self.connected is False:
+            lg.info('The central database can be reached again.')
+        self.connected = True
+        if changed and self.notify is not None:
+            try:
+                self.notify()
+            except Exception as exc:
+                lg.error('Could not report the local mirror sync: %s', exception_one_line(exc))
+
+    def sync(self):
+        """Bring the mirror up to date with the central database, with the defects past the high-water mark, the
+        defects deleted centrally and the certified operators.
+
+        :return: bool, whether anything in the mirror changed.
+        """
+        with self._lock:
+            full_sync, self._full_sync = self._full_sync, False
+            since_id, since_modified = (None, None) if full_sync else (self._last_seen_id, self._last_seen_modified)
+            self._written_through = {}
+        table = DefectModel.__table__
+        try:
+            with self.engine.connect() as cnn:
+                mirrored_ids = set(cnn.execute(sqlalchemy.select(table.c.id)).scalars())
+            # the central reads can wait on the network, so they don't hold the lock the save queue writes through with
+            with snapshot_session() as central:
+                defects = DefectModel.find_new_since(lam_number=self.lam_num, since_id=since_id,
+                                                     since_modified=since_modified, session=central)
+                # a deleted defect has no modified time to be found by, so look for the mirrored ones by id
+                deleted_ids = set() if full_sync or not mirrored_ids else mirrored_ids - set(central.execute(
+                    sqlalchemy.select(DefectModel.id).where(DefectModel.id.in_(mirrored_ids))).scalars())
+                operators = sorted((_column_values(operator) for operator in
+                                    OperatorModel.get_active_operators(self.lam_num, session=central)),
+                                   key=lambda operator: operator['id'])
+            rows = [_column_values(defect) for defect in defects]
+            if full_sync:  # every open defect was read, the others mirrored are confirmed or deleted
+                deleted_ids = mirrored_ids - {row['id'] for row in rows}
+
+            with self._lock:
+                # a save written through during the reads is at least as new as what they got, unless it changed again
+                written = self._written_through
+                self._written_through = None
+                changed_rows = [row for row in rows if row['id'] not in written or
+                                _newer(row['entry_modified_ts'], written[row['id']])]
+                deleted_ids -= written.keys()
+                with self.engine.begin() as cnn:
+                    if deleted_ids:
+                        cnn.execute(sqlalchemy.delete(table).where(table.c.id.in_(deleted_ids)))
+                    self._keep(cnn, changed_rows)
+                    operators_changed = operators != self._operators
+                    if operators_changed:
+                        cnn.execute(sqlalchemy.delete(OperatorModel.__table__))
+                        if operators:
+                            cnn.execute(sqlalchemy.insert(OperatorModel.__table__), operators)
+
+                for row in rows:
+                    if self._last_seen_id is None or row['id'] > self._last_seen_id:
+                        self._last_seen_id = row['id']
+                    if _newer(row['entry_modified_ts'], self._last_seen_modified):
+                        self._last_seen_modified = row['entry_modified_ts']
+                self._operators = operators
+        except BaseException:
+            if full_sync:  # the next sync is a full one again
+                self._full_sync = True
+            raise
+        return full_sync or bool(changed_rows) or bool(deleted_ids) or operators_changed
+
+    def write_through(self, row):
+        """Apply a defect the central database has committed to the mirror, without waiting for the next sync.
+
+        :param row: mapping, of every column of the defect, ex: the sqlalchemy Row's _mapping from DefectModel.patch.
+        """
+        with self._lock, self.engine.begin() as cnn:
+            self._keep(cnn, [dict(row)])
+            if self._written_through is not None:
+                self._written_through[row['id']] = row['entry_modified_ts']
+
+    @staticmethod
+    def _keep(cnn, rows):
+        """Upsert the open defects and delete the confirmed ones.
+
+        :param cnn: sqlalchemy.engine.Connection, to the mirror.
+        :param rows: list, of dicts of every column of a defect.
+        """
+        table = DefectModel.__table__
+        confirmed_ids = [row['id'] for row in rows if row['operator_saved_time'] is not None]
+        open_rows = [row for row in rows if row['operator_saved_time'] is None]
+        if confirmed_ids:
+            cnn.execute(sqlalchemy.delete(table).where(table.c.id.in_(confirmed_ids)))
+        if open_rows:
+            insert = sqlite.insert(table)
+            cnn.execute(insert.on_conflict_do_update(
+                index_elements=[table.c.id],
+                set_={column.name: insert.excluded[column.name] for column in table.columns if column.name != 'id'}),
+                open_rows)
+
+    def active_operators(self):
+        """Get the mirrored active operators certified for the laminator.
+
+        :return: list, of OperatorModels.
+        """
+        with self.session() as session:
+            return OperatorModel.get_active_operators(self.lam_num, session=session)
@@ -1,18 +1,18 @@
 """Contains the panel that displays the defect information and interface."""
 
+import datetime
 import tkinter as tk
 from tkinter import ttk
 
-import sqlalchemy.exc
-
-from dev_common import dt_to_shift, StrCol
-from flask_server_files.models.lam_operator import OperatorModel
+from dev_common import dt_to_shift, exception_one_line, StrCol
 from log_and_alert.log_setup import lg
 from msg_window.defect_attributes import DefectTypePanel, HorizontalNumButtonSelector, LengthSetFrames, LotNumberEntry
 from widgets.roll_removed_toggles import RollRemovedToggles
 
 
 class MessagePanel(tk.ttk.LabelFrame):
+    """The panel for confirming a defect. Its widgets edit a DefectDraft, which is only written when it is saved."""
+
     def __init__(self, parent, current_defects, defect_instance=None, row=0, **kwargs):
         super().__init__(parent)
         self.config(text=f'Defect #{defect_instance.id}')
@@ -32,11 +32,8 @@ class MessagePanel(tk.ttk.LabelFrame):
             setattr(self, k, v)
 
         self.hideables = []
-        self.defect_interface = defect_instance
-        with self.defect_interface.session() as session:
-            interface_id = self.defect_interface.id
-            self.defect_interface.session.remove()
-        self.defect_id = interface_id
+        self.defect_interface = defect_instance  # a DefectDraft
+        self.defect_id = self.defect_interface.id
         self.message_text_template = 'lot  # {lot_number}\n' \
                                      '{timestamp} on lam{lam_num}\n' \
                                      '{len_meters} meters oospec\n' \
@@ -67,9 +64,7 @@ class MessagePanel(tk.ttk.LabelFrame):
         self._tabframe.bind('<<NotebookTabChanged>>', self.update_message_text)
 
         # if it's an auto-detected defect, they hopefully only need to confirm it, start there
-        with self.defect_interface.session() as session:
-            source = self.defect_interface.record_creation_source
-        if source != 'operator':
+        if self.defect_interface.record_creation_source != 'operator':
             self._tabframe.select(self._tabframe.index('end') - 1)
 
         # lot #, rolls, defect type panel
@@ -144,25 +139,16 @@ class MessagePanel(tk.ttk.LabelFrame):
     def update_message_text(self, *args):
         """Update the message label with any changes."""
 
-        with self.defect_interface.session() as session:
-            ts = self.defect_interface.defect_end_ts
-            lot_number = self.defect_interface.source_lot_number
-            len_meters = self.defect_interface.length_of_defect_meters
-            defect_type = self.defect_interface.defect_type
-            defect_id = self.defect_interface.id
-            start_length = self.defect_interface.mahlo_start_length
-            end_length = self.defect_interface.mahlo_end_length
-            lam_num = self.defect_interface.lam_num
-            self.defect_interface.session.remove()
+        defect = self.defect_interface
         msg_text = self.message_text_template.format(
-            lot_number=lot_number,
-            timestamp=ts.strftime(self.dt_format_str),
-            len_meters=len_meters,
-            dtype=defect_type,
-            defect_id=defect_id,
-            mahlo_start_length=start_length,
-            mahlo_end_length=end_length,
-            lam_num=lam_num,
+            lot_number=defect.source_lot_number,
+            timestamp=defect.defect_end_ts.strftime(self.dt_format_str),
+            len_meters=defect.length_of_defect_meters,
+            dtype=defect.defect_type,
+            defect_id=defect.id,
+            mahlo_start_length=defect.mahlo_start_length,
+            mahlo_end_length=defect.mahlo_end_length,
+            lam_num=defect.lam_num,
             )
         self.message_label.config(text=msg_text)
 
@@ -189,59 +175,44 @@ class MessagePanel(tk.ttk.LabelFrame):
         parent.rowconfigure(0, weight=1)
         send_btn.grid(**send_grid_params)
         send_btn.grid(sticky='nse')
-        with self.defect_interface.session() as session:
-            defect_id = self.defect_interface.id
-            self.defect_interface.session.remove()
-        setattr(send_btn, 'msg_id', defect_id)
+        setattr(send_btn, 'msg_id', self.defect_interface.id)
         setattr(send_btn, 'side', 'send')
 
     def save_response(self, event=None):
-        """Save the changes made to the database.
+        """Queue the changes made to the defect, and its confirmation, to be saved with one UPDATE.
+
+        The panel is removed right away, the save queue commits the save in the background.
 
         :param event: tkinter.Event, (optional)
         """
 
         lg.debug('Saving defect record: %s', self.defect_interface)
-        with OperatorModel.session() as session:
-            # get the operator name
-            top_level_win = self.winfo_toplevel()
-            op_name = top_level_win.current_operator.get().split(' ')
-
-            # create filters
-            filter_val_first = OperatorModel.first_name == op_name[0]
-            filter_val_last = OperatorModel.last_name == op_name[1]
-            try:
-                operator_db = OperatorModel.query.filter(filter_val_first).filter(filter_val_last).all()[0]
-                op_initials = operator_db.initials
-                op_id = operator_db.id
-                OperatorModel.session.remove()
-            except sqlalchemy.exc.PendingRollbackError:
-                OperatorModel.scoped_session.rollback()
-                lg.error('Rollback error trying to fetch operator data.')
-                return
-            except IndexError:
-                lg.debug('IndexError fetching operator from database. Check selected operator.')
-                top_level_win.event_generate('<<OperatorNotFound>>')
-                return
-
-        # update column values
-        with self.defect_interface.session() as session:
-            # get the state of the toggles and assign that to the columns
-            for togl, tkvar in self._removed_toggles.removed_vars.items():
-                if togl == 'all':
-                    col_name = 'rem_all'
-                else:
-                    col_name = self._removed_toggles.sides_to_defect_columns_dict[togl]
-                self.toggle_strvar_set_column(col_name, tkvar)
-
-            self.defect_interface.operator_saved_time = self.defect_interface.db_current_ts
-            self.defect_interface.shift_number = dt_to_shift(self.defect_interface.defect_start_ts)
-            self.defect_interface.operator_initials = op_initials
-            self.defect_interface.operator_list_id = op_id
-            self.defect_interface.save_to_database()
-            self.defect_interface.session.remove()
-            self.current_defects.pop(self.current_defects.index(self.defect_interface))
-            self.destroy()
+        top_level_win = self.winfo_toplevel()
+        operator = top_level_win.operators.get(top_level_win.current_operator.get())
+        if operator is None:
+            lg.debug('The selected operator is not an active operator. Check selected operator.')
+            top_level_win.event_generate('<<OperatorNotFound>>')
+            return
+        op_initials, op_id = operator
+
+        # get the state of the toggles and assign that to the columns
+        for togl, tkvar in self._removed_toggles.removed_vars.items():
+            if togl == 'all':
+                col_name = 'rem_all'
+            else:
+                col_name = self._removed_toggles.sides_to_defect_columns_dict[togl]
+            self.toggle_strvar_set_column(col_name, tkvar)
+
+        try:
+            self.defect_interface.save(top_level_win.save_queue,
+                                       operator_saved_time=datetime.datetime.now(datetime.timezone.utc),
+                                       shift_number=dt_to_shift(self.defect_interface.defect_start_ts),
+                                       operator_initials=op_initials, operator_list_id=op_id)
+        except OSError as exc:
+            lg.error('Defect %s could not be queued, keeping the panel: %s', self.defect_id, exception_one_line(exc))
+            return
+        self.current_defects.pop(self.current_defects.index(self.defect_interface))
+        self.destroy()
 
     def toggle_strvar_set_column(self, col_name, tkvar):
         removed_str = tkvar.get()
@@ -3,9 +3,9 @@ from tkinter import ttk
 
 from ttkwidgets.frames import ScrolledFrame
 
-from dev_common import exception_one_line
 from flask_server_files.models.defect import DefectModel
 from log_and_alert.log_setup import lg
+from msg_window.defect_draft import DefectDraft
 from msg_window.msg_panel import MessagePanel
 from publishing_vars import PublishingLengthList
 
@@ -45,11 +45,11 @@ class DefectMessageFrame(ScrolledFrame):
         self.grid(row=1, column=0, sticky='nesw', columnspan=3)
 
         # keep track of things
-        self.messages_frames = []  # list of MessagePanel
-        self.current_defects = PublishingLengthList()  # list of DefectModels
+        self.messages_frames = {}  # {defect id: MessagePanel}
+        self.current_defects = PublishingLengthList()  # list of DefectDrafts, one per panel
         self.message_panel_row = 0  # to keep the panels in order
 
-        self.after(5000, self.check_for_new_defects)  # give SQLalchemy time to connect to the database
+        self.after(1000, self.check_for_new_defects)  # what the local mirror kept from the last run
 
     def current_defect_count(self):
         return len(self.current_defects)
@@ -60,10 +60,7 @@ class DefectMessageFrame(ScrolledFrame):
         :param id_num: int
         :return: MessagePanel
         """
-        for panel in self.messages_frames:
-            if panel.defect_id == id_num:
-                return panel
-        return None
+        return self.messages_frames.get(id_num)
 
     def set_style(self, style_dict):
         """Incorporate the style dict parameters into the instance.
@@ -77,53 +74,73 @@ class DefectMessageFrame(ScrolledFrame):
                 lg.debug(f'PopupFrame add {k}: {v}')
                 setattr(self, k, v)
 
-    def check_for_new_defects(self, retry_num=0):
-        """Check the database for new defects, if there are add new panels."""
-        try:
-            with DefectModel.session() as session:
-                new_defs = DefectModel.find_new(lam_number=self.lam_num)
-                DefectModel.session.remove()
-            lg.debug('new defects: %s', new_defs)
-            for defect in new_defs:
-                if defect not in self.current_defects:
-                    self.add_message_panel(defect)
-
-            # if we have no defects, no need to be big
-            if not self.current_defects:
-                self.parent.hide_hideables()
-        except AssertionError as aser:
-            lg.warning('Assertion error for sqlalchemy (not connected). %s', aser)
-            retry_num += 1
-            if retry_num > 5:
-                raise ConnectionError('Cannot connect to database!')
-            self.after(2000, self.check_for_new_defects, retry_num)
-        except AttributeError as ater:
-            lg.warning('Running without flask. %s', exception_one_line(ater))
+    def check_for_new_defects(self):
+        """Check the local mirror for new defects, add panels for them and remove the panels of the defects that have
+        been confirmed since.
+
+        The mirror is kept in sync with the database in the background, reading it doesn't wait on the network.
+        """
+        mirror = getattr(self.parent, 'mirror', None)
+        if mirror is None:
+            lg.warning('Running without the local mirror, not checking for new defects.')
+            return
+        with mirror.session() as session:
+            open_defects = DefectModel.find_new(lam_number=self.lam_num, session=session)
+        # the defects with queued saves, their panels are gone even though the mirror doesn't show it yet
+        save_queue = getattr(self.parent, 'save_queue', None)
+        pending_ids = set() if save_queue is None else save_queue.pending_ids()
+
+        open_ids = {defect.id for defect in open_defects} - pending_ids
+        for id_num in set(self.messages_frames) - open_ids:
+            self.remove_message_panel(id_num)
+        for defect in open_defects:
+            if defect.id in open_ids:
+                self.add_message_panel(defect)
+
+        # if we have no defects, no need to be big
+        if not self.current_defects:
+            self.parent.hide_hideables()
 
     def get_message_rows(self):
         """Get a list of the rows that MessagePanels currently occupy.
 
         :return: list, [int, ...]
         """
-        mrows = [msg_panel.msg_number for msg_panel in self.messages_frames]
+        mrows = [msg_panel.msg_number for msg_panel in self.messages_frames.values()]
         return mrows
 
     def add_message_panel(self, defect):
-        """Add a message panel to the frame.
+        """Add a message panel to the frame, editing a draft copy of the defect.
 
         :param defect: DefectModel
         :return: MessagePanel
         """
-        if defect.id not in tuple(df.defect_id for df in self.messages_frames):
+        if defect.id not in self.messages_frames:
             self.message_panel_row += 1
-            self.current_defects.append(defect)
-            msg_frm = MessagePanel(self.interior, self.current_defects, defect, self.message_panel_row,
+            draft = DefectDraft.from_model(defect)
+            self.current_defects.append(draft)
+            msg_frm = MessagePanel(self.interior, self.current_defects, draft, self.message_panel_row,
                                    dt_format_str=self.dt_format_str,
                                    pad={'x': self.pad['x'], 'y': self.pad['y']},
                                    _wgt_styles=self._wgt_styles, sticky='nesw')
-            self.messages_frames.append(msg_frm)
+            self.messages_frames[defect.id] = msg_frm
             return msg_frm
 
+    def remove_message_panel(self, id_num):
+        """Remove the panel for a defect that has been confirmed, if it is still showing.
+
+        :param id_num: int, the defect id.
+        """
+        panel = self.messages_frames.pop(id_num, None)
+        if panel is None:
+            return
+        for index, defect in enumerate(self.current_defects):
+            if defect.id == id_num:
+                self.current_defects.pop(index)
+                break
+        if panel.winfo_exists():
+            panel.destroy()
+
     def show_number_of_msgs_button(self):
         """Show the button that has the count of defect messages."""
         self.number_of_messages_button.grid(row=0, column=0, sticky='nesw',
@@ -0,0 +1,261 @@
+"""Contains the write-behind queue the popup saves defects through, so the tkinter thread never waits on the database.
+
+Each save is appended to a local journal file before it is queued. A background thread commits the saves in order,
+retrying while the database can't be reached, and the saves left in the journal are queued again on start, so they
+survive a restart.
+"""
+import collections
+import datetime
+import json
+import os
+import threading
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from dev_common import exception_one_line
+from flask_server_files.models.defect import DefectModel
+from log_and_alert.log_setup import lg
+
+# the popup's local files are kept in the program's directory, wherever it was started from
+program_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# errors from the database or the network being down or busy, the save is tried again; anything else would fail again
+retry_errors = (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError, sqlalchemy.exc.DisconnectionError,
+                sqlalchemy.exc.TimeoutError)
+
+_timestamp_columns = {column.name for column in DefectModel.__table__.columns
+                      if isinstance(column.type, sqlalchemy.DateTime)}
+
+
+def _encode_values(values):
+    """Get column values that can be written to the journal as JSON."""
+    return {column: value.isoformat() if isinstance(value, datetime.datetime) else value
+            for column, value in values.items()}
+
+
+def _decode_values(values):
+    """Get column values from the journal as the column types."""
+    return {column: datetime.datetime.fromisoformat(value)
+            if column in _timestamp_columns and isinstance(value, str) else value for column, value in values.items()}
+
+
+class SaveQueue:
+    """An ordered, durable queue of defect saves, committed by a background thread.
+
+    ex:
+        > save_queue = SaveQueue(notify=on_save_done)  # queues the saves left in the journal from before a restart
+        > save_queue.start()
+        > save_queue.patch(defect_id, {'operator_initials': 'ABC'})  # returns without waiting for the database
+    """
+
+    retry_delays = (1, 2, 5, 10, 30)  # seconds to wait before each retry, the last repeats until the database is back
+
+    def __init__(self, journal_path=os.path.join(program_dir, 'mahlo_popup_saves.jsonl'), notify=None,
+                 mirror=None):
+        """
+        :param journal_path: str, the file the saves are journaled to, its saves that weren't done are queued.
+        :param notify: function, optional, called from the writer thread with the result of each save, a dict of
+        {'seq': int, 'action': 'insert' or 'patch', 'id': int, the defect id, 'ok': bool, 'error': str or None}.
+        :param mirror: LocalMirror, optional, the committed patches are written through to it.
+        """
+        self.journal_path = journal_path
+        self.notify = notify
+        self.mirror = mirror
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pending = collections.deque()  # of journal entries, the first is being committed
+        self._next_seq = 1
+        self._stopping = False
+        self._thread = None
+
+        for entry in self._read_journal():
+            entry['replayed'] = True
+            self._pending.append(entry)
+            self._next_seq = max(self._next_seq, entry['seq'] + 1)
+        if self._pending:
+            lg.info('Saving %s defect saves left in the journal.', len(self._pending))
+
+    def start(self):
+        """Start the writer thread."""
+        self._thread = threading.Thread(target=self._write_saves, name='defect_save_queue', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the writer thread after the save it is committing, the saves still queued stay in the journal.
+
+        :param timeout: float, optional, the seconds to wait for the thread.
+        """
+        with self._lock:
+            self._stopping = True
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def insert(self, values):
+        """Queue a new defect.
+
+        The times default to now, instead of to when the insert is committed, and entry_created_ts tells whether a
+        replayed insert was committed before a restart.
+
+        :param values: dict, of {column name: value}, the values already converted to the column types.
+        :return: int, the save's sequence number.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        values = {'defect_start_ts': now, 'defect_end_ts': now, 'entry_created_ts': now, **values}
+        return self._put('insert', None, values)
+
+    def patch(self, id_, values):
+        """Queue an update to the columns of a defect.
+
+        :param id_: int, the defect id.
+        :param values: dict, of {column name: value}, the values already converted to the column types.
+        :return: int, the save's sequence number.
+        """
+        return self._put('patch', id_, values)
+
+    def pending_ids(self):
+        """Get the ids of the defects with saves that haven't been committed yet.
+
+        :return: set, of ints.
+        """
+        with self._lock:
+            return {entry['id'] for entry in self._pending if entry['id'] is not None}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _put(self, action, id_, values):
+        with self._lock:
+            entry = {'seq': self._next_seq, 'action': action, 'id': id_, 'values': _encode_values(values)}
+            self._next_seq += 1
+            self._append_journal(entry)
+            self._pending.append(entry)
+            self._changed.notify_all()
+        lg.debug('Queued defect save %s: %s', entry['seq'], entry)
+        return entry['seq']
+
+    def _append_journal(self, record):
+        """Append a record to the journal, on disk before returning."""
+        with open(self.journal_path, 'a') as journal:
+            journal.write(json.dumps(record, default=str) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def _read_journal(self):
+        """Get the journal's saves that weren't done.
+
+        :return: list, of journal entries in order.
+        """
+        entries = {}
+        try:
+            with open(self.journal_path, 'r') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except json.decoder.JSONDecodeError as jde:
+                        # the last line of a journal can be cut short by a power failure, it was never queued
+                        lg.warning('Skipping a journal line that could not be read: %s', exception_one_line(jde))
+                        continue
+                    if record.get('done'):
+                        entries.pop(record['seq'], None)
+                    else:
+                        entries[record['seq']] = record
+        except FileNotFoundError:
+            pass
+        return [entries[seq] for seq in sorted(entries)]
+
+    def _write_saves(self):
+        """Commit the queued saves in order, until stopped."""
+        while True:
+            with self._lock:
+                while not self._pending and not self._stopping:
+                    self._changed.wait()
+                if self._stopping:
+                    return
+                entry = self._pending[0]
+            result = self._commit_with_retry(entry)
+            if result is None:
+                return
+            with self._lock:
+                self._pending.popleft()
+                if self._pending:
+                    self._append_journal({'seq': entry['seq'], 'done': True})
+                else:
+                    open(self.journal_path, 'w').close()  # everything is saved, start the journal over
+            if self.notify is not None:
+                try:
+                    self.notify(result)
+                except Exception as exc:
+                    lg.error('Could not report defect save %s: %s', entry['seq'], exception_one_line(exc))
+
+    def _commit_with_retry(self, entry):
+        """Commit a save, trying again while the database can't be reached.
+
+        :param entry: dict, the journal entry.
+        :return: dict, the result (see __init__), or None if stopped before it could be committed.
+        """
+        result = {'seq': entry['seq'], 'action': entry['action'], 'id': entry['id'], 'ok': True, 'error': None}
+        attempt = 0
+        while True:
+            try:
+                result['id'] = self._commit(entry)
+                return result
+            except LookupError as exc:
+                lg.warning('Defect save %s was not made: %s', entry['seq'], exc)
+                result.update(ok=False, error=str(exc))
+                return result
+            except retry_errors as exc:
+                delay = self.retry_delays[min(attempt, len(self.retry_delays) - 1)]
+                attempt += 1
+                lg.warning('Defect save %s failed (attempt %s), trying again in %s s: %s', entry['seq'], attempt, delay,
+                           exception_one_line(exc))
+            except Exception as exc:
+                lg.error('Defect save %s failed and will not be tried again: %s %s', entry['seq'], entry,
+                         exception_one_line(exc))
+                result.update(ok=False, error=f'{type(exc).__name__}: {exc}')
+                return result
+            finally:
+                DefectModel.session.remove()
+            with self._lock:
+                if self._changed.wait_for(lambda: self._stopping, timeout=delay):
+                    return None
+
+    def _commit(self, entry):
+        """Write a save to the database.
+
+        :param entry: dict, the journal entry.
+        :return: int, the defect id.
+        :raises LookupError: when the defect to patch doesn't exist.
+        """
+        values = _decode_values(entry['values'])
+        if entry['action'] == 'patch':
+            row = DefectModel.patch(entry['id'], values)
+            if row is None:
+                raise LookupError(f'Defect {entry["id"]} no longer exists.')
+            if self.mirror is not None:
+                try:
+                    self.mirror.write_through(row._mapping)
+                except Exception as exc:
+                    lg.error('Could not write defect %s through to the local mirror: %s', entry['id'],
+                             exception_one_line(exc))
+            return entry['id']
+        if entry.get('replayed'):
+            existing_id = self._find_inserted(values)
+            if existing_id is not None:
+                lg.info('Defect save %s was inserted before the restart, as id %s.', entry['seq'], existing_id)
+                return existing_id
+        return DefectModel.bulk_insert([values])[0]
+
+    @staticmethod
+    def _find_inserted(values):
+        """Get the id of a defect inserted from these values, by its entry_created_ts and laminator.
+
+        :param values: dict, of {column name: value}
+        :return: int or None
+        """
+        query = sqlalchemy.select(DefectModel.id).where(
+            DefectModel.entry_created_ts == values['entry_created_ts'],
+            DefectModel.lam_num.is_not_distinct_from(values.get('lam_num')))
+        return DefectModel.session.execute(query).scalars().first()
@@ -1,4 +1,5 @@
 import tkinter
+from collections import deque
 
 
 def upsert_subscriber(self, subscriber, update_method):
@@ -239,6 +240,66 @@ class PublishingLengthList(list, metaclass=PublishListMetaWrap):
             return gotitem
 
 
+class SubscribableDeque(deque):
+    """A collections.deque that notifies subscribers when items are added.
+
+    Used as the flask -> popup inbox so the tkinter mainloop can be woken up as soon as a message arrives instead of
+    polling the deque on a timer. The subscriber callables are run on the thread that added the item, so they should
+    only hand off to their own thread (ex: tkinter event_generate) and return quickly.
+
+    ex:
+        > inbox = SubscribableDeque()
+        > inbox.subscribe('any subscriber object', lambda: print('new message'))
+        > inbox.append({'action': 'show'})
+        new message
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._deque_subscribers = {}
+
+    def subscribe(self, subscriber, notify_method):
+        """Subscribe to items being added to the deque.
+
+        :param subscriber: object, used to prevent multiple subscription and allow for changing the notify_method.
+        :param notify_method: callable, called without parameters after items are added.
+        :return: str, either 'subscriber added' or 'subscriber updated' if the subscriber was already subscribed.
+        """
+        sub_id = id(subscriber)
+        result = 'subscriber updated' if sub_id in self._deque_subscribers else 'subscriber added'
+        self._deque_subscribers[sub_id] = notify_method
+        return result
+
+    def unsubscribe(self, subscriber):
+        """Remove a subscriber from the subscriber list.
+
+        :param subscriber: any, the subscriber to remove.
+        :return: bool, if the subscriber was found will return True, if they were not found False
+        """
+        return self._deque_subscribers.pop(id(subscriber), None) is not None
+
+    def publish(self):
+        """Notify the subscribers that there are items waiting."""
+        for notify_method in tuple(self._deque_subscribers.values()):
+            notify_method()
+
+    def append(self, item):
+        super().append(item)
+        self.publish()
+
+    def appendleft(self, item):
+        super().appendleft(item)
+        self.publish()
+
+    def extend(self, items):
+        super().extend(items)
+        self.publish()
+
+    def extendleft(self, items):
+        super().extendleft(items)
+        self.publish()
+
+
 if __name__ == '__main__':
     # some rough testing
     a_list = PublishingLengthList((1, 2, 3))
@@ -0,0 +1,132 @@
+"""Recompute defect lengths from the Mahlo meter count (MdMeterCount) history.
+
+The Ignition defect script records the length of a defect as end_length - start_length. The meter counter resets at
+roll change, so a defect that spans a reset gets a wrong (often negative) length. Here the counter history is turned
+into the total distance travelled, counting each reset as the counter starting again from 0, and the length of each
+defect is the distance travelled between its start and end.
+
+The counter is a float and can dip slightly between samples, so only a drop to below reset_fraction of the previous
+count is a reset. Smaller drops count as no distance. Samples without a count (NULL floatvalue) are skipped.
+"""
+import numpy as np
+
+reset_fraction = 0.5  # a count below this fraction of the previous count is a reset, not a dip
+
+
+class DefectLengthCalculator:
+    """Calculates the meters travelled during many defect windows from a streamed meter count history.
+
+    Feed it the meter count history in t_stamp order, a chunk at a time (see TagHistoryConnector.iter_range), then get
+    the lengths. Each chunk is handled with vectorized numpy operations and only the distance at each window boundary
+    is kept, so the full history never has to be held in memory.
+
+    ex:
+        > calculator = DefectLengthCalculator(starts, ends)
+        > for t_stamps, counts in thist.iter_range('length', first_start, last_end, as_arrays=True):
+        >     calculator.add_chunk(t_stamps, counts)
+        > lengths = calculator.lengths()
+    """
+
+    def __init__(self, window_starts, window_ends):
+        """Initialize a new instance.
+
+        :param window_starts: array-like, of int t_stamps (epoch ms) for the start of each defect.
+        :param window_ends: array-like, of int t_stamps (epoch ms) for the end of each defect.
+        """
+
+        window_starts = np.asarray(window_starts, dtype=np.int64)
+        window_ends = np.asarray(window_ends, dtype=np.int64)
+        self._window_count = len(window_starts)
+        boundaries = np.concatenate((window_starts, window_ends))
+        self._order = np.argsort(boundaries, kind='stable')
+        self._boundaries = boundaries[self._order]
+        self._boundary_distance = np.full(len(boundaries), np.nan)
+        self._next_boundary = 0  # boundaries before this index have their distance set
+        self._last_count = None
+        self._distance = 0.0  # total distance travelled at the last sample seen
+
+    def add_chunk(self, t_stamps, meter_counts):
+        """Add the next chunk of meter count history.
+
+        :param t_stamps: numpy.ndarray, of int t_stamps in increasing order, after those of the previous chunk.
+        :param meter_counts: numpy.ndarray, of the meter count at each t_stamp, nan where there is no count.
+        """
+
+        meter_counts = np.asarray(meter_counts, dtype=np.float64)
+        counted = np.isfinite(meter_counts)
+        t_stamps, meter_counts = np.asarray(t_stamps)[counted], meter_counts[counted]
+        if not len(t_stamps):
+            return
+        previous = meter_counts[0] if self._last_count is None else self._last_count
+        previous_counts = np.concatenate(([previous], meter_counts[:-1]))
+        steps = meter_counts - previous_counts
+        resets = meter_counts < previous_counts * reset_fraction
+        steps[resets] = meter_counts[resets]  # after a reset the counter counted up from 0
+        steps[~resets & (steps < 0)] = 0.0  # a dip in the counter, not a reset
+        distance = self._distance + np.cumsum(steps)
+
+        # boundaries between the previous chunk and this one get the distance at the end of the previous chunk
+        first_in_chunk = np.searchsorted(self._boundaries, t_stamps[0], side='left')
+        if self._last_count is not None:
+            self._boundary_distance[self._next_boundary:first_in_chunk] = self._distance
+        self._next_boundary = max(self._next_boundary, first_in_chunk)
+
+        # boundaries within this chunk get the distance at the last sample at or before them
+        after_chunk = np.searchsorted(self._boundaries, t_stamps[-1], side='right')
+        in_chunk = self._boundaries[self._next_boundary:after_chunk]
+        sample_index = np.searchsorted(t_stamps, in_chunk, side='right') - 1
+        self._boundary_distance[self._next_boundary:after_chunk] = distance[sample_index]
+        self._next_boundary = after_chunk
+
+        self._last_count = meter_counts[-1]
+        self._distance = distance[-1]
+
+    def lengths(self):
+        """Get the length of each defect window, in the order they were provided.
+
+        Boundaries after the last sample use the last sample. Windows starting before the first sample are nan.
+
+        :return: numpy.ndarray, of float meters rounded to 2 places.
+        """
+
+        boundary_distance = self._boundary_distance.copy()
+        if self._last_count is not None:
+            boundary_distance[self._next_boundary:] = self._distance
+        unsorted = np.empty_like(boundary_distance)
+        unsorted[self._order] = boundary_distance
+        starts, ends = unsorted[:self._window_count], unsorted[self._window_count:]
+        return np.round(ends - starts, 2)
+
+
+def defect_lengths(t_stamps, meter_counts, window_starts, window_ends):
+    """Get the length of each defect window from a meter count history that is already in memory.
+
+    :param t_stamps: array-like, of int t_stamps in increasing order.
+    :param meter_counts: array-like, of the meter count at each t_stamp.
+    :param window_starts: array-like, of int t_stamps for the start of each defect.
+    :param window_ends: array-like, of int t_stamps for the end of each defect.
+    :return: numpy.ndarray, of float meters rounded to 2 places.
+    """
+
+    calculator = DefectLengthCalculator(window_starts, window_ends)
+    calculator.add_chunk(np.asarray(t_stamps, dtype=np.int64), meter_counts)
+    return calculator.lengths()
+
+
+def lengths_from_history(thist, window_starts, window_ends, chunk_size=50_000):
+    """Get the length of each defect window by streaming the meter count history from the tag history database.
+
+    :param thist: TagHistoryConnector, for the laminator the defects are from.
+    :param window_starts: array-like, of int t_stamps for the start of each defect.
+    :param window_ends: array-like, of int t_stamps for the end of each defect.
+    :param chunk_size: int, the number of history rows to handle at a time.
+    :return: numpy.ndarray, of float meters rounded to 2 places, nan where there is no history for the window.
+    """
+
+    calculator = DefectLengthCalculator(window_starts, window_ends)
+    if len(window_starts):
+        first_start, last_end = int(np.min(window_starts)), int(np.max(window_ends))
+        for t_stamps, meter_counts in thist.iter_range('length', first_start, last_end + 1, chunk_size=chunk_size,
+                                                       as_arrays=True, include_prior=True):
+            calculator.add_chunk(t_stamps, meter_counts)
+    return calculator.lengths()
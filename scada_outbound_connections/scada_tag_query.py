@@ -1,11 +1,30 @@
 """To query the Ignition tag history database."""
+import contextlib
+import datetime
+import itertools
+import threading
+import time
+from concurrent import futures
+from typing import NamedTuple, Optional
 
-from psycopg2 import connect, sql
+from psycopg2 import errors, InterfaceError, OperationalError, ProgrammingError
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
 from log_and_alert.log_setup import lg
 from untracked_config.configuration_data import connection_dict
 
 
+class TagSnapshot(NamedTuple):
+    """The latest value of each of a machine's tags, from a single query. Fields not requested are None."""
+
+    lot_number: Optional[str] = None
+    length: Optional[float] = None
+    shift_number: Optional[int] = None
+    recipe: Optional[str] = None
+    file_name: Optional[str] = None
+    tabcode: Optional[int] = None
+
+
 class TagIds:
     """A class to hold tag ids."""
 
@@ -34,6 +53,14 @@ class TagIds:
             # for development
             self._tag_set_dict['lam0'] = self._tag_set_dict['lam1']
 
+    def fields(self):
+        """Get the field names for this tag set.
+
+        :return: tuple, of str
+        """
+
+        return tuple(self._tag_set_dict[self._tag_set].keys())
+
     def process_paths(self, paths_to_id_function):
         """Process the tag ilike string to a tag id using the provided function.
 
@@ -46,19 +73,328 @@ class TagIds:
             setattr(self, field, _tag_id)
 
 
+def to_t_stamp(moment):
+    """Convert a datetime to an Ignition tag history t_stamp (milliseconds since the epoch).
+
+    :param moment: datetime.datetime or int, naive datetimes are local time. Ints are returned as they are.
+    :return: int
+    """
+
+    if isinstance(moment, datetime.datetime):
+        return int(moment.timestamp() * 1000)
+    return int(moment)
+
+
+def rows_to_arrays(rows, value_column=None):
+    """Convert tag history rows to numpy arrays of the t_stamps and values.
+
+    :param rows: list, of sqlth_1_data rows (tagid, intvalue, floatvalue, stringvalue, datevalue, dataintegrity,
+        t_stamp).
+    :param value_column: int, (optional) the row index of the value. Default None, use the first of floatvalue,
+        intvalue, or stringvalue that is not null in each row.
+    :return: tuple, (numpy.ndarray of int64 t_stamps, numpy.ndarray of values)
+    """
+    import numpy as np
+
+    t_stamps = np.fromiter((row[6] for row in rows), dtype=np.int64, count=len(rows))
+    if value_column is None:
+        values = [row[2] if row[2] is not None else row[1] if row[1] is not None else row[3] for row in rows]
+    else:
+        values = [row[value_column] for row in rows]
+    if value_column == 3 or any(isinstance(value, str) for value in values):
+        return t_stamps, np.array(values, dtype=object)
+    return t_stamps, np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+class TagValueCache:
+    """A time-to-live cache for tag history query results.
+
+    Concurrent requests for a key that is not cached are collapsed into one load; the other callers wait for and share
+    its result. Hit, miss, and collapsed counts are kept for checking how well the cache is working.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """Initialize a new instance.
+
+        :param clock: callable, returns the current time in seconds. For testing.
+        """
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}  # key: (expiry time, value)
+        self._in_flight = {}  # key: concurrent.futures.Future of the load running for it
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+
+    def get(self, key, ttl, load):
+        """Get the value for the key, calling load() to get it if it is not cached or has expired.
+
+        :param key: hashable, the cache key.
+        :param ttl: float, seconds a loaded value stays valid. 0 or less is never cached.
+        :param load: callable, without parameters, that returns the value.
+        :return: any, the value.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self.hits += 1
+                return entry[1]
+            loading = self._in_flight.get(key)
+            if loading is None:
+                self.misses += 1
+                loading = self._in_flight[key] = futures.Future()
+                is_loader = True
+            else:
+                self.collapsed += 1
+                is_loader = False
+
+        if not is_loader:
+            return loading.result()
+
+        try:
+            value = load()
+        except BaseException as exc:
+            loading.set_exception(exc)
+            raise
+        else:
+            self.put(key, ttl, value)
+            loading.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def peek(self, key):
+        """Get the value for the key if it is cached and not expired, without loading it.
+
+        :param key: hashable, the cache key.
+        :return: tuple, (bool, any), whether the value was found and the value (None if not).
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+        return False, None
+
+    def put(self, key, ttl, value):
+        """Cache the value for the key for ttl seconds."""
+
+        if ttl > 0:
+            with self._lock:
+                self._entries[key] = (self._clock() + ttl, value)
+
+    def invalidate(self, key=None):
+        """Remove the key, or everything if key is None, from the cache."""
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_matching(self, key_test):
+        """Remove the keys that key_test(key) returns True for from the cache."""
+
+        with self._lock:
+            for key in [key for key in self._entries if key_test(key)]:
+                del self._entries[key]
+
+    def stats(self):
+        """Get the cache counters.
+
+        :return: dict
+        """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'collapsed': self.collapsed,
+                    'entries': len(self._entries)}
+
+
 class DatabaseConnection:
-    """A database connection template."""
+    """A pooled database connection template.
+
+    Each query checks out its own connection and cursor from a thread safe pool, so more than one thread can query at
+    the same time. Connections are checked before use and queries that fail because the connection dropped are retried
+    on a new connection with an increasing delay between attempts.
+    """
+
+    min_connections = 1
+    max_connections = 4
+    retries = 3
+    retry_backoff = 0.5  # seconds, doubles each retry
+    max_backoff = 10
+    health_check_idle = 30  # seconds a connection can sit unused before it is checked with a query
+
+    # {name: (parameter types, query with %s parameters)} to PREPARE once per connection and run with fetchall_prepared
+    prepared_statements = {}
+    use_prepared_statements = True
 
-    def __init__(self, connection_dictionary=None, *args, **kwargs):
+    def __init__(self, connection_dictionary=None, *args, min_connections=None, max_connections=None, retries=None,
+                 **kwargs):
         """Initialize a new instance.
 
         :param connection_dictionary: dict, required parameters to pass to psycopg2.connect().
+        :param min_connections: int, (optional) connections the pool keeps open.
+        :param max_connections: int, (optional) the most connections the pool will open at once.
+        :param retries: int, (optional) how many times to retry a query after a connection failure.
         """
 
         connection_dictionary = connection_dict if (connection_dictionary is None) else connection_dictionary
-        self.cnn = connect(*args, **connection_dictionary, **kwargs)
-        self.cnn.autocommit = True
-        self.crs = self.cnn.cursor()
+        self.min_connections = self.min_connections if min_connections is None else min_connections
+        self.max_connections = self.max_connections if max_connections is None else max_connections
+        self.retries = self.retries if retries is None else retries
+        self._connect_args = args
+        self._connect_kwargs = {**connection_dictionary, **kwargs}
+        self._last_used = {}  # id(connection): time.monotonic() it was returned to the pool
+        self._prepared = {}  # id(connection): set of the statement names prepared on it
+        self._pool = ThreadedConnectionPool(self.min_connections, self.max_connections, *self._connect_args,
+                                            **self._connect_kwargs)
+
+    def _is_healthy(self, cnn):
+        """Check that a connection from the pool is still usable."""
+
+        if cnn.closed:
+            return False
+        try:
+            # before the check, its SELECT would begin a transaction and autocommit can't be set inside one
+            cnn.autocommit = True
+            idle_since = self._last_used.get(id(cnn))
+            if idle_since is None or time.monotonic() - idle_since > self.health_check_idle:
+                with cnn.cursor() as crs:
+                    crs.execute('SELECT 1')
+        except (OperationalError, InterfaceError, ProgrammingError):
+            return False
+        return True
+
+    def _backoff(self, attempt):
+        time.sleep(min(self.retry_backoff * 2 ** attempt, self.max_backoff))
+
+    def _get_connection(self):
+        """Check out a healthy connection, waiting and reconnecting as needed.
+
+        :return: psycopg2.extensions.connection
+        :raises ConnectionError: if a connection cannot be made after the retries.
+        """
+
+        last_error = None
+        for attempt in range(self.retries + 1):
+            try:
+                cnn = self._pool.getconn()
+                if self._is_healthy(cnn):
+                    return cnn
+                lg.warning('Discarding a dropped tag history connection.')
+                self._return_connection(cnn, discard=True)
+                last_error = 'connection dropped'
+                continue  # try again right away with a new connection
+            except (OperationalError, PoolError) as err:
+                last_error = err
+                lg.warning('Could not get a tag history connection (attempt %s): %s', attempt + 1, err)
+            self._backoff(attempt)
+        raise ConnectionError(f'Unable to connect to the tag history database: {last_error}')
+
+    def _return_connection(self, cnn, discard=False):
+        if discard:
+            self._last_used.pop(id(cnn), None)
+            self._prepared.pop(id(cnn), None)
+        else:
+            self._last_used[id(cnn)] = time.monotonic()
+        self._pool.putconn(cnn, close=discard)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Get a cursor on a connection checked out for the with block.
+
+        A connection that fails is closed instead of being returned to the pool.
+
+        :return: psycopg2.extensions.cursor
+        """
+
+        cnn = self._get_connection()
+        discard = False
+        try:
+            with cnn.cursor() as crs:
+                yield crs
+        except (OperationalError, InterfaceError):
+            discard = True
+            raise
+        finally:
+            self._return_connection(cnn, discard=discard)
+
+    def fetchall(self, query, parameters=None):
+        """Execute the query and get all the rows, retrying on a new connection if the connection drops.
+
+        Only use this with queries that are safe to repeat (SELECT).
+
+        :param query: str, the query.
+        :param parameters: tuple or dict, (optional) the query parameters.
+        :return: list, of tuples
+        """
+
+        def execute_query(crs):
+            crs.execute(query, parameters)
+            return crs.fetchall()
+
+        return self._with_retries(execute_query)
+
+    def fetchall_prepared(self, name, parameters):
+        """Execute one of the prepared_statements and get all the rows, preparing it on the connection if needed.
+
+        The server parses and plans a prepared statement once per connection instead of for every query.
+
+        :param name: str, the prepared_statements key.
+        :param parameters: tuple, the query parameters.
+        :return: list, of tuples
+        """
+
+        parameter_types, query = self.prepared_statements[name]
+        if not self.use_prepared_statements:
+            return self.fetchall(query, parameters)
+        execute_statement = f'EXECUTE {name} ({", ".join(["%s"] * len(parameters))})'
+
+        def execute_prepared(crs):
+            prepared = self._prepared.setdefault(id(crs.connection), set())
+            if name not in prepared:
+                self._prepare(crs, name, parameter_types, query)
+                prepared.add(name)
+            try:
+                crs.execute(execute_statement, parameters)
+            except errors.InvalidSqlStatementName:  # the server dropped it (ex: DISCARD ALL), prepare it again
+                self._prepare(crs, name, parameter_types, query)
+                crs.execute(execute_statement, parameters)
+            return crs.fetchall()
+
+        return self._with_retries(execute_prepared)
+
+    @staticmethod
+    def _prepare(crs, name, parameter_types, query):
+        """PREPARE the query, numbering its %s parameters as $1, $2, ..."""
+
+        query_parts = query.split('%s')
+        numbered_query = query_parts[0] + ''.join(f'${num}{part}' for num, part in enumerate(query_parts[1:], 1))
+        crs.execute(f'PREPARE {name} ({parameter_types}) AS {numbered_query}')
+
+    def _with_retries(self, execute):
+        """Call execute(cursor) and return its result, retrying on a new connection if the connection drops."""
+
+        for attempt in range(self.retries + 1):
+            try:
+                with self.cursor() as crs:
+                    return execute(crs)
+            except (OperationalError, InterfaceError) as err:
+                if attempt >= self.retries:
+                    raise
+                lg.warning('Tag history query failed, reconnecting (attempt %s): %s', attempt + 1, err)
+                self._backoff(attempt)
+
+    def close(self):
+        """Close all the pool's connections."""
+
+        self._pool.closeall()
 
 
 class TagHistoryConnector(DatabaseConnection):
@@ -68,17 +404,68 @@ class TagHistoryConnector(DatabaseConnection):
     string) then it will query the new tag after reinstantiation or calling .update_tag_ids().
     """
 
+    prepared_statements = {
+        'th_tag_id': ('text', r'''SELECT id FROM sqlth_te WHERE tagpath ILIKE %s AND retired IS NULL'''),
+        'th_recent_values': ('integer, integer',
+                             r'''SELECT * FROM sqlth_1_data WHERE tagid = %s ORDER BY t_stamp DESC LIMIT %s'''),
+        'th_latest_rows': ('integer[]', r'''SELECT latest.* FROM unnest(%s::integer[]) AS tags(tagid)
+                                           CROSS JOIN LATERAL (SELECT * FROM sqlth_1_data AS hist
+                                                               WHERE hist.tagid = tags.tagid
+                                                               ORDER BY hist.t_stamp DESC LIMIT 1) AS latest'''),
+        }
+
+    _shared_connectors = {}
+    _shared_lock = threading.Lock()
+
+    # the sqlth_1_data column index holding each field's value (1: intvalue, 2: floatvalue, 3: stringvalue)
+    value_columns = {'lot_number': 3, 'length': 2, 'shift_number': 1, 'recipe': 3, 'file_name': 3, 'tabcode': 1}
+
+    # seconds to reuse a field's recent values before querying again; the length changes constantly while running
+    value_ttls = {'lot_number': 5, 'length': 1, 'shift_number': 60, 'recipe': 60, 'file_name': 60, 'tabcode': 60}
+    default_ttl = 1
+
     def __init__(self, tag_set=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._history_table = sql.Identifier('sqlth_1_data')
-        self._tag_entry_table = sql.Identifier('sqlt_te')
+        self.cache = TagValueCache()
+        self._range_cursor_ids = itertools.count()
         self.tag_ids = TagIds(tag_set_tids=tag_set)
+        self._tag_id_ttls = {}
         self.update_tag_ids()
 
+    @classmethod
+    def shared(cls, tag_set):
+        """Get a connector for the tag set that is shared within this process, creating it the first time.
+
+        For the flask server, so each request does not open a new pool and look up the tag ids again.
+
+        :param tag_set: str, ex: 'lam1'
+        :return: TagHistoryConnector
+        """
+
+        with cls._shared_lock:
+            if tag_set not in cls._shared_connectors:
+                cls._shared_connectors[tag_set] = cls(tag_set)
+            return cls._shared_connectors[tag_set]
+
     def update_tag_ids(self):
         """Query the tag entry table for the tag ids matching the preset ilike strings."""
 
         self.tag_ids.process_paths(self.tag_id_query)
+        self._tag_id_ttls = {getattr(self.tag_ids, field): self.value_ttls.get(field, self.default_ttl)
+                             for field in self.tag_ids.fields()}
+        self.cache.invalidate()
+
+    def invalidate(self, field=None):
+        """Drop the cached values for a field, or for all fields if None, so the next request queries for them.
+
+        :param field: str, (optional) the TagSnapshot field name.
+        """
+
+        if field is None:
+            self.cache.invalidate()
+        else:
+            tag_id = getattr(self.tag_ids, field)
+            self.cache.invalidate_matching(lambda key: key[0] == tag_id)
 
     def tag_id_query(self, tag_path_ilike_string):
         """Get the tag id that matches the tag path string.
@@ -87,15 +474,13 @@ class TagHistoryConnector(DatabaseConnection):
         :return: int, the tag id.
         """
 
-        id_sql_query = r'''SELECT id FROM sqlth_te WHERE tagpath ILIKE %s AND retired IS NULL'''
-        self.crs.execute(id_sql_query, (tag_path_ilike_string,))
-        results = self.crs.fetchall()
+        results = self.fetchall_prepared('th_tag_id', (tag_path_ilike_string,))
         result_count = len(results)
         if result_count > 1:
             raise Warning('Multiple tags match ilike string pattern (tag_path_ilike_string): %s', tag_path_ilike_string)
         elif result_count == 0:
             raise Warning('No historized tag id found for %s', tag_path_ilike_string)
-        return results[0]
+        return results[0][0]
 
     def get_recent_lots(self, lot_count: int = 5):
         """Get lot_count most recent lot numbers in increasing age order.
@@ -115,9 +500,97 @@ class TagHistoryConnector(DatabaseConnection):
         :return: list, of 0 to lot_count tuples, each containing a row from the tag history.
         """
 
-        lot_query = sql.SQL(r'''SELECT * FROM sqlth_1_data WHERE tagid = %s ORDER BY t_stamp DESC LIMIT %s;''')
-        self.crs.execute(lot_query, (tag_id, value_count))
-        return self.crs.fetchall()
+        ttl = self._tag_id_ttls.get(tag_id, self.default_ttl)
+        return self.cache.get((tag_id, value_count), ttl, lambda: self._query_recent_values(tag_id, value_count))
+
+    def _query_recent_values(self, tag_id, value_count):
+        return self.fetchall_prepared('th_recent_values', (tag_id, value_count))
+
+    def snapshot(self, fields=None):
+        """Get the latest value of several tags with one query.
+
+        Each tag's most recent row is found with a LATERAL join, so each lookup uses the tag history's tagid/t_stamp
+        index the same as get_recent_values does. Tags with a cached most recent value are not queried.
+
+        :param fields: iterable, (optional) of TagSnapshot field names to get. Default None, all of them.
+        :return: TagSnapshot
+        """
+
+        fields = self.tag_ids.fields() if fields is None else tuple(fields)
+        field_tag_ids = {field: getattr(self.tag_ids, field) for field in fields}
+        rows_by_tag_id = {}
+        for tag_id in set(field_tag_ids.values()):
+            found, rows = self.cache.peek((tag_id, 1))
+            if found and rows:
+                rows_by_tag_id[tag_id] = rows[0]
+        tag_ids_to_query = [tag_id for tag_id in set(field_tag_ids.values()) if tag_id not in rows_by_tag_id]
+        if tag_ids_to_query:
+            rows_by_tag_id.update(self._query_latest_rows(tag_ids_to_query))
+
+        values = {}
+        for field, tag_id in field_tag_ids.items():
+            row = rows_by_tag_id.get(tag_id)
+            values[field] = row[self.value_columns[field]] if row is not None else None
+        return TagSnapshot(**values)
+
+    def _query_latest_rows(self, tag_ids):
+        """Query the most recent row of each tag, caching them for get_recent_values(tag_id, 1) as well.
+
+        :param tag_ids: list, of int tag ids.
+        :return: dict, {tag_id: row}
+        """
+
+        rows_by_tag_id = {row[0]: row for row in self.fetchall_prepared('th_latest_rows', (tag_ids,))}
+        for tag_id, row in rows_by_tag_id.items():
+            self.cache.put((tag_id, 1), self._tag_id_ttls.get(tag_id, self.default_ttl), [row])
+        return rows_by_tag_id
+
+    def iter_range(self, tag, start, end, chunk_size=10_000, as_arrays=False, include_prior=False):
+        """Stream a tag's history between two times, in t_stamp order, a chunk at a time.
+
+        A named (server-side) cursor is used so only chunk_size rows are held in memory at once, ex: a full shift of
+        MdMeterCount samples.
+
+        :param tag: str or int, a TagSnapshot field name (ex: 'length') or a tag id.
+        :param start: datetime.datetime or int, the start of the range (inclusive), int is Ignition's epoch ms t_stamp.
+        :param end: datetime.datetime or int, the end of the range (exclusive).
+        :param chunk_size: int, the number of rows to fetch from the server at a time.
+        :param as_arrays: bool, if True yield (t_stamps, values) numpy arrays instead of lists of rows. The value is
+            taken from the field's value column, or the first of float/int/string value that isn't null for a tag id.
+        :param include_prior: bool, if True also include the last row before the start, the tag's value at the start.
+        :return: generator, of lists of sqlth_1_data rows or tuples of numpy.ndarray
+        """
+
+        tag_id = tag if isinstance(tag, int) else getattr(self.tag_ids, tag)
+        value_column = None if isinstance(tag, int) else self.value_columns[tag]
+        start, end = to_t_stamp(start), to_t_stamp(end)
+        range_query = r'''SELECT tagid, intvalue, floatvalue, stringvalue, datevalue, dataintegrity, t_stamp
+                          FROM sqlth_1_data WHERE tagid = %s AND t_stamp >= %s AND t_stamp < %s ORDER BY t_stamp'''
+        if include_prior:
+            start_query = r'''COALESCE((SELECT max(t_stamp) FROM sqlth_1_data WHERE tagid = %s AND t_stamp <= %s),
+                                       %s)'''
+            range_query = range_query.replace('t_stamp >= %s', f't_stamp >= {start_query}')
+            parameters = (tag_id, tag_id, start, start, end)
+        else:
+            parameters = (tag_id, start, end)
+
+        cnn = self._get_connection()
+        cnn.autocommit = False  # named cursors only exist inside a transaction
+        discard = False
+        try:
+            with cnn.cursor(name=f'th_range_{next(self._range_cursor_ids)}') as crs:
+                crs.itersize = chunk_size
+                crs.execute(range_query, parameters)
+                while rows := crs.fetchmany(chunk_size):
+                    yield rows_to_arrays(rows, value_column) if as_arrays else rows
+        except (OperationalError, InterfaceError):
+            discard = True
+            raise
+        finally:
+            if not discard and not cnn.closed:
+                cnn.rollback()  # read only, end the transaction
+                cnn.autocommit = True
+            self._return_connection(cnn, discard=discard)
 
     def current_lot_number(self):
         """Get the current lot number.
@@ -158,3 +631,4 @@ if __name__ == '__main__':
     lg.debug(thist.current_lot_number())
     lg.debug(thist.current_mahlo_length())
     lg.debug(thist.get_current_shift_number())
+    lg.debug(thist.snapshot())
@@ -0,0 +1,87 @@
+"""Compare serializing defects the old way (ORM instances, jsonize_sqla_model's per row lookups) with RowSerializer.
+
+Runs against its own in-memory SQLite database, so it needs no server:
+    python -m tests.benchmarks.model_serializer_bench
+
+Both sides load the rows from the database and encode each one as JSON, as the /defects endpoint does.
+"""
+import datetime
+import json
+import time
+import unittest
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from flask_server_files.helpers import model_serializer, RowSerializer
+from flask_server_files.models.defect import DefectModel
+
+ROWS = 100_000
+
+
+def legacy_jsonize(model):
+    """jsonize_sqla_model as it was before RowSerializer."""
+    jdict = {}
+    for key in model.__table__.columns.keys():
+        this_val = getattr(model, key)
+        if isinstance(this_val, datetime.datetime):
+            try:
+                this_val = this_val.isoformat()
+            except AttributeError as er:
+                this_val = str(this_val)
+
+        jdict[key] = this_val
+    return jdict
+
+
+def build_table(engine):
+    DefectModel.__table__.create(engine)
+    start = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    records = [{'id': n, 'source_lot_number': f'{n:08d}', 'lam_num': n % 2 + 1, 'recipe': 'recipe', 'tabcode': '3',
+                'defect_start_ts': start + datetime.timedelta(minutes=n),
+                'defect_end_ts': start + datetime.timedelta(minutes=n, seconds=30),
+                'length_of_defect_meters': 12.5, 'entry_created_ts': start, 'entry_modified_ts': start,
+                'operator_saved_time': start, 'rem_l': True, 'rem_c': False, 'shift_number': n % 4 + 1}
+               for n in range(1, ROWS + 1)]
+    with engine.begin() as cnn:
+        cnn.execute(sqlalchemy.insert(DefectModel.__table__), records)
+
+
+class ModelSerializerBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        build_table(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def time_before(self):
+        start = time.perf_counter()
+        with Session(self.engine) as session:
+            encoded = [json.dumps(legacy_jsonize(defect)) for defect in session.query(DefectModel).all()]
+        return time.perf_counter() - start, encoded
+
+    def time_after(self, serializer):
+        start = time.perf_counter()
+        with self.engine.connect() as cnn:
+            rows = cnn.execute(sqlalchemy.select(*serializer.select_columns)).all()
+            encoded = [serializer.to_json(row) for row in rows]
+        return time.perf_counter() - start, encoded
+
+    def test_rows_per_second(self):
+        results = {}
+        results['before: ORM + jsonize_sqla_model + json'], before = self.time_before()
+        results['after: Core rows + RowSerializer + json'], after = self.time_after(
+            RowSerializer(DefectModel.__table__, fast_json=False))
+        results['after: Core rows + RowSerializer + fast json'], _ = self.time_after(model_serializer(DefectModel))
+
+        # same output, only faster
+        self.assertEqual(len(before), ROWS)
+        self.assertEqual(json.loads(before[-1]), json.loads(after[-1]))
+
+        for name, seconds in results.items():
+            print(f'{name:>45}: {ROWS / seconds:>9,.0f} rows/s ({seconds:.2f} s)')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
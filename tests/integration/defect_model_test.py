@@ -1,7 +1,11 @@
 from datetime import datetime
 
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
 from flask_server_files.helpers import jsonize_sqla_model
 from flask_server_files.models.defect import DefectModel
+from flask_server_files.models.defect_rollup import DefectRollupModel
 from tests.base_test import BaseTest
 
 
@@ -103,3 +107,97 @@ class DefectModelTest(BaseTest):
             self.assertTrue(new_defects[0].id in new_ids)
             self.assertTrue(new_defects[1].id in new_ids)
             self.assertEqual(len(new_defects), 2)
+
+    def test_defect_class_method_find_new_since(self):
+        with self.app_context():
+            defect0 = DefectModel(lam_num=1)
+            defect0.save_to_database()
+            defect1 = DefectModel(lam_num=1)
+            defect1.save_to_database()
+
+            # without a mark, every unconfirmed defect
+            new_defects = DefectModel.find_new_since(lam_number=1)
+            self.assertSetEqual({df.id for df in new_defects}, {defect0.id, defect1.id})
+            last_id = max(df.id for df in new_defects)
+
+            # nothing has changed past the mark
+            self.assertListEqual(DefectModel.find_new_since(lam_number=1, since_id=last_id), [])
+
+            # a new defect and a confirmed one are both past the mark, the untouched one is not
+            mark = datetime.now().astimezone()
+            defect2 = DefectModel(lam_num=1)
+            defect2.save_to_database()
+            defect0.operator_saved_time = datetime.now().astimezone()
+            defect0.save_to_database()
+            changed = DefectModel.find_new_since(lam_number=1, since_id=last_id, since_modified=mark)
+            changed_ids = {df.id for df in changed}
+            self.assertSetEqual(changed_ids, {defect0.id, defect2.id})
+
+    def test_find_new_uses_unconfirmed_index(self):
+        with self.app_context():
+            for lam_num in (1, 2):
+                DefectModel(lam_num=lam_num).save_to_database()
+
+            # a handful of rows will always seq scan, make the planner show whether the index can serve the query
+            DefectModel.session.execute(text('SET enable_seqscan = off'))
+            for lam_number in (None, 1):
+                query = DefectModel.new_query(lam_number).statement.compile(dialect=postgresql.dialect(),
+                                                                            compile_kwargs={'literal_binds': True})
+                plan = '\n'.join(row[0] for row in DefectModel.session.execute(text(f'EXPLAIN {query}')))
+                self.assertIn('ix_defect_records_unconfirmed_lam_created', plan)
+                self.assertNotIn('Seq Scan', plan)
+            DefectModel.session.execute(text('RESET enable_seqscan'))
+
+    def test_find_new_since_uses_indexes(self):
+        with self.app_context():
+            for lam_num in (1, 2):
+                DefectModel(lam_num=lam_num).save_to_database()
+
+            DefectModel.session.execute(text('SET enable_seqscan = off'))
+            query = DefectModel.since_query(1, since_id=1, since_modified=datetime.now().astimezone())
+            query = query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+            plan = '\n'.join(row[0] for row in DefectModel.session.execute(text(f'EXPLAIN {query}')))
+            self.assertIn('ix_defect_records_lam_modified', plan)
+            self.assertNotIn('Seq Scan', plan)
+            DefectModel.session.execute(text('RESET enable_seqscan'))
+
+    def test_defect_class_method_mark_all_confirmed(self):
+        with self.app_context():
+            for lam_num in (1, 1, 2):
+                DefectModel(source_lot_number='lot', lam_num=lam_num).save_to_database()
+
+            self.assertEqual(DefectModel.mark_all_confirmed(lam_number=1), 2)
+            self.assertEqual([df.lam_num for df in DefectModel.find_new()], [2])
+            self.assertEqual(DefectModel.mark_all_confirmed(), 1)
+            self.assertEqual(DefectModel.mark_all_confirmed(), 0)
+
+    def test_defect_class_method_summarize(self):
+        with self.app_context():
+            for lam_num, length in ((1, 2.5), (1, 3.0), (2, 4.0)):
+                DefectModel(source_lot_number='lot', lam_num=lam_num, length_of_defect_meters=length).save_to_database()
+
+            rows = DefectModel.summarize(('lam_num',), bucket='day')
+            self.assertEqual([(row.lam_num, row.defect_count, row.total_meters) for row in rows],
+                             [(1, 2, 5.5), (2, 1, 4.0)])
+
+    def test_rollup_follows_every_write(self):
+        with self.app_context():
+            DefectRollupModel.__table__.create(DefectModel.session.get_bind(), checkfirst=True)
+            DefectRollupModel.rebuild()
+
+            defect = DefectModel.new_defect(source_lot_number='lot', lam_num=1, length_of_defect_meters=2.0)
+            defect.shift_number = 2
+            defect.save_to_database()
+            record = {'source_lot_number': 'lot', 'lam_num': 2, 'length_of_defect_meters': 1.5}
+            ids = DefectModel.bulk_insert([record] * 3)
+            DefectModel.patch(ids[0], {'mahlo_start_length': 1.0, 'mahlo_end_length': 4.0})
+            DefectModel.mark_all_confirmed(lam_number=2)
+            DefectModel.bulk_update_lengths({ids[1]: 10.0})
+
+            def rollup():
+                return sorted(tuple(row) for row in DefectRollupModel.summarize(('lam_num', 'shift_number')))
+
+            self.assertEqual(rollup(), [(1, 2, 1, 2.0, 0), (2, 0, 3, 14.5, 3)])
+            DefectRollupModel.rebuild(batch_size=2)
+            self.assertEqual(rollup(), [(1, 2, 1, 2.0, 0), (2, 0, 3, 14.5, 3)])
+            DefectRollupModel.__table__.drop(DefectModel.session.get_bind())
@@ -1,3 +1,4 @@
+from flask_server_files.models.defect import DefectModel
 from tests.base_test import BaseTest
 
 
@@ -14,6 +15,43 @@ class FlaskEndpointsTest(BaseTest):
 
             self.assertEqual(response.json, {})
 
+    def test_defects_keyset_pages(self):
+        with self.app_context():
+            for i in range(5):
+                DefectModel(source_lot_number=f'lot{i}').save_to_database()
+
+            first = self.app.get(r'/defects?limit=3', json={}).json
+            self.assertEqual(len(first['results_dict']), 3)
+            self.assertIsNotNone(first['next_after_id'])
+
+            second = self.app.get(rf'/defects?limit=3&after_id={first["next_after_id"]}', json={}).json
+            self.assertEqual(len(second['results_dict']), 2)
+            self.assertIsNone(second['next_after_id'])
+            self.assertFalse(set(first['results_dict']) & set(second['results_dict']))
+
+    def test_defects_bulk_insert(self):
+        with self.app_context():
+            records = [{'source_lot_number': 'lot1', 'lam_num': 1}, {'lam_num': 2}, {'source_lot_number': 'lot3'}]
+            response = self.app.post(r'/defects/bulk', json=records)
+
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual([result['status'] for result in response.json['results']],
+                             ['created', 'invalid', 'created'])
+            new_id = response.json['results'][2]['id']
+            self.assertEqual(DefectModel.find_by_id(new_id).source_lot_number, 'lot3')
+
+    def test_defect_patch(self):
+        with self.app_context():
+            defect = DefectModel(source_lot_number='lot1', mahlo_start_length=10.5)
+            defect.save_to_database()
+
+            response = self.app.patch(r'/defect', json={'id': defect.id, 'mahlo_end_length': 25.25})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['length_of_defect_meters'], 14.75)
+
+            response = self.app.patch(r'/defect', json={'id': defect.id + 1, 'tabcode': '3'})
+            self.assertEqual(response.status_code, 404)
+
     def test_popup_operational(self):
         with self.app_context():
             response = self.app.get(r'/popup_operational_check')
@@ -0,0 +1,43 @@
+import unittest
+
+import flask
+
+from flask_server_files.conditional_get import ConditionalResponses
+
+
+class ConditionalResponsesTests(unittest.TestCase):
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.responses = ConditionalResponses()
+        self.generated = 0
+
+    def generate_body(self):
+        self.generated += 1
+        yield '{"rows": '
+        yield '[1, 2, 3]}'
+
+    def get(self, etag, if_none_match=None):
+        headers = {'If-None-Match': f'"{if_none_match}"'} if if_none_match else {}
+        with self.app.test_request_context(headers=headers):
+            response = self.responses.respond(etag, self.generate_body)
+            return response.status_code, response.get_data(), response.get_etag()[0]
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.responses.etag('lam1', 5)
+        self.assertEqual(self.get(etag), (200, b'{"rows": [1, 2, 3]}', etag))
+        self.assertEqual(self.get(etag, if_none_match=etag), (304, b'', etag))
+        self.assertEqual(self.generated, 1)
+
+    def test_repeat_polls_are_served_from_the_cache(self):
+        etag = self.responses.etag('lam1', 5)
+        for _ in range(3):
+            self.assertEqual(self.get(etag)[1], b'{"rows": [1, 2, 3]}')
+        self.assertEqual(self.generated, 1)
+
+        # a new version of the rows is generated
+        self.get(self.responses.etag('lam1', 6))
+        self.assertEqual(self.generated, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import datetime
+import types
+import unittest
+from unittest import mock
+
+import flask
+
+from flask_server_files.models.defect import DefectModel
+from flask_server_files.resources import defect
+from flask_server_files.resources.defect import DefectLengths, validate_defect_record
+
+
+class ValidateDefectRecordTests(unittest.TestCase):
+    def test_values_are_converted_to_the_column_types(self):
+        values, errors = validate_defect_record({'source_lot_number': 12345, 'lam_num': '2', 'rem_l': 'true',
+                                                 'length_of_defect_meters': 3, 'defect_start_ts': '2023-09-01T06:30:00',
+                                                 'tabcode': None})
+        self.assertEqual(errors, [])
+        self.assertEqual(values, {'source_lot_number': '12345', 'lam_num': 2, 'rem_l': True,
+                                  'length_of_defect_meters': 3.0,
+                                  'defect_start_ts': datetime.datetime(2023, 9, 1, 6, 30)})
+
+    def test_every_problem_is_reported(self):
+        values, errors = validate_defect_record({'lam_num': True, 'rem_c': 'maybe', 'defect_end_ts': 'yesterday',
+                                                 'id': 5, 'not_a_column': 1})
+        self.assertIsNone(values)
+        self.assertEqual(len(errors), 6)
+
+    def test_a_record_must_be_an_object(self):
+        self.assertEqual(validate_defect_record(['lot1'])[0], None)
+
+
+class DefectLengthsTests(unittest.TestCase):
+    def test_defects_without_an_end_are_skipped(self):
+        start = datetime.datetime(2023, 9, 1, 8)
+        windows = [types.SimpleNamespace(id=1, defect_start_ts=start, defect_end_ts=start + datetime.timedelta(hours=1),
+                                         length_of_defect_meters=0.0),
+                   types.SimpleNamespace(id=2, defect_start_ts=start, defect_end_ts=None, length_of_defect_meters=0.0)]
+        with mock.patch.object(DefectModel, 'session'), \
+                mock.patch.object(DefectModel, 'get_defect_windows', return_value=windows), \
+                mock.patch.object(DefectModel, 'bulk_update_lengths', side_effect=len) as bulk_update_lengths, \
+                mock.patch.object(defect.TagHistoryConnector, 'shared'), \
+                mock.patch.object(defect, 'lengths_from_history', return_value=[12.5]) as lengths_from_history, \
+                flask.Flask(__name__).test_request_context(method='POST', json={
+                    'start_date': '2023-09-01', 'end_date': '2023-09-02', 'lam_num': 1}):
+            response, status = DefectLengths().post()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(lengths_from_history.call_args.args[1]), 1)
+        bulk_update_lengths.assert_called_once_with({1: 12.5})
+        self.assertEqual(response[1], {'checked': 1, 'skipped': 1, 'updated': 1, 'updated_lengths': {1: 12.5}})
+
+    def test_laminator_0_is_not_every_laminator(self):
+        with mock.patch.object(DefectModel, 'session'), \
+                mock.patch.object(DefectModel, 'get_defect_windows', return_value=[]) as get_defect_windows, \
+                mock.patch.object(defect.TagHistoryConnector, 'shared'), \
+                mock.patch.object(defect, 'lengths_from_history', return_value=[]), \
+                flask.Flask(__name__).test_request_context(method='POST', json={
+                    'start_date': '2023-09-01', 'end_date': '2023-09-02', 'lam_num': 0}):
+            response, status = DefectLengths().post()
+
+        self.assertEqual(status, 200)
+        self.assertEqual([call.args[2] for call in get_defect_windows.call_args_list], [0])
+        self.assertEqual(list(response), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
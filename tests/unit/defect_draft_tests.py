@@ -0,0 +1,29 @@
+import unittest
+from unittest import mock
+
+from flask_server_files.models.defect import DefectModel
+from msg_window.defect_draft import DefectDraft
+
+
+class TestDefectDraft(unittest.TestCase):
+    def setUp(self):
+        self.draft = DefectDraft.from_model(DefectModel(id=7, source_lot_number='123', rolls_of_product_post_slit=3))
+
+    def test_only_changed_columns(self):
+        self.assertEqual(self.draft.changes(), {})
+        self.draft.rolls_of_product_post_slit = 4
+        self.draft.rem_l = True
+        self.draft.source_lot_number = '123'
+        self.assertEqual(self.draft.changes(), {'rolls_of_product_post_slit': 4, 'rem_l': True})
+
+    def test_save_queues_one_patch(self):
+        self.draft.defect_type = 'puckering'
+        save_queue = mock.Mock()
+        save_queue.patch.return_value = 1
+        self.assertEqual(self.draft.save(save_queue, operator_initials='ABC'), 1)
+        save_queue.patch.assert_called_once_with(7, {'defect_type': 'puckering', 'operator_initials': 'ABC'})
+        self.assertEqual(self.draft.changes(), {})
+        self.assertEqual(self.draft.operator_initials, 'ABC')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import datetime
+import unittest
+from unittest import mock
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from flask_server_files.models.defect import DefectModel
+from flask_server_files.models.defect_rollup import DefectRollupModel
+
+
+def compile_pg(clause):
+    return str(clause.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+
+class TestFindNewQuery(unittest.TestCase):
+    def test_where_clause_is_built_in_sql(self):
+        where = compile_pg(DefectModel.new_query().statement.whereclause)
+        self.assertEqual(where, 'laminator_foam_defect_removal_records.operator_saved_time IS NULL')
+
+    def test_where_clause_with_lam_number(self):
+        where = compile_pg(DefectModel.new_query(lam_number=2).statement.whereclause)
+        self.assertEqual(where, 'laminator_foam_defect_removal_records.operator_saved_time IS NULL AND '
+                                'laminator_foam_defect_removal_records.lam_num = 2')
+
+    def test_unconfirmed_index_is_partial(self):
+        ddl = compile_pg(CreateIndex(DefectModel.unconfirmed_index))
+        self.assertIn('(lam_num, entry_created_ts)', ddl)
+        self.assertIn('WHERE operator_saved_time IS NULL', ddl)
+
+
+    def test_since_query_is_an_or_of_index_ranges(self):
+        since = datetime.datetime(2023, 9, 1, 8)
+        query = DefectModel.since_query(lam_number=1, since_id=5, since_modified=since)
+        self.assertEqual(compile_pg(query.statement.whereclause),
+                         "(laminator_foam_defect_removal_records.id > 5 OR "
+                         "laminator_foam_defect_removal_records.entry_modified_ts > '2023-09-01 08:00:00') AND "
+                         "laminator_foam_defect_removal_records.lam_num = 1")
+        self.assertEqual([column.name for column in DefectModel.modified_index.columns],
+                         ['lam_num', 'entry_modified_ts'])
+
+
+class TestSummaryGroups(unittest.TestCase):
+    def test_time_bucket_is_the_same_expression_in_the_group_by(self):
+        groups = DefectModel.summary_groups(('lam_num',), bucket='week')
+        query = compile_pg(sqlalchemy.select(*groups, sqlalchemy.func.count()).group_by(*groups))
+        self.assertEqual(query.count("date_trunc('week', laminator_foam_defect_removal_records.defect_start_ts)"), 2)
+
+    def test_only_known_groups(self):
+        for group_by, bucket in ((('id',), None), ((), 'year')):
+            with self.assertRaises(ValueError):
+                DefectModel.summary_groups(group_by, bucket)
+
+
+class TestBulkWrites(unittest.TestCase):
+    # only statements that SQLAlchemy 1.4 executes the same way
+    def setUp(self):
+        session_patch = mock.patch.object(DefectModel, 'session')
+        self.session = session_patch.start()
+        self.addCleanup(session_patch.stop)
+        self.session.get_bind.return_value.dialect.name = 'postgresql'
+        for owner, attribute in ((DefectModel, 'get_rollup_rows'), (DefectRollupModel, 'apply_changes')):
+            patcher = mock.patch.object(owner, attribute)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_lengths_are_updated_by_id(self):
+        DefectModel.bulk_update_lengths({3: 1.5, 4: 2.0})
+        query, params = self.session.execute.call_args.args
+        self.assertIn('WHERE laminator_foam_defect_removal_records.id = %(b_id)s',
+                      str(query.compile(dialect=postgresql.dialect())))
+        self.assertEqual(params, [{'b_id': 3, 'b_length': 1.5}, {'b_id': 4, 'b_length': 2.0}])
+
+    def test_inserts_get_their_ids_from_the_sequence(self):
+        self.session.execute.return_value.scalars.return_value = iter([7, 8, 9])
+        ids = DefectModel.bulk_insert([{'lam_num': 1}, {'lam_num': 2, 'rem_l': True}, {'lam_num': 3}])
+        self.assertEqual(ids, [7, 8, 9])
+        id_query, *inserts = [call.args for call in self.session.execute.call_args_list]
+        self.assertIn('nextval', compile_pg(id_query[0]))
+        self.assertEqual([params for query, params in inserts],
+                         [[{'lam_num': 1, 'id': 7}, {'lam_num': 3, 'id': 9}], [{'lam_num': 2, 'rem_l': True, 'id': 8}]])
+        self.assertNotIn('RETURNING', compile_pg(inserts[0][0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
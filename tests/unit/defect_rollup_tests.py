@@ -0,0 +1,63 @@
+import datetime
+import unittest
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from flask_server_files.models.defect_rollup import DefectRollupModel
+
+
+def defect(**values):
+    defaults = {'defect_start_ts': datetime.datetime(2023, 9, 1, 8), 'lam_num': 1, 'shift_number': 2,
+                'defect_type': 'thickness', 'length_of_defect_meters': 2.5, 'operator_saved_time': None}
+    return {**defaults, **values}
+
+
+class RecordingSession:
+    """Keeps the parameters of the upsert instead of running it."""
+    dialect_name = 'postgresql'
+
+    def __init__(self):
+        self.params = None
+
+    def get_bind(self):
+        return sqlalchemy.create_mock_engine(f'{self.dialect_name}://', executor=None)
+
+    def execute(self, query, params):
+        self.query = query
+        self.params = params
+
+
+class TestRollupChanges(unittest.TestCase):
+    def test_contribution(self):
+        key, values = DefectRollupModel.contribution(defect(shift_number=None, defect_type=None))
+        self.assertEqual(key, (datetime.date(2023, 9, 1), 1, 0, ''))
+        self.assertEqual(values, (1, 2.5, 0))
+        self.assertIsNone(DefectRollupModel.contribution(defect(defect_start_ts=None)))
+
+    def test_changes_are_netted_per_key(self):
+        session = RecordingSession()
+        confirmed = defect(operator_saved_time=datetime.datetime(2023, 9, 1, 9), length_of_defect_meters=4.0)
+        DefectRollupModel.apply_changes(session, [(None, defect()), (defect(), confirmed),
+                                                  (defect(shift_number=3), None)])
+        self.assertEqual(sorted((row['shift_number'], row['defect_count'], row['total_meters'], row['confirmed_count'])
+                                for row in session.params), [(2, 1, 4.0, 1), (3, -1, -2.5, 0)])
+        self.assertIn('ON CONFLICT (day, lam_num, shift_number, defect_type) DO UPDATE',
+                      str(session.query.compile(dialect=postgresql.dialect())))
+
+    def test_unchanged_keys_are_not_written(self):
+        session = RecordingSession()
+        DefectRollupModel.apply_changes(session, [(defect(), defect())])
+        self.assertIsNone(session.params)
+
+
+class TestRollupSummaryGroups(unittest.TestCase):
+    def test_only_rollup_columns(self):
+        self.assertEqual(len(DefectRollupModel.summary_groups(('lam_num', 'defect_type'), bucket='week')), 3)
+        for group_by, bucket in ((('recipe',), None), ((), 'hour')):
+            with self.assertRaises(ValueError):
+                DefectRollupModel.summary_groups(group_by, bucket)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import csv
+import datetime
+import importlib.util
+import io
+import unittest
+
+import sqlalchemy
+
+from flask_server_files.export_formats import arrow_chunks, csv_chunks, parquet_chunks
+from flask_server_files.helpers import RowSerializer
+
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+
+class ExportFormatsTests(unittest.TestCase):
+    def setUp(self):
+        table = sqlalchemy.Table('export_test', sqlalchemy.MetaData(),
+                                 sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                                 sqlalchemy.Column('lot', sqlalchemy.String),
+                                 sqlalchemy.Column('length', sqlalchemy.Float),
+                                 sqlalchemy.Column('start', sqlalchemy.TIMESTAMP(timezone=True)))
+        self.serializer = RowSerializer(table)
+        start = datetime.datetime(2023, 9, 1, tzinfo=datetime.timezone.utc)
+        self.row_chunks = [[(1, 'lot1', 1.5, start), (2, None, 2.0, None)], [(3, 'lot3', None, start)]]
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(b''.join(csv_chunks(self.serializer, self.row_chunks)).decode())))
+        self.assertEqual(rows[0], ['id', 'lot', 'length', 'start'])
+        self.assertEqual(rows[1], ['1', 'lot1', '1.5', '2023-09-01T00:00:00+00:00'])
+        self.assertEqual(len(rows), 4)
+
+    @unittest.skipUnless(HAS_PYARROW, 'pyarrow is not installed')
+    def test_arrow_and_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow_table = pa.ipc.open_stream(b''.join(arrow_chunks(self.serializer, self.row_chunks))).read_all()
+        parquet_table = pq.read_table(io.BytesIO(b''.join(parquet_chunks(self.serializer, self.row_chunks))))
+        for table in (arrow_table, parquet_table):
+            self.assertEqual(table.column('id').to_pylist(), [1, 2, 3])
+            self.assertEqual(table.column('lot').to_pylist(), ['lot1', None, 'lot3'])
+            self.assertEqual(table.schema.field('start').type, pa.timestamp('us', tz='UTC'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,37 @@
+import datetime
+import decimal
+import json
 import os
 import tempfile
 import threading
 import time
 import unittest
 
-from flask_server_files.helpers import single_instance
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from flask_server_files.helpers import modified_time_ddl, RowSerializer, single_instance, stamp_modified_time
+
+
+class TestRowSerializer(unittest.TestCase):
+    def setUp(self):
+        self.table = sqlalchemy.Table('serializer_test', sqlalchemy.MetaData(),
+                                      sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                                      sqlalchemy.Column('name', sqlalchemy.String),
+                                      sqlalchemy.Column('created', sqlalchemy.TIMESTAMP(timezone=True)),
+                                      sqlalchemy.Column('length', sqlalchemy.Numeric))
+        self.serializer = RowSerializer(self.table)
+        self.created = datetime.datetime(2023, 9, 1, 6, 30, tzinfo=datetime.timezone.utc)
+
+    def test_row_dict_converts_only_what_needs_it(self):
+        row_dict = self.serializer.row_dict((1, 'lot1', self.created, None))
+        self.assertEqual(row_dict, {'id': 1, 'name': 'lot1', 'created': '2023-09-01T06:30:00+00:00', 'length': None})
+
+    def test_to_json_with_either_encoder(self):
+        for serializer in (self.serializer, RowSerializer(self.table, fast_json=False)):
+            encoded = serializer.to_json((2, 'lot2', self.created, decimal.Decimal('1.5')))
+            self.assertEqual(json.loads(encoded), {'id': 2, 'name': 'lot2', 'created': '2023-09-01T06:30:00+00:00',
+                                                   'length': 1.5})
 
 
 class TestSingleInstance(unittest.TestCase):
@@ -38,3 +65,32 @@ class TestSingleInstance(unittest.TestCase):
         # Try to acquire the lock file again
         with single_instance(self.lock_file, timeout=1):
             pass
+
+
+class TestModifiedTimeDDL(unittest.TestCase):
+    def setUp(self):
+        self.table = sqlalchemy.Table('stamped', sqlalchemy.MetaData(),
+                                      sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                                      sqlalchemy.Column('entry_modified_ts', sqlalchemy.TIMESTAMP(timezone=True)))
+
+    def test_writes_are_stamped_in_commit_order(self):
+        function, triggers = modified_time_ddl(self.table)
+        function = str(function.compile(dialect=postgresql.dialect()))
+        self.assertIn('pg_advisory_xact_lock', function)  # held until the commit
+        self.assertIn('NEW.entry_modified_ts := clock_timestamp()', function)
+        self.assertEqual({name: str(ddl.compile(dialect=postgresql.dialect())) for name, ddl in triggers.items()},
+                         {'stamped_modified_lock': 'CREATE TRIGGER stamped_modified_lock BEFORE INSERT OR UPDATE ON '
+                                                   'stamped FOR EACH STATEMENT EXECUTE PROCEDURE '
+                                                   'stamp_entry_modified_ts()',
+                          'stamped_modified_stamp': 'CREATE TRIGGER stamped_modified_stamp BEFORE INSERT OR UPDATE ON '
+                                                    'stamped FOR EACH ROW EXECUTE PROCEDURE '
+                                                    'stamp_entry_modified_ts()'})
+
+    def test_only_postgresql_gets_the_triggers(self):
+        stamp_modified_time(self.table)
+        engine = sqlalchemy.create_engine('sqlite://')
+        self.table.metadata.create_all(engine)
+        with engine.connect() as cnn:
+            self.assertEqual(cnn.execute(sqlalchemy.text("SELECT count(*) FROM sqlite_master WHERE type = 'trigger'"))
+                             .scalar(), 0)
+        engine.dispose()
@@ -0,0 +1,135 @@
+import datetime
+import functools
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from flask_server_files.models.defect import DefectModel
+from flask_server_files.models.lam_operator import OperatorModel
+from flask_server_files.sqla_instance import Base, snapshot_session
+from msg_window import local_mirror
+from msg_window.local_mirror import LocalMirror
+
+
+class TestLocalMirror(unittest.TestCase):
+    def setUp(self):
+        # a throwaway central database, never the configured one
+        self.central = sqlalchemy.create_engine('sqlite://', poolclass=sqlalchemy.pool.StaticPool,
+                                               connect_args={'check_same_thread': False})
+        self.addCleanup(self.central.dispose)
+        Base.metadata.create_all(self.central, tables=[DefectModel.__table__, OperatorModel.__table__])
+        central_session = functools.partial(snapshot_session, bind=self.central)
+        session_patch = mock.patch.object(local_mirror, 'snapshot_session', central_session)
+        session_patch.start()
+        self.addCleanup(session_patch.stop)
+        self.start = datetime.datetime(2023, 9, 1, 8)
+        self.insert_defects(1, 1, 2)
+        with self.central.begin() as cnn:
+            cnn.execute(sqlalchemy.insert(OperatorModel.__table__),
+                        [{'first_name': 'Ann', 'last_name': 'Lee', 'initials': 'AL', 'lam_1_certified': True},
+                         {'first_name': 'Bob', 'last_name': 'Ray', 'initials': 'BR', 'lam_1_certified': False}])
+
+        mirror_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(mirror_dir.cleanup)
+        self.mirror = LocalMirror(1, path=os.path.join(mirror_dir.name, 'mirror.sqlite'))
+        self.addCleanup(self.mirror.engine.dispose)
+
+    def insert_defects(self, *lam_nums):
+        with self.central.begin() as cnn:
+            cnn.execute(sqlalchemy.insert(DefectModel.__table__),
+                        [{'source_lot_number': 'lot', 'lam_num': lam_num, 'defect_start_ts': self.start,
+                          'defect_end_ts': self.start, 'entry_created_ts': self.start,
+                          'entry_modified_ts': self.start} for lam_num in lam_nums])
+
+    def mirrored_ids(self):
+        with self.mirror.session() as session:
+            return sorted(defect.id for defect in DefectModel.find_new(lam_number=1, session=session))
+
+    def test_sync_is_incremental(self):
+        self.assertTrue(self.mirror.sync())
+        self.assertEqual(self.mirrored_ids(), [1, 2])
+        self.assertEqual([operator.initials for operator in self.mirror.active_operators()], ['AL'])
+        self.assertFalse(self.mirror.sync())
+
+        # confirmed centrally, and a new one
+        with self.central.begin() as cnn:
+            cnn.execute(sqlalchemy.update(DefectModel.__table__).where(DefectModel.id == 1).values(
+                operator_saved_time=self.start, entry_modified_ts=self.start + datetime.timedelta(minutes=1)))
+        self.insert_defects(1)
+        self.assertTrue(self.mirror.sync())
+        self.assertEqual(self.mirrored_ids(), [2, 4])
+
+    def test_deleted_defects_are_dropped_without_a_full_sync(self):
+        self.mirror.sync()
+        with self.central.begin() as cnn:
+            cnn.execute(sqlalchemy.delete(DefectModel.__table__).where(DefectModel.id == 2))
+        self.assertTrue(self.mirror.sync())
+        self.assertEqual(self.mirrored_ids(), [1])
+        self.assertFalse(self.mirror.sync())
+
+    def test_first_sync_is_on_the_sync_thread(self):
+        synced = threading.Event()
+        self.mirror.notify = synced.set
+        self.mirror.start()
+        self.addCleanup(self.mirror.stop, 5)
+        self.assertTrue(synced.wait(5))  # without request_sync, so before the first interval
+        self.assertTrue(self.mirror.connected)
+        self.assertEqual(self.mirrored_ids(), [1, 2])
+
+    def test_a_mirror_of_older_models_is_rebuilt(self):
+        self.mirror.sync()
+        with self.mirror.engine.begin() as cnn:
+            cnn.execute(sqlalchemy.text('ALTER TABLE lam_operator_list DROP COLUMN entry_modified_ts'))
+        self.mirror.engine.dispose()
+
+        mirror = LocalMirror(1, path=self.mirror.engine.url.database)
+        self.addCleanup(mirror.engine.dispose)
+        self.assertEqual(mirror.active_operators(), [])
+        self.assertTrue(mirror.sync())
+        self.assertEqual([operator.initials for operator in mirror.active_operators()], ['AL'])
+
+    def test_write_through(self):
+        self.mirror.sync()
+        with self.mirror.session() as session:
+            values = DefectModel.find_new(lam_number=1, session=session)[0].get_model_dict()
+        self.mirror.write_through({**values, 'operator_saved_time': self.start})
+        self.assertEqual(self.mirrored_ids(), [1])
+
+    def test_a_save_written_through_during_the_central_reads_is_kept(self):
+        self.mirror.sync()
+        with self.mirror.session() as session:
+            values = session.get(DefectModel, 1).get_model_dict()
+        confirmed = {**values, 'operator_saved_time': self.start,
+                     'entry_modified_ts': self.start + datetime.timedelta(minutes=1)}
+        find_new_since = DefectModel.find_new_since
+
+        def save_while_reading(*args, **kwargs):
+            defects = find_new_since(*args, **kwargs)  # still has the defect open
+            writer = threading.Thread(target=self.mirror.write_through, args=(confirmed,))
+            writer.start()
+            writer.join(5)
+            self.assertFalse(writer.is_alive())  # the save queue didn't wait on the sync
+            return defects
+
+        self.mirror.request_sync(full=True)
+        with mock.patch.object(DefectModel, 'find_new_since', side_effect=save_while_reading):
+            self.mirror.sync()
+        self.assertEqual(self.mirrored_ids(), [2])
+
+    def test_reads_keep_working_offline(self):
+        self.mirror._sync_and_notify()
+        self.assertTrue(self.mirror.connected)
+        down = sqlalchemy.exc.OperationalError('SELECT', {}, Exception('could not connect to server'))
+        with mock.patch.object(DefectModel, 'find_new_since', side_effect=down):
+            self.mirror._sync_and_notify()
+        self.assertFalse(self.mirror.connected)
+        self.assertEqual(self.mirrored_ids(), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+
+from scada_outbound_connections.meter_count_lengths import DefectLengthCalculator, defect_lengths
+
+
+class DefectLengthsTests(unittest.TestCase):
+    # the counter runs up to 30 m then resets at roll change (t=4000) and counts up again
+    t_stamps = np.array([0, 1000, 2000, 3000, 4000, 5000, 6000, 7000])
+    counts = np.array([0.0, 10.0, 20.0, 30.0, 5.0, 15.0, 25.0, 35.0])
+
+    def test_window_without_a_reset(self):
+        np.testing.assert_array_equal(defect_lengths(self.t_stamps, self.counts, [1000], [3000]), [20.0])
+
+    def test_window_across_a_reset(self):
+        # 20 -> 30 before the reset, 0 -> 15 after it
+        np.testing.assert_array_equal(defect_lengths(self.t_stamps, self.counts, [2000], [5000]), [25.0])
+
+    def test_boundaries_between_samples_use_the_previous_sample(self):
+        np.testing.assert_array_equal(defect_lengths(self.t_stamps, self.counts, [1500, 6500], [2500, 9000]),
+                                      [10.0, 10.0])
+
+    def test_window_before_the_history_is_unknown(self):
+        self.assertTrue(np.isnan(defect_lengths(self.t_stamps, self.counts, [-1000], [1000])[0]))
+
+    def test_a_dip_in_the_count_is_not_a_reset(self):
+        counts = [1000.0, 1000.5, 1000.4, 1001.0, 1002.0]
+        # the 0.1 m dip counts as no distance
+        np.testing.assert_array_equal(defect_lengths(range(5), counts, [0, 2], [4, 4]), [2.1, 1.6])
+
+    def test_samples_without_a_count_are_skipped(self):
+        counts = self.counts.copy()
+        counts[2] = np.nan  # the start at t=2000 uses the sample at t=1000
+        np.testing.assert_array_equal(defect_lengths(self.t_stamps, counts, [1000, 2000, 5000], [3000, 5000, 7000]),
+                                      [20.0, 35.0, 20.0])
+
+    def test_streamed_chunks_match_one_pass(self):
+        rng = np.random.default_rng(7)
+        t_stamps = np.arange(0, 100_000, 10)
+        counts = np.cumsum(rng.random(len(t_stamps))) % 500  # several resets
+        starts = np.sort(rng.integers(0, 90_000, 200))
+        ends = starts + rng.integers(0, 10_000, 200)
+
+        calculator = DefectLengthCalculator(starts, ends)
+        for chunk in range(0, len(t_stamps), 997):
+            calculator.add_chunk(t_stamps[chunk:chunk + 997], counts[chunk:chunk + 997])
+
+        np.testing.assert_array_equal(calculator.lengths(), defect_lengths(t_stamps, counts, starts, ends))
+        self.assertTrue((calculator.lengths() >= 0).all())
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import flask
+import sqlalchemy
+import sqlalchemy.exc
+
+from flask_server_files.sqla_instance import fsa, pool_metrics, pool_stats, StatsQueuePool
+
+
+class TestPoolStats(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://', poolclass=StatsQueuePool, pool_size=1, max_overflow=0,
+                                               pool_timeout=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_waits_and_timeouts_are_counted(self):
+        with self.engine.connect():
+            self.assertEqual(pool_stats(self.engine)['checked_out'], 1)
+            with self.assertRaises(sqlalchemy.exc.TimeoutError):
+                self.engine.connect()
+
+        # a wait that gets a connection
+        first = self.engine.connect()
+        threading.Timer(0.01, first.close).start()
+        self.engine.connect().close()
+
+        stats = pool_stats(self.engine)
+        self.assertEqual((stats['waits'], stats['timeouts'], stats['checked_out']), (2, 1, 0))
+        self.assertGreater(stats['wait_seconds'], 0)
+        self.assertIn(('db_pool_timeouts_total', 'counter', 'Checkouts that gave up waiting.', 1),
+                      pool_metrics(self.engine))
+
+    def test_free_connections_do_not_wait(self):
+        for _ in range(3):
+            self.engine.connect().close()
+        self.assertEqual(pool_stats(self.engine)['waits'], 0)
+
+    def test_stats_survive_a_recreated_pool(self):
+        self.engine.dispose()
+        self.engine.connect().close()
+        self.assertEqual(pool_stats(self.engine)['max_overflow'], 0)
+
+
+class TestFlaskSQLAlchemyPool(unittest.TestCase):
+    def test_flask_sqlalchemy_keeps_no_connections(self):
+        database_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(database_dir.cleanup)
+        app = flask.Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(database_dir.name, "test.sqlite")}'
+        fsa.init_app(app)
+        with app.app_context():
+            self.assertIsInstance(fsa.engine.pool, sqlalchemy.pool.NullPool)
+            fsa.engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
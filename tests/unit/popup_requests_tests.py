@@ -0,0 +1,34 @@
+import threading
+import unittest
+
+from flask_server_files.popup_requests import PopupRequests
+
+
+class PopupRequestsTests(unittest.TestCase):
+    def test_responses_go_to_their_own_request(self):
+        requests = PopupRequests()
+        first_id, first_future = requests.new_request()
+        second_id, second_future = requests.new_request()
+        self.assertNotEqual(first_id, second_id)
+
+        # the popup answers out of order
+        threading.Thread(target=requests.complete, args=(second_id, 'second')).start()
+        threading.Thread(target=requests.complete, args=(first_id, 'first')).start()
+
+        self.assertEqual(requests.wait_for(first_id, first_future, timeout=1), 'first')
+        self.assertEqual(requests.wait_for(second_id, second_future, timeout=1), 'second')
+        self.assertEqual(requests.pending_count(), 0)
+
+    def test_timeout_abandons_the_request(self):
+        requests = PopupRequests()
+        request_id, future = requests.new_request()
+
+        with self.assertRaises(TimeoutError):
+            requests.wait_for(request_id, future, timeout=0.01)
+
+        # a late response is discarded
+        self.assertFalse(requests.complete(request_id, 'late'))
+        self.assertEqual(requests.pending_count(), 0)
+
+    def test_unknown_request_id(self):
+        self.assertFalse(PopupRequests().complete(None, 'nobody asked'))
@@ -0,0 +1,42 @@
+import threading
+import unittest
+
+from publishing_vars import SubscribableDeque
+
+
+class SubscribableDequeTests(unittest.TestCase):
+    def test_adding_items_notifies_subscribers(self):
+        notifications = []
+        inbox = SubscribableDeque()
+        inbox.subscribe(self, lambda: notifications.append(len(inbox)))
+
+        inbox.append({'action': 'show'})
+        inbox.appendleft({'action': 'shrink'})
+        inbox.extend([{'action': 'show_force'}])
+
+        self.assertEqual(notifications, [1, 2, 3])
+        self.assertEqual(inbox.popleft(), {'action': 'shrink'})
+
+    def test_resubscribe_and_unsubscribe(self):
+        calls = []
+        inbox = SubscribableDeque()
+        self.assertEqual(inbox.subscribe(self, lambda: calls.append('first')), 'subscriber added')
+        self.assertEqual(inbox.subscribe(self, lambda: calls.append('second')), 'subscriber updated')
+
+        inbox.append(1)
+        self.assertEqual(calls, ['second'])
+
+        self.assertTrue(inbox.unsubscribe(self))
+        self.assertFalse(inbox.unsubscribe(self))
+        inbox.append(2)
+        self.assertEqual(calls, ['second'])
+
+    def test_notifies_from_the_appending_thread(self):
+        woken = threading.Event()
+        inbox = SubscribableDeque()
+        inbox.subscribe(self, woken.set)
+
+        threading.Thread(target=inbox.append, args=({'action': 'show'},)).start()
+
+        self.assertTrue(woken.wait(1))
+        self.assertEqual(len(inbox), 1)
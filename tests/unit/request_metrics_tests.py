@@ -0,0 +1,56 @@
+import unittest
+
+import flask
+
+from flask_server_files.request_metrics import RequestMetrics
+
+
+def make_app():
+    app = flask.Flask(__name__)
+
+    @app.route('/defect/<int:id_>')
+    def defect(id_):
+        return {'id': id_}
+
+    @app.route('/broken')
+    def broken():
+        raise RuntimeError('broken')
+
+    return app
+
+
+class TestRequestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.app = make_app()
+        self.metrics = RequestMetrics(self.app, threads=4)
+        self.client = self.app.test_client()
+
+    def test_requests_are_counted_by_route(self):
+        for id_ in range(3):
+            self.client.get(f'/defect/{id_}')
+        self.client.get('/nowhere')
+        self.assertEqual(self.client.get('/broken').status_code, 500)
+
+        text = self.metrics.render()
+        self.assertIn('http_requests_total{route="/defect/<int:id_>",method="GET",status="200"} 3', text)
+        self.assertIn('http_requests_total{route="<unmatched>",method="GET",status="404"} 1', text)
+        self.assertIn('http_request_errors_total{route="/broken",method="GET"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/defect/<int:id_>",method="GET",le="+Inf"} 3', text)
+        self.assertIn('server_threads_in_use 0', text)
+        self.assertIn('server_threads_peak_in_use 1', text)
+        self.assertIn('server_threads 4', text)
+
+    def test_histogram_and_summary(self):
+        for seconds in (0.001, 0.02, 0.02, 20.0):
+            self.metrics.record('/defects', 'GET', 200, seconds)
+        text = self.metrics.render()
+        self.assertIn('http_request_duration_seconds_bucket{route="/defects",method="GET",le="0.005"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/defects",method="GET",le="0.025"} 3', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/defects",method="GET",le="10.0"} 3', text)
+
+        route, = self.metrics.summary()['routes']
+        self.assertEqual((route['count'], route['errors'], route['p95_ms']), (4, 0, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import datetime
+import json
+import os
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+
+import sqlalchemy.exc
+from sqlalchemy.dialects import postgresql
+
+from flask_server_files.models.defect import DefectModel
+from msg_window.save_queue import SaveQueue
+
+
+class TestSaveQueue(unittest.TestCase):
+    def setUp(self):
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+        self.journal_path = os.path.join(journal_dir.name, 'saves.jsonl')
+        self.results = []
+        self.done = threading.Semaphore(0)
+
+    def notify(self, result):
+        self.results.append(result)
+        self.done.release()
+
+    def wait_for(self, count):
+        for _ in range(count):
+            self.assertTrue(self.done.acquire(timeout=5))
+
+    def make_queue(self):
+        save_queue = SaveQueue(self.journal_path, notify=self.notify)
+        save_queue.retry_delays = (0.01,)
+        self.addCleanup(save_queue.stop, 5)
+        return save_queue
+
+    def test_saves_are_journaled_and_replayed_in_order(self):
+        save_queue = self.make_queue()
+        saved_time = datetime.datetime(2023, 9, 1, 8, tzinfo=datetime.timezone.utc)
+        save_queue.patch(3, {'operator_saved_time': saved_time})
+        save_queue.insert({'lam_num': 1})
+        with open(self.journal_path) as journal:
+            self.assertEqual([json.loads(line)['action'] for line in journal], ['patch', 'insert'])
+
+        # a restart before the writer got to them
+        save_queue = self.make_queue()
+        calls = []
+        row = types.SimpleNamespace(_mapping={})
+        with mock.patch.object(DefectModel, 'patch', side_effect=lambda *args: calls.append(args) or row), \
+                mock.patch.object(DefectModel, 'bulk_insert', side_effect=lambda records: calls.append(records) or [9]), \
+                mock.patch.object(SaveQueue, '_find_inserted', return_value=None):
+            save_queue.start()
+            self.wait_for(2)
+        self.assertEqual(calls[0], (3, {'operator_saved_time': saved_time}))
+        self.assertEqual(calls[1][0]['lam_num'], 1)
+        self.assertIsInstance(calls[1][0]['entry_created_ts'], datetime.datetime)
+        self.assertEqual([(result['action'], result['id'], result['ok']) for result in self.results],
+                         [('patch', 3, True), ('insert', 9, True)])
+        self.assertEqual(len(save_queue), 0)
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+
+    def test_replayed_insert_is_not_inserted_twice(self):
+        self.make_queue().insert({'lam_num': 1})
+        save_queue = self.make_queue()
+        with mock.patch.object(DefectModel, 'bulk_insert') as bulk_insert, \
+                mock.patch.object(SaveQueue, '_find_inserted', return_value=5):
+            save_queue.start()
+            self.wait_for(1)
+        bulk_insert.assert_not_called()
+        self.assertEqual(self.results[0]['id'], 5)
+
+    def test_replayed_insert_without_a_lam_num_is_found(self):
+        with mock.patch.object(DefectModel, 'session') as session:
+            SaveQueue._find_inserted({'entry_created_ts': datetime.datetime(2023, 9, 1, 8), 'lam_num': None})
+        query = session.execute.call_args.args[0]
+        compiled = str(query.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+        self.assertIn('lam_num IS NOT DISTINCT FROM NULL', compiled)
+
+    def test_retries_until_the_database_is_back(self):
+        save_queue = self.make_queue()
+        down = sqlalchemy.exc.OperationalError('UPDATE', {}, Exception('connection refused'))
+        row = types.SimpleNamespace(_mapping={})
+        with mock.patch.object(DefectModel, 'patch', side_effect=[down, down, row]) as patch:
+            save_queue.start()
+            save_queue.patch(3, {'rem_l': True})
+            self.assertEqual(save_queue.pending_ids(), {3})
+            self.wait_for(1)
+        self.assertEqual(patch.call_count, 3)
+        self.assertTrue(self.results[0]['ok'])
+        self.assertEqual(save_queue.pending_ids(), set())
+
+    def test_failed_saves_are_reported(self):
+        save_queue = self.make_queue()
+        with mock.patch.object(DefectModel, 'patch', return_value=None):
+            save_queue.start()
+            save_queue.patch(3, {'rem_l': True})
+            self.wait_for(1)
+        self.assertFalse(self.results[0]['ok'])
+        self.assertIn('3', self.results[0]['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,276 @@
+import threading
+import unittest
+from unittest import mock
+
+from psycopg2 import OperationalError, ProgrammingError
+
+from scada_outbound_connections import scada_tag_query
+from scada_outbound_connections.scada_tag_query import DatabaseConnection, TagHistoryConnector, TagValueCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TagValueCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TagValueCache(clock=self.clock)
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return [(1, 2, 3.0, 'lot')]
+
+    def test_values_are_reused_until_they_expire(self):
+        self.cache.get(('tag', 1), 60, self.load)
+        self.clock.now = 59
+        self.cache.get(('tag', 1), 60, self.load)
+        self.assertEqual(self.loads, 1)
+
+        self.clock.now = 61
+        self.cache.get(('tag', 1), 60, self.load)
+        self.assertEqual(self.loads, 2)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2, 'collapsed': 0, 'entries': 1})
+
+    def test_invalidate(self):
+        self.cache.get(('tag', 1), 60, self.load)
+        self.cache.invalidate_matching(lambda key: key[0] == 'tag')
+        self.cache.get(('tag', 1), 60, self.load)
+        self.assertEqual(self.loads, 2)
+
+    def test_concurrent_requests_share_one_load(self):
+        release = threading.Event()
+
+        def slow_load():
+            release.wait(1)
+            return self.load()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get('key', 1, slow_load)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while self.cache.stats()['collapsed'] < 4:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(len(results), 5)
+
+    def test_failed_load_is_not_cached(self):
+        def failing_load():
+            raise ConnectionError('historian unavailable')
+
+        with self.assertRaises(ConnectionError):
+            self.cache.get('key', 60, failing_load)
+        self.assertEqual(self.cache.get('key', 60, self.load), self.load())
+
+
+class FakeCursor:
+    def __init__(self, connection, name=None):
+        self.connection = connection  # the same attribute name as a psycopg2 cursor
+        self.name = name
+        self.itersize = 2000
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, parameters=None):
+        self.connection.executed.append(query)
+        if self.connection.dropped:
+            self.connection.closed = 1
+            raise OperationalError('server closed the connection unexpectedly')
+        if not self.connection.autocommit:
+            self.connection.in_transaction = True  # like psycopg2, the first query begins a transaction
+        elif self.name is not None:
+            raise ProgrammingError(f'cursor "{self.name}" does not exist')  # named cursors need a transaction
+        if 'FROM sqlth_1_data' in query:
+            if 'COALESCE' in query:  # include_prior, the range starts at the tag's last row at or before the start
+                tag_id, _, prior_end, start, end = parameters
+                start = max((row[6] for row in self.connection.history if row[0] == tag_id and row[6] <= prior_end),
+                            default=start)
+            else:
+                tag_id, start, end = parameters
+            self.results = sorted((row for row in self.connection.history
+                                   if row[0] == tag_id and start <= row[6] < end), key=lambda row: row[6])
+
+    def fetchall(self):
+        return [(self.connection.number,)]
+
+    def fetchmany(self, size):
+        self.connection.fetch_sizes.append(size)
+        rows, self.results = self.results[:size], self.results[size:]
+        return rows
+
+
+class FakeConnection:
+    def __init__(self, number, dropped=False, history=()):
+        self.number = number
+        self.dropped = dropped
+        self.history = list(history)  # sqlth_1_data rows
+        self.fetch_sizes = []
+        self.closed = 0
+        self.in_transaction = False
+        self._autocommit = False  # psycopg2's default
+        self.executed = []
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        if self.in_transaction:
+            raise ProgrammingError('set_session cannot be used inside a transaction')
+        self._autocommit = value
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+
+class FakePool:
+    def __init__(self, connections):
+        self.connections = list(connections)
+        self.discarded = []
+
+    def getconn(self):
+        return self.connections.pop(0)
+
+    def putconn(self, cnn, close=False):
+        if close:
+            self.discarded.append(cnn)
+        else:
+            self.connections.append(cnn)
+
+
+class DatabaseConnectionTests(unittest.TestCase):
+    def make_connection(self, connections):
+        pool = FakePool(connections)
+        with mock.patch.object(scada_tag_query, 'ThreadedConnectionPool', return_value=pool):
+            database = DatabaseConnection({}, retries=2)
+        database.retry_backoff = 0
+        return database, pool
+
+    def test_dropped_connection_is_replaced(self):
+        dropped = FakeConnection(1, dropped=True)
+        database, pool = self.make_connection([dropped, FakeConnection(2)])
+
+        self.assertEqual(database.fetchall('SELECT 1'), [(2,)])
+        self.assertEqual(pool.discarded, [dropped])
+
+    def test_new_connection_is_autocommit_before_its_health_check(self):
+        connection = FakeConnection(1)
+        database, pool = self.make_connection([connection])
+
+        self.assertEqual(database.fetchall('SELECT 2'), [(1,)])
+        self.assertEqual(connection.executed, ['SELECT 1', 'SELECT 2'])
+        self.assertTrue(connection.autocommit)
+        self.assertFalse(connection.in_transaction)
+        self.assertEqual(pool.discarded, [])
+
+    def test_connection_left_in_a_transaction_is_discarded(self):
+        stuck = FakeConnection(1)
+        stuck.in_transaction = True
+        database, pool = self.make_connection([stuck, FakeConnection(2)])
+        database._prepared[id(stuck)] = {'recent'}
+
+        self.assertEqual(database.fetchall('SELECT 1'), [(2,)])
+        self.assertEqual(pool.discarded, [stuck])
+        self.assertNotIn(id(stuck), database._prepared)
+
+    def test_gives_up_after_the_retries(self):
+        database, pool = self.make_connection([FakeConnection(n, dropped=True) for n in range(3)])
+
+        with self.assertRaises(ConnectionError):
+            database.fetchall('SELECT 1')
+        self.assertEqual(len(pool.discarded), 3)
+
+    def test_statements_are_prepared_once_per_connection(self):
+        connection = FakeConnection(1)
+        database, pool = self.make_connection([connection])
+        database.prepared_statements = {'recent': ('integer, integer', 'SELECT * FROM t WHERE a = %s LIMIT %s')}
+
+        for _ in range(3):
+            database.fetchall_prepared('recent', (1, 2))
+
+        self.assertEqual(connection.executed[1:], ['PREPARE recent (integer, integer) AS SELECT * FROM t WHERE a = $1 '
+                                                   'LIMIT $2'] + ['EXECUTE recent (%s, %s)'] * 3)
+
+
+def history_row(t_stamp, value, tag_id=7):
+    return tag_id, None, value, None, None, 192, t_stamp
+
+
+class IterRangeTests(unittest.TestCase):
+    def make_connector(self, history):
+        self.connection = FakeConnection(1, history=history)
+        self.pool = FakePool([self.connection])
+        with mock.patch.object(scada_tag_query, 'ThreadedConnectionPool', return_value=self.pool), \
+                mock.patch.object(TagHistoryConnector, 'update_tag_ids'):
+            return TagHistoryConnector(None, {})
+
+    def assert_connection_returned(self):
+        self.assertEqual(self.pool.connections, [self.connection])
+        self.assertEqual(self.pool.discarded, [])
+        self.assertTrue(self.connection.autocommit)
+        self.assertFalse(self.connection.in_transaction)
+
+    def test_chunks_end_at_the_page_boundaries(self):
+        history = [history_row(t_stamp, float(t_stamp)) for t_stamp in range(10, 15)] + [history_row(15, 9.0, 8)]
+        connector = self.make_connector(history)
+
+        chunks = list(connector.iter_range(7, 10, 15, chunk_size=2))
+        self.assertEqual([[row[6] for row in chunk] for chunk in chunks], [[10, 11], [12, 13], [14]])
+        self.assert_connection_returned()
+
+        # a last page that is full is not followed by an empty chunk
+        self.connection.fetch_sizes.clear()
+        chunks = list(connector.iter_range(7, 10, 14, chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2])
+        self.assertEqual(self.connection.fetch_sizes, [2, 2, 2])
+
+    def test_empty_range(self):
+        connector = self.make_connector([history_row(10, 1.0)])
+
+        self.assertEqual(list(connector.iter_range(7, 11, 20, chunk_size=2)), [])
+        self.assertEqual(list(connector.iter_range(7, 11, 20, chunk_size=2, as_arrays=True)), [])
+        self.assert_connection_returned()
+
+    def test_duplicate_t_stamps_across_a_page_break(self):
+        history = [history_row(10, 1.0), history_row(11, 2.0), history_row(11, 3.0), history_row(11, 4.0),
+                   history_row(12, 5.0)]
+        connector = self.make_connector(history)
+
+        chunks = list(connector.iter_range(7, 10, 13, chunk_size=2, as_arrays=True))
+        self.assertEqual([t_stamps.tolist() for t_stamps, values in chunks], [[10, 11], [11, 11], [12]])
+        self.assertEqual([value for t_stamps, values in chunks for value in values], [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assert_connection_returned()
+
+    def test_include_prior_starts_with_the_last_row_before_the_start(self):
+        history = [history_row(5, 1.0), history_row(8, 2.0), history_row(9, 9.0, 8), history_row(10, 3.0),
+                   history_row(12, 4.0)]
+        connector = self.make_connector(history)
+
+        chunks = list(connector.iter_range(7, 9, 13, chunk_size=2, include_prior=True))
+        self.assertEqual([[row[6] for row in chunk] for chunk in chunks], [[8, 10], [12]])
+        # a row at the start is the value at the start, nothing before it is needed
+        chunks = list(connector.iter_range(7, 10, 13, chunk_size=2, include_prior=True, as_arrays=True))
+        self.assertEqual([t_stamps.tolist() for t_stamps, values in chunks], [[10, 12]])
+        # without history before the start, the range starts at the start
+        chunks = list(connector.iter_range(7, 4, 9, chunk_size=2, include_prior=True))
+        self.assertEqual([[row[6] for row in chunk] for chunk in chunks], [[5, 8]])
+        self.assert_connection_returned()
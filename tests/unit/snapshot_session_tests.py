@@ -0,0 +1,83 @@
+import datetime
+import os
+import unittest
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from flask_server_files.models.defect import DefectModel
+from flask_server_files.sqla_instance import engine, QueryCounter, snapshot_session
+from msg_window.defect_draft import DefectDraft
+
+# the most queries opening a defect's panel may make, the panel's widgets only edit the draft
+MAX_PANEL_QUERIES = 0
+
+
+def display_available():
+    try:
+        import tkinter
+        tkinter.Tk().destroy()
+        return True
+    except Exception:
+        return False
+
+
+class TestSnapshotSession(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        DefectModel.__table__.create(self.engine)
+        start = datetime.datetime(2023, 9, 1, 8)
+        with self.engine.begin() as cnn:
+            cnn.execute(sqlalchemy.insert(DefectModel.__table__),
+                        [{'source_lot_number': str(n), 'lam_num': 1, 'defect_start_ts': start,
+                          'defect_end_ts': start, 'entry_created_ts': start} for n in range(3)])
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_poll_is_one_query(self):
+        with QueryCounter(self.engine) as counter:
+            with snapshot_session(bind=self.engine) as session:
+                defects = DefectModel.find_new_since(lam_number=1, session=session)
+                session.commit()
+            drafts = [DefectDraft.from_model(defect) for defect in defects]
+            # every value is still there after the commit and close
+            values = [(defect.source_lot_number, defect.defect_end_ts, draft.lam_num)
+                      for defect, draft in zip(defects, drafts)]
+        self.assertEqual(len(values), 3)
+        self.assertEqual(counter.count, 1, counter.statements)
+
+    def test_read_only(self):
+        with snapshot_session(bind=self.engine) as session:
+            session.add(DefectModel(source_lot_number='lot'))
+            with self.assertRaises(sqlalchemy.exc.InvalidRequestError):
+                session.flush()
+
+
+@unittest.skipUnless(display_available(), 'needs a display for tkinter')
+class TestMessagePanelQueries(unittest.TestCase):
+    def test_opening_a_panel(self):
+        import tkinter
+
+        from dev_common import style_component
+        from msg_window.msg_panel import MessagePanel
+        from publishing_vars import PublishingLengthList
+
+        root = tkinter.Tk()
+        style_component(root, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+        start = datetime.datetime(2023, 9, 1, 8)
+        draft = DefectDraft.from_model(DefectModel(id=1, source_lot_number='123', lam_num=1, defect_start_ts=start,
+                                                   defect_end_ts=start, rolls_of_product_post_slit=3,
+                                                   record_creation_source='operator', defect_type='thickness'))
+        current_defects = PublishingLengthList([draft])
+        try:
+            with QueryCounter(engine) as counter:
+                MessagePanel(root, current_defects, draft, 1, pad={'x': 2, 'y': 2}, _wgt_styles=root._wgt_styles)
+                root.update()
+            self.assertLessEqual(counter.count, MAX_PANEL_QUERIES, counter.statements)
+        finally:
+            root.destroy()
+
+
+if __name__ == '__main__':
+    unittest.main()